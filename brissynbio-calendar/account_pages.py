@@ -110,6 +110,8 @@ class AccountDetailsPage(base_pages.BasePostPage):
             if band_equipment and len(band_equipment) > 0:
                 state.setTemplate("banned_equipment", band_equipment)
 
+            state.setTemplate("feed_urls", bsb.ical.get_feed_urls(state.account, self.request.host_url))
+
         self.write(state, "account.html", "Account")
 
     def render_get(self, state):
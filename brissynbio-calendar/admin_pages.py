@@ -7,9 +7,6 @@ import base_pages
 # CGI interface
 import cgi
 
-# pickling
-import pickle
-
 # dates and times
 import datetime
 
@@ -20,6 +17,7 @@ main_menu_items = [ base_pages.MenuItem("summary", "/admin/summary"),
                     base_pages.MenuItem("equipment", "/admin/equipment"),
                     base_pages.MenuItem("users", "/admin/users"),
                     base_pages.MenuItem("projects", "/admin/projects"),
+                    base_pages.MenuItem("billing", "/admin/billing"),
                     base_pages.MenuItem("feedback", "/admin/feedback"),
                     base_pages.MenuItem("bugs", "/admin/bugs"),
                     base_pages.MenuItem("backup", "/admin/backup") ]
@@ -53,20 +51,31 @@ class AdminPage(base_pages.BasePostPage):
         state.addParentPage("/admin/summary")
         state = self.buildSubMenu(state, main_menu_items)
 
-        state.setTemplate("number_of_accounts", bsb.accounts.number_of_accounts())
-        state.setTemplate("number_to_approve", bsb.accounts.number_of_account_to_approve())
-        state.setTemplate("number_of_projects", bsb.projects.number_of_projects())
+        # start all of the counts together, and wait for them once the 
+        # calendar account has been checked
+        number_to_approve = bsb.accounts.number_of_account_to_approve_async()
+        number_of_accounts = bsb.accounts.number_of_accounts_async()
+        number_of_projects = bsb.projects.number_of_projects_async()
+        number_of_equipment = bsb.equipment.number_of_equipment_async()
+        number_of_bookings = bsb.equipment.number_of_bookings_async()
+
+        has_calendar_account = bsb.calendar.hasCalendarAccount()
+        state.setTemplate("has_calendar_account", has_calendar_account)
+
+        number_to_approve = number_to_approve.get_result()
+
+        state.setTemplate("number_of_accounts", number_of_accounts.get_result())
+        state.setTemplate("number_to_approve", number_to_approve)
+        state.setTemplate("number_of_projects", number_of_projects.get_result())
+        state.setTemplate("number_of_equipment", number_of_equipment.get_result())
+        state.setTemplate("number_of_bookings", number_of_bookings.get_result())
 
         management_tasks = []
 
-        if bsb.accounts.number_of_account_to_approve() > 0:
+        if number_to_approve > 0:
             management_tasks.append( ("You have some user accounts to approve.",
                                       "/admin/users") )
 
-
-        has_calendar_account = bsb.calendar.hasCalendarAccount()
-        state.setTemplate("has_calendar_account", has_calendar_account)
-
         if not has_calendar_account:
             management_tasks.append( ("You have to connect the calendar account.",
                                       bsb.calendar.connectCalendarAccountURL()) )
@@ -109,55 +118,98 @@ class BackupPage(base_pages.BasePostPage):
     def needsAdmin(self):
         return True
 
+    def _restoreLegacy(self, state, database, file_contents):
+        """Restore from a backup file of one database, or a backup of every database
+           written as a pickle by earlier versions"""
+        if database == "all":
+            try:
+                backups = bsb.backup.read_legacy_backup(file_contents)
+            except bsb.backup.BackupError as e:
+                raise bsb.InputError("Cannot restore from the backup file. %s" % e.errorMessage(), detail=e)
+
+            failures = {}
+
+            for backup in backups:
+                try:
+                    databases[backup].restore(state.account, backups[backup])
+                except Exception as e:
+                    failures[backup] = e
+        
+            if len(failures) > 0:
+                raise bsb.InputError("Cannot restore fully from backup file! See details for more information.",
+                                     detail=failures)
+        else:
+            try:
+                databases[database].restore(state.account, file_contents)
+            except Exception as e:
+                raise bsb.InputError("Cannot restore the backup for database '%s'." % database,
+                                     detail=e)
+
     def render_restore(self, state, is_post):
         if is_post and len(state.extra_paths) > 1:
             database = state.extra_paths[1]
-            file_contents = self.request.POST.multi["filecontents"].file.read()
+            fileobj = self.request.POST.multi["filecontents"].file
 
-            if database == "all":
-                backups = pickle.loads(file_contents)
+            if not bsb.backup.is_backup_file(fileobj.read(2)):
+                fileobj.seek(0)
+                self._restoreLegacy(state, database, fileobj.read())
+            else:
+                fileobj.seek(0)
 
-                failures = {}
+                if database == "all":
+                    kinds = None
+                else:
+                    kinds = [database]
 
-                for backup in backups:
-                    try:
-                        databases[backup].restore(state.account, backups[backup])
-                    except Exception as e:
-                        failures[backup] = e
-        
-                if len(failures) > 0:
-                    raise bsb.InputError("Cannot restore fully from backup file! See details for more information.",
-                                         detail=failures)
-            else:
                 try:
-                    databases[database].restore(state.account, file_contents)
-                except Exception as e:
-                    raise bsb.InputError("Cannot restore the backup for database '%s'." % database,
+                    bsb.backup.start_restore(state.account, fileobj, kinds,
+                                             self.request.POST.multi["filecontents"].filename)
+                except bsb.backup.BackupError as e:
+                    raise bsb.InputError("Cannot restore from the backup file. %s" % e.errorMessage(),
                                          detail=e)
 
+                state.addMessage("The backup file has been uploaded and is being restored in the background. "
+                                 "The website will be in maintenance mode while the restored data is switched in.")
+                return self.render_overview(state, is_post)
+
         self.redirect("/admin/backup")            
 
-    def render_backup(self, state, is_post):
-        if len(state.extra_paths) > 1:
-            database = state.extra_paths[1]
-            filename = self.request.get("filename", "backup.dat")
+    def render_discard(self, state, is_post):
+        if is_post and len(state.extra_paths) > 1:
+            try:
+                bsb.backup.discard_restore(state.account, state.extra_paths[1])
+                state.addMessage("The data replaced by the restore is being deleted in the background.")
+            except bsb.backup.BackupError as e:
+                state.addError(e.errorMessage())
+
+        return self.render_overview(state, is_post)
+
+    def render_backup(self, state, is_post, incremental=False):
+        if incremental or len(state.extra_paths) > 1:
+            filename = self.request.get("filename", "backup.ndjson.gz")
+            since = None
 
-            output = None
+            if incremental:
+                kinds = None
+                since = bsb.to_datetime(self.request.get("since", None))
 
-            if database == "all":
-                backups = {}
-                for db in databases:
-                    backups[db] = databases[db].backup(state.account)
+                if not since:
+                    raise bsb.InputError("You must give the time since which the changes should be backed up")
 
-                output = pickle.dumps(backups)
+            elif state.extra_paths[1] == "all":
+                kinds = None
             else:
-                output = databases[database].backup(state.account)
+                kinds = [state.extra_paths[1]]
 
-        self.response.clear()
-        self.response.content_type = "application/octet-stream"
-        self.response.headers = { "Content-Type" : "application/octet-stream",
-                                  "Content-Disposition" : "inline; filename=\"%s\"" % str(filename)}
-        self.response.write(output)
+            chunks = bsb.backup.stream_backup(state.account, kinds, since)
+
+            self.response.clear()
+            self.response.headers["Content-Type"] = "application/gzip"
+            self.response.headers["Content-Disposition"] = "attachment; filename=\"%s\"" % str(filename)
+
+            # the backup is written as it is read, one compressed chunk at a time
+            for chunk in chunks:
+                self.response.out.write(chunk)
 
     def render_delete(self, state, is_post):
         if len(state.extra_paths) > 2:
@@ -184,7 +236,10 @@ class BackupPage(base_pages.BasePostPage):
             database = state.extra_paths[1]
 
             if database in databases:
-                state.setTemplate("data", databases[database].getAll(state.account))
+                page = databases[database].getPage(state.account, 
+                                                   bsb.to_string(self.request.get("cursor", None)))
+                state.setTemplate("data", page.items)
+                state.setTemplate("page", page)
                 state.setTemplate("database", database)
                 self.write(state, "admin_backup_backup.html", "Admin | Backup | %s" % database)
                 return
@@ -195,6 +250,9 @@ class BackupPage(base_pages.BasePostPage):
         keys = list(databases.keys())
         keys.sort()
         state.setTemplate("databases", keys)
+        state.setTemplate("backup_kinds", bsb.backup.backup_kinds())
+        state.setTemplate("last_watermark", bsb.backup.get_last_watermark())
+        state.setTemplate("restore_jobs", bsb.backup.list_restore_jobs())
         self.write(state, "admin_backup_overview.html", "Admin | Backup/Restore")
 
     def render_post(self, state, is_post=True):
@@ -207,8 +265,12 @@ class BackupPage(base_pages.BasePostPage):
         else:
             if state.extra_paths[0] == "backup":
                 return self.render_backup(state, is_post)
+            elif state.extra_paths[0] == "incremental":
+                return self.render_backup(state, is_post, incremental=True)
             elif state.extra_paths[0] == "restore":
                 return self.render_restore(state, is_post)
+            elif state.extra_paths[0] == "discard":
+                return self.render_discard(state, is_post)
             elif state.extra_paths[0] == "view":
                 return self.render_view(state, is_post)
             elif state.extra_paths[0] == "delete":
@@ -227,8 +289,9 @@ class AdminProjectsPage(base_pages.BasePostPage):
         return True
 
     def _printOverview(self, state):
-        projects = bsb.projects.list_projects()
-        state.setTemplate('projects', projects)
+        page = bsb.projects.list_projects_page(bsb.to_string(self.request.get("cursor", None)))
+        state.setTemplate('projects', page.items)
+        state.setTemplate('page', page)
         self.write(state, "admin_projects.html", "Admin Projects")
 
     def _printView(self, state, project_id):
@@ -304,8 +367,9 @@ class AdminUsersPage(base_pages.BaseGetPage):
         return True
 
     def _printOverview(self, state):
-        accounts = bsb.accounts.list_accounts()
-        state.setTemplate('accounts', accounts)
+        page = bsb.accounts.list_accounts_page(bsb.to_string(self.request.get("cursor", None)))
+        state.setTemplate('accounts', page.items)
+        state.setTemplate('page', page)
         self.write(state, "admin_users.html", "Admin Users")    
 
     def _printView(self, state, email):
@@ -438,11 +502,42 @@ class AdminCalendarPage(base_pages.BasePostPage):
                 calendar.disconnect(state.account)
                 self.redirect("/admin/calendars/%s" % idstring)
 
+            elif action in ["check_drift", "reconcile"]:
+                equip = bsb.equipment.get_equipment_for_calendar(idstring)
+
+                if equip is None:
+                    state.addError("Calendar '%s' is not used by any equipment, so has no bookings to reconcile." \
+                                        % calendar.name)
+                else:
+                    report = bsb.calendar_sync.reconcile_equipment(state.account, equip,
+                                                                    repair=(action == "reconcile"))
+
+                    if report and report.repaired:
+                        state.addMessage("Repaired %d drifted events in calendar '%s'" % \
+                                              (report.numDrifted(), calendar.name))
+
+            elif action == "watch":
+                equip = bsb.equipment.get_equipment_for_calendar(idstring)
+
+                if equip is None:
+                    state.addError("Calendar '%s' is not used by any equipment, so cannot be watched." \
+                                        % calendar.name)
+                else:
+                    bsb.calendar_watch.watch_calendar(state.account, equip,
+                                                      self.request.host_url + bsb.calendar_watch.NOTIFY_PATH)
+                    state.addMessage("Watching calendar '%s' for changes" % calendar.name)
+
+            elif action == "reset_sync":
+                bsb.calendar_sync.reset_sync(state.account, idstring)
+                state.addMessage("The next reconciliation of '%s' will perform a full sync" % calendar.name)
+
             elif action:
                 raise bsb.InputError("""Unknown form action '%s' for calendar '%s'.""" % (action,calendar.name))           
 
         state.setTemplate("calendar", calendar)
         state.setTemplate("calendar_url", calendar.getURL(state.account))
+        state.setTemplate("drift_report", bsb.calendar_sync.get_drift_report(idstring))
+        state.setTemplate("watch_channels", bsb.calendar_watch.get_channels(idstring))
         self.write(state, "admin_calendars_view.html", "Admin | Calendar | %s" % calendar.name)
 
     def calendarsPage(self, state, is_post=False):
@@ -463,9 +558,31 @@ class AdminCalendarPage(base_pages.BasePostPage):
 
         state.setTemplate('calendars', calendars)
         state.setTemplate('urls', urls)
+        state.setTemplate('drift_reports', bsb.calendar_sync.get_drift_reports())
+
+        # the health of the connection to google calendar
+        state.setTemplate('breaker_state', bsb.calendar.calendar_breaker_state())
+        state.setTemplate('budget_usage', bsb.calendar.calendar_budget_usage())
+        state.setTemplate('pool_stats', bsb.calendar.service_pool_stats())
+        state.setTemplate('cache_stats', bsb.calendar.http_cache_stats())
 
         self.write(state, "admin_calendars.html", "Admin Calendars")    
 
+    def feedsPage(self, state, action):
+        """Revoke the signed addresses of all of the booking feeds"""
+        if action == "revoke":
+            state.setTemplate("really_revoke_feeds", True)
+
+        elif action == "really_revoke":
+            bsb.ical.reset_secret(state.account)
+            state.addMessage("Revoked the addresses of all of the booking feeds. Users will need to copy "
+                             "the new addresses from their account pages.")
+
+        elif action:
+            raise bsb.InputError("""Unknown form action '%s' for the booking feeds.""" % action)
+
+        self.calendarsPage(state, False)
+
     def render_get(self, state):
         self.render_post(state, False)
 
@@ -476,6 +593,11 @@ class AdminCalendarPage(base_pages.BasePostPage):
 
         if state.extra_paths is None:
             self.calendarsPage(state, is_post)
+        elif state.extra_paths[0] == "feeds":
+            if len(state.extra_paths) > 1:
+                self.feedsPage(state, state.extra_paths[1])
+            else:
+                self.feedsPage(state, None)
         else:
             if len(state.extra_paths) > 1:
                 self.calendarViewPage(state, state.extra_paths[0], state.extra_paths[1], is_post)
@@ -654,7 +776,7 @@ class AdminEquipmentPage(base_pages.BasePostPage):
         state.setTemplate("newer_range_start", old_range_end)
         state.setTemplate("newer_range_end", old_range_end + datetime.timedelta(days=7))
 
-        bookings = bsb.equipment.get_bookings(start_time=old_range_start, end_time=old_range_end)
+        bookings = bsb.equipment.get_bookings(start_time=old_range_start, end_time=old_range_end, lazy=True)
         state.setTemplate("bookings", bookings)
         state.setTemplate("account_mapping", bsb.accounts.get_account_mapping())
 
@@ -704,7 +826,9 @@ class AdminEquipmentPage(base_pages.BasePostPage):
         state.setTemplate("labs_dict", bsb.equipment.get_laboratory_mapping())
         state.setTemplate("types_dict", bsb.equipment.get_equipment_type_mapping())
 
-        state.setTemplate("equipment", bsb.equipment.list_equipment())
+        page = bsb.equipment.list_equipment_page(bsb.to_string(self.request.get("cursor", None)))
+        state.setTemplate("equipment", page.items)
+        state.setTemplate("page", page)
 
         self.write(state, "admin_equipment.html", "Admin Equipment")        
 
@@ -835,6 +959,169 @@ class AdminEquipmentPage(base_pages.BasePostPage):
                 state.addError("Unrecognised action '%s'" % state.extra_paths[0])
                 self.overviewPage(state, is_post)
 
+class AdminQueryAuditPage(base_pages.BasePostPage):
+    """Page used to record the shapes of the queries run by this instance, and to
+       compare them against the composite indexes in index.yaml"""
+    def needsAdmin(self):
+        return True
+
+    def saveReferrer(self):
+        return False
+
+    def render_get(self, state):
+        self.render_post(state, False)
+
+    def render_post(self, state, is_post=True):
+        # the audit reads index.yaml and hooks into the datastore, so is only
+        # imported when this admin page is used, not on every request
+        import bsb.query_audit
+
+        state.addParentPage("/admin")
+        state = self.buildSubMenu(state, main_menu_items)
+
+        if state.extra_paths:
+            action = state.extra_paths[0]
+
+            if action == "start":
+                bsb.query_audit.start_recording()
+            elif action == "stop":
+                bsb.query_audit.stop_recording()
+            elif action == "reset":
+                bsb.query_audit.reset()
+            elif action == "replay":
+                was_recording = bsb.query_audit.is_recording()
+                bsb.query_audit.start_recording()
+
+                for error in bsb.query_audit.replay(state.account):
+                    state.addError(error)
+
+                if not was_recording:
+                    bsb.query_audit.stop_recording()
+            else:
+                state.addError("Unknown action '%s'" % action)
+
+        state.setTemplate("is_recording", bsb.query_audit.is_recording())
+        state.setTemplate("report", bsb.query_audit.audit())
+
+        self.write(state, "admin_query_audit.html", "Admin | Query Audit")
+
+class AdminBillingPage(base_pages.BasePostPage):
+    """Page used to set the hourly rates charged for the equipment, to run the
+       billing job, and to view the invoices that it has saved"""
+    def needsAdmin(self):
+        return True
+
+    def _readRate(self, name):
+        """Read the rate in pounds from the form field 'name', returning it in pence"""
+        text = bsb.to_string(self.request.get(name, None))
+
+        if not text:
+            return None
+
+        try:
+            return int( round(float(text.lstrip(u"£")) * 100) )
+        except ValueError:
+            raise bsb.InputError("You have entered '%s'. This is not an amount of money!" % text)
+
+    def _setRates(self, state):
+        rates = bsb.billing.get_rates()
+
+        for (name, idstring) in bsb.equipment.get_sorted_equipment_type_mapping():
+            rate = self._readRate("type_%s" % idstring)
+
+            if rate != rates.get("type_%s" % idstring):
+                bsb.billing.set_rate(state.account, rate, type_idstring=idstring)
+
+        for (name, idstring) in bsb.equipment.get_sorted_equipment_mapping():
+            rate = self._readRate("equipment_%s" % idstring)
+
+            if rate != rates.get("equipment_%s" % idstring):
+                bsb.billing.set_rate(state.account, rate, equipment_idstring=idstring)
+
+    def _printOverview(self, state):
+        state.setTemplate("runs", bsb.billing.list_runs(state.account))
+        state.setTemplate("rates", bsb.billing.get_rates())
+        state.setTemplate("types", bsb.equipment.get_sorted_equipment_type_mapping())
+        state.setTemplate("equipment", bsb.equipment.get_sorted_equipment_mapping())
+        state.setTemplate("period", bsb.billing.previous_period())
+        state.setTemplate("format_pence", bsb.billing.format_pence)
+
+        self.write(state, "admin_billing.html", "Admin | Billing")
+
+    def _printPeriod(self, state, period):
+        run = bsb.billing.get_run(state.account, period)
+
+        if not run:
+            state.addError("The billing has not been run for %s" % period)
+            self._printOverview(state)
+            return
+
+        state.setTemplate("run", run)
+        state.setTemplate("invoices", bsb.billing.get_invoices(state.account, period))
+        state.setTemplate("format_pence", bsb.billing.format_pence)
+
+        self.write(state, "admin_billing_period.html", "Admin | Billing | %s" % period)
+
+    def _printInvoice(self, state, period, project):
+        version = bsb.to_int(self.request.get("version", None))
+        invoice = bsb.billing.get_invoice(state.account, period, project, version)
+
+        if not invoice:
+            state.addError("There is no invoice for project '%s' for %s" % (project, period))
+            self._printOverview(state)
+            return
+
+        state.setTemplate("invoice", invoice)
+        state.setTemplate("run", bsb.billing.get_run(state.account, period))
+        state.setTemplate("format_pence", bsb.billing.format_pence)
+        state.setTemplate("mins_to_string", bsb.mins_to_string)
+
+        self.write(state, "admin_billing_invoice.html", "Admin | Billing | %s | %s" % (period, invoice.project_name))
+
+    def render_get(self, state):
+        self.render_post(state, False)
+
+    def render_post(self, state, is_post=True):
+        state.addParentPage("/admin/billing")
+        state.addParentPage("/admin")
+        state = self.buildSubMenu(state, main_menu_items)
+
+        try:
+            if state.extra_paths is None:
+                self._printOverview(state)
+                return
+
+            action = state.extra_paths[0]
+
+            if action == "period" and len(state.extra_paths) > 1:
+                self._printPeriod(state, state.extra_paths[1])
+                return
+
+            elif action == "invoice" and len(state.extra_paths) > 2:
+                self._printInvoice(state, state.extra_paths[1], state.extra_paths[2])
+                return
+
+            elif is_post and action == "run":
+                bsb.billing.start_billing(state.account, bsb.to_string(self.request.get("period", None)))
+                state.addMessage("The billing job has been started. Refresh this page to see the invoices.")
+
+            elif is_post and action == "reinvoice" and len(state.extra_paths) > 1:
+                bsb.billing.start_billing(state.account, state.extra_paths[1], invoices_only=True)
+                state.addMessage("The invoices for %s are being recomputed from the saved usage." % \
+                                    state.extra_paths[1])
+
+            elif is_post and action == "rates":
+                self._setRates(state)
+                state.addMessage("The rates have been saved. They will be used the next time the invoices are computed.")
+
+            else:
+                state.addError("Unrecognised action '%s'" % action)
+
+        except (bsb.billing.BillingError, bsb.InputError) as e:
+            state.addError(e.errorMessage())
+
+        self._printOverview(state)
+
 class AdminBugsPage(base_pages.BasePostPage):
     """Class to view the bugs pages"""
     def needsAdmin(self):
@@ -971,7 +1258,8 @@ class AdminFeedBackPage(base_pages.BasePostPage):
         state.setTemplate("newer_range_end", min(today_start, old_range_end + datetime.timedelta(days=7)))
 
         state.setTemplate("feedback", bsb.feedback.get_feedback(state.account, old_range_start, 
-                                                                old_range_end + datetime.timedelta(days=1)))
+                                                                old_range_end + datetime.timedelta(days=1),
+                                                                lazy=True))
  
         self.write(state, "admin_feedback.html", "Admin | Feedback")
 
@@ -506,8 +506,19 @@ def processLocationEdit(page, id, sub_action=None):
     return None
 
 import admin
+import counters
+import rate_limit
 import accounts
 import calendar
 import projects
 import feedback
 import equipment
+import calendar_sync
+import calendar_watch
+import ical
+import export
+import billing
+import backup
+import reports
+import utilisation
+import warmup
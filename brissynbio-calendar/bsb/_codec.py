@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the reader of the per-database backups written as pickles by
+   earlier versions. A changed pickle can run any code as it is read, so these are
+   read with an unpickler that only allows the named classes to be created"""
+
+import pickle
+import StringIO
+
+class CodecError(Exception):
+    """Raised when data cannot be decoded"""
+    def __init__(self, message, detail=None):
+        Exception.__init__(self, message)
+        self.message = message
+        self.detail = detail
+
+    def errorMessage(self):
+        return self.message
+
+# The classes that any legacy pickle may contain, as (module, name)
+_SAFE_GLOBALS = set( [("datetime", "datetime"), ("datetime", "date"), ("datetime", "time"),
+                      ("copy_reg", "_reconstructor"), ("__builtin__", "object"),
+                      ("google.appengine.api.datastore_types", "GeoPt")] )
+
+class _SafeUnpickler(pickle.Unpickler):
+    def __init__(self, data, allowed):
+        pickle.Unpickler.__init__(self, StringIO.StringIO(data))
+        self._allowed = allowed
+
+    def find_class(self, module, name):
+        # check the name before anything is imported, as importing can run code
+        if not (module, name) in self._allowed:
+            raise CodecError("The pickled data refers to '%s.%s', which is not allowed" % (module, name),
+                             detail=(module, name))
+
+        return pickle.Unpickler.find_class(self, module, name)
+
+def safe_unpickle(data, classes=[]):
+    """Unpickle the passed data (written by earlier versions of the backups), only
+       allowing the passed classes (and a few safe standard classes) to be created,
+       so that a changed file cannot run any code"""
+    allowed = set(_SAFE_GLOBALS)
+
+    for cls in classes:
+        allowed.add( (cls.__module__, cls.__name__) )
+
+    try:
+        return _SafeUnpickler(data, allowed).load()
+    except CodecError:
+        raise
+    except Exception as e:
+        # a changed pickle can make the unpickler raise almost anything
+        # (e.g. TypeError or AttributeError from a bad reduce or build)
+        raise CodecError("The pickled data is corrupted", detail=e)
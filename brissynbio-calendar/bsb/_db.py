@@ -4,7 +4,143 @@ from bsb import *
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 
-import pickle
+import time
+
+import _codec
+
+class Tombstone(ndb.Model):
+    """Records that an entity was deleted, so that an incremental backup can delete it
+       too. The tombstone is a child of the root of the deleted entity, so that it is
+       written in the same entity group (and the same transaction) as the delete"""
+    deleted_kind = ndb.StringProperty(indexed=False)
+    deleted_key = ndb.KeyProperty(indexed=False)
+    deleted = ndb.DateTimeProperty(indexed=True, auto_now_add=True)
+
+class TrackedModel(ndb.Model):
+    """Base class of the kinds that are backed up. This records when each entity was
+       last changed, and leaves a Tombstone when an entity is deleted, so that
+       incremental backups only need to include what has changed"""
+    modified = ndb.DateTimeProperty(indexed=True, auto_now=True)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if future.get_exception() is None:
+            Tombstone(id=key.urlsafe(), parent=key.root(), deleted_kind=key.kind(),
+                      deleted_key=key).put()
+
+def delete_tracked(keys):
+    """Delete the entities with the passed keys, writing the tombstones of any
+       tracked entities in one batch, rather than one at a time as the delete
+       hook of TrackedModel would"""
+    ctx = ndb.get_context()
+    ndb.Future.wait_all( [ctx.delete(key) for key in keys] )
+
+    tombstones = []
+
+    for key in keys:
+        CLASS = ndb.Model._kind_map.get(key.kind())
+
+        if CLASS and issubclass(CLASS, TrackedModel):
+            tombstones.append( Tombstone(id=key.urlsafe(), parent=key.root(),
+                                         deleted_kind=key.kind(), deleted_key=key) )
+
+    ndb.put_multi(tombstones)
+
+class RegistryAliases(ndb.Model):
+    """The registries whose data is held under a different name. A restore writes
+       into a new (shadow) registry and then points the registry at it, so that the
+       restored data replaces the old data in one step. 'aliases' maps the name of
+       each registry used by the code to the name of the registry holding its data"""
+    aliases = ndb.JsonProperty()
+    changed = ndb.DateTimeProperty(indexed=False, auto_now=True)
+
+# How often (in seconds) each instance reloads the registry aliases
+ALIAS_REFRESH_TIME = 10
+
+_ALIASES_CACHE_KEY = "bsb_registry_aliases"
+
+_aliases = None
+_aliases_time = 0
+
+def _aliases_key():
+    return ndb.Key(RegistryAliases, "bsb.registries")
+
+@ndb.non_transactional
+def _load_aliases():
+    aliases = memcache.get(_ALIASES_CACHE_KEY)
+
+    if aliases is None:
+        item = _aliases_key().get(use_cache=False, use_memcache=False)
+
+        if item and item.aliases:
+            aliases = item.aliases
+        else:
+            aliases = {}
+
+        # 'add' never replaces the aliases written by set_registry_aliases, even if they
+        # changed after they were read here, and the expiry bounds any other staleness
+        memcache.add(_ALIASES_CACHE_KEY, aliases, time=ALIAS_REFRESH_TIME)
+
+    return aliases
+
+def get_registry_aliases():
+    """Return the dictionary mapping the name of each aliased registry to the name of
+       the registry that holds its data. This is reloaded every ALIAS_REFRESH_TIME seconds"""
+    global _aliases, _aliases_time
+
+    now = time.time()
+
+    if _aliases is None or now - _aliases_time > ALIAS_REFRESH_TIME:
+        _aliases = _load_aliases()
+        _aliases_time = now
+
+    return _aliases
+
+def set_registry_aliases(aliases):
+    """Point each registry in the passed dictionary at the registry that now holds its
+       data, returning the dictionary of the registries that held the data before.
+       Other instances see the change within ALIAS_REFRESH_TIME seconds"""
+    global _aliases
+
+    item = _aliases_key().get(use_cache=False, use_memcache=False)
+
+    if not item:
+        item = RegistryAliases(key=_aliases_key(), aliases={})
+
+    current = dict(item.aliases or {})
+    previous = {}
+
+    for (name, physical) in aliases.items():
+        previous[name] = current.get(name, name)
+
+        if physical == name:
+            current.pop(name, None)
+        else:
+            current[name] = physical
+
+    item.aliases = current
+    item.put()
+
+    memcache.set(_ALIASES_CACHE_KEY, current, time=ALIAS_REFRESH_TIME)
+    _aliases = None
+
+    return previous
+
+def registry(name):
+    """Return the name of the registry that holds the data of the registry 'name'.
+       This is 'name' itself unless the registry has been replaced by a restore"""
+    if name is None:
+        return None
+
+    return get_registry_aliases().get(name, name)
+
+def logical_registry(name):
+    """Return the name used by the code for the passed name of the registry holding
+       the data, i.e. the reverse of 'registry'"""
+    if name is None:
+        return None
+
+    return name.split("@")[0]
 
 def setFromInfo(dbobj, info):
     dbobj.key = info._getKey()
@@ -23,13 +159,9 @@ def _get_items(CLASS_INFO, CLASS, registry):
 
     return infos
 
-def getAllFromDB(account, CLASS, registry):
-    """Function to download a dictionary of the entire contents of this database"""
-    if registry:
-        items = CLASS.getQuery(registry).fetch()
-    else:
-        items = CLASS.getQuery().fetch()
-
+def _to_table(items):
+    """Convert the passed datastore items into a table (list of rows), where
+       the first row contains the column names"""
     if not items:
         return {}
 
@@ -48,6 +180,22 @@ def getAllFromDB(account, CLASS, registry):
 
     return output
 
+def getAllFromDB(account, CLASS, registry):
+    """Function to download a dictionary of the entire contents of this database"""
+    if registry:
+        items = CLASS.getQuery(registry).fetch()
+    else:
+        items = CLASS.getQuery().fetch()
+
+    return _to_table(items)
+
+def getPageFromDB(account, CLASS, registry, cursor=None, page_size=None):
+    """Function to return one page of the contents of this database. This returns
+       an ItemPage whose items are the table of data for the page"""
+    page = fetch_page(CLASS, registry, cursor, page_size)
+    page.items = _to_table(page.items)
+    return page
+
 def deleteDB(account, CLASS_INFO, CLASS, registry=None):
     """Function used to completely delete the entire database for class 'CLASS'
        contained in the registry 'registry'"""
@@ -64,14 +212,7 @@ def deleteDB(account, CLASS_INFO, CLASS, registry=None):
     for item in items:
         keys.append( item.key )
 
-    ndb.delete_multi( keys )
-
-def backup(account, CLASS_INFO, CLASS, registry=None):
-    """Function used to return a string containing the entire database for class 'CLASS'
-       backed up from the passed registry"""
-
-    assert_is_admin(account, "Only administrator accounts can backup and restore the database.")
-    return pickle.dumps( _get_items(CLASS_INFO, CLASS, registry) )
+    delete_tracked( keys )
 
 def restore(account, CLASS_INFO, CLASS, data, registry=None, delete_existing=True):
     """Function to restore the database from the passed 'data' string"""
@@ -82,8 +223,12 @@ def restore(account, CLASS_INFO, CLASS, data, registry=None, delete_existing=Tru
 
     assert_is_admin(account, "Only administrator accounts can backup and restore the database.")
 
-    # load all of the items
-    items = pickle.loads(data)
+    # load all of the items. These backups were written as pickles by earlier
+    # versions, so are only allowed to create the objects that can be in a backup
+    try:
+        items = _codec.safe_unpickle(data, CLASS_INFO._LEGACY_CLASSES + [CLASS_INFO, CLASS])
+    except _codec.CodecError as e:
+        raise InputError("Cannot restore as the backup cannot be read. %s" % e.errorMessage(), detail=e)
 
     bad_items = []
 
@@ -122,9 +267,47 @@ def restore(account, CLASS_INFO, CLASS, data, registry=None, delete_existing=Tru
 
         ndb.put_multi(dbitems)
 
+class LazyInfo(object):
+    """A lightweight, read-only view of a datastore item, used for large listings.
+       The fields named in _FIELDS are converted directly from the item when
+       they are read. The full Info object (of type CLASS_INFO) is only
+       created the first time that any other attribute is used"""
+    __slots__ = ("_item", "_CLASS_INFO", "_info")
+
+    # dictionary of field name to function that converts the item to that field
+    _FIELDS = { "idstring" : lambda item: unicode(item.key.string_id()),
+                "id" : lambda item: unicode(item.key.string_id()),
+                "name" : lambda item: unicode(item.name) if item.name else None }
+
+    def __init__(self, item, CLASS_INFO):
+        self._item = item
+        self._CLASS_INFO = CLASS_INFO
+        self._info = None
+
+    def info(self):
+        """Return the full Info object for this item"""
+        if self._info is None:
+            self._info = self._CLASS_INFO(self._item)
+
+        return self._info
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        try:
+            convert = self._FIELDS[name]
+        except KeyError:
+            return getattr(self.info(), name)
+
+        return convert(self._item)
+
 class StandardInfo:
     """Base class of all of the standard 'Info' classes,
        for database objects that have an 'idstring', 'name' and 'information'"""
+    # the other classes that could be pickled in a backup written by earlier versions
+    _LEGACY_CLASSES = []
+
     def __init__(self, item, registry):
         self._registry = None
         self.name = None
@@ -197,35 +380,43 @@ class StandardInfo:
                                     Click below for more details.""" % (item.name, info),
                                  detail=e)
 
-def get_idstring_to_name_db(CLASS, registry):
-    """Call this function to return a dictionary that maps all of the 
-       items in the database for CLASS under registry to the names of
-       these items"""
+@ndb.tasklet
+def get_idstring_to_name_db_async(CLASS, registry):
+    """Return a future for the dictionary that maps the IDString of every item of
+       type CLASS in 'registry' to its name. The query is only run if the
+       dictionary is not already in memcache"""
     key = "%s_%s_db" % (CLASS.__name__,registry)
-    d = memcache.get(key)
+    ctx = ndb.get_context()
+    d = yield ctx.memcache_get(key)
 
-    if d:
-        return d
-    else:
+    if not d:
         d = {}
-        items = CLASS.getQuery(registry).fetch()
+        items = yield CLASS.getQuery(registry).fetch_async()
 
         for item in items:
             d[ unicode(item.key.string_id()) ] = unicode(item.name)
 
-        memcache.set(key=key, value=d)
+        yield ctx.memcache_set(key, d)
 
-        return d
+    raise ndb.Return(d)
 
-def get_sorted_names_to_idstring(CLASS, registry):
+def get_idstring_to_name_db(CLASS, registry):
+    """Call this function to return a dictionary that maps all of the 
+       items in the database for CLASS under registry to the names of
+       these items"""
+    return get_idstring_to_name_db_async(CLASS, registry).get_result()
+
+@ndb.tasklet
+def get_sorted_names_to_idstring_async(CLASS, registry):
+    """Return a future for the list of (name, IDString) pairs of every item of
+       type CLASS in 'registry', sorted by name"""
     k = "%s_%s_ll" % (CLASS.__name__,registry)
-    d = memcache.get(k)
+    ctx = ndb.get_context()
+    l = yield ctx.memcache_get(k)
 
-    if d:
-        return d
-    else:
+    if not l:
         d = {}
-        items = CLASS.getQuery(registry).fetch()
+        items = yield CLASS.getQuery(registry).fetch_async()
 
         for item in items:
             d[unicode(item.name)] = unicode(item.key.string_id())
@@ -238,9 +429,12 @@ def get_sorted_names_to_idstring(CLASS, registry):
         for key in keys:
             l.append( (key,d[key]) )
 
-        memcache.set(key=k, value=l)
+        yield ctx.memcache_set(k, l)
+
+    raise ndb.Return(l)
 
-        return l
+def get_sorted_names_to_idstring(CLASS, registry):
+    return get_sorted_names_to_idstring_async(CLASS, registry).get_result()
 
 def changed_idstring_to_name_db(CLASS, registry):
     """Call this function to signal that the idstring to name db has been
@@ -248,47 +442,68 @@ def changed_idstring_to_name_db(CLASS, registry):
     memcache.set( "%s_%s_db" % (CLASS.__name__,registry), None )
     memcache.set( "%s_%s_ll" % (CLASS.__name__,registry), None )
 
+def _item_key(CLASS, idstring, registry=None):
+    if registry:
+        return ndb.Key( CLASS, idstring, parent=CLASS.ancestor(registry) )
+    else:
+        return ndb.Key( CLASS, idstring, parent=CLASS.ancestor() )
+
+def get_db_async(CLASS, idstring, registry=None):
+    """Return a future for the database item matching IDString 'idstring'"""
+    if not idstring:
+        future = ndb.Future()
+        future.set_result(None)
+        return future
+
+    return _item_key(CLASS, idstring, registry).get_async()
+
 def get_db(CLASS, idstring, registry=None):
     """Return the database item matching IDString 'idstring'"""
-    if not idstring:
-        return None
+    return get_db_async(CLASS, idstring, registry).get_result()
 
-    if registry:
-        key = ndb.Key( CLASS, idstring, parent=CLASS.ancestor(registry) )
-    else:
-        key = ndb.Key( CLASS, idstring, parent=CLASS.ancestor() )
+@ndb.tasklet
+def get_item_async(CLASS, CLASS_INFO, idstring, registry):
+    """Return a future for the item of type CLASS with IDString 'idstring',
+       converted to type CLASS_INFO, or for None if there is no such item"""
+    item = yield get_db_async(CLASS, idstring, registry)
 
-    item = key.get()
-    return item
+    if item:
+        raise ndb.Return( CLASS_INFO(item) )
+    else:
+        raise ndb.Return(None)
 
 def get_item(CLASS, CLASS_INFO, idstring, registry):
     """Return the object matching idstring 'idstring' of type CLASS
        from the registry 'registry', returning the object converted to 
        type CLASS_INFO"""
+    return get_item_async(CLASS, CLASS_INFO, idstring, registry).get_result()
 
-    item = get_db(CLASS, idstring, registry)
-
-    if item:
-        return CLASS_INFO(item)
-    else:
-        return None
+def number_of_items_async(CLASS, registry):
+    """Return a future for the number of items in the passed registry for the passed CLASS type"""
+    return CLASS.getQuery(registry).count_async()
 
 def number_of_items(CLASS, registry):
     """Return the number of items in the passed registry for the passed CLASS type"""
-    return CLASS.getQuery(registry).count()
+    return number_of_items_async(CLASS, registry).get_result()
 
-def list_items(CLASS, CLASS_INFO, registry, sorted=True):
-    """Function to return a list of all entries of type CLASS in the passed registry,
-       where each item is converted to an object of type CLASS_INFO"""
+@ndb.tasklet
+def list_items_async(CLASS, CLASS_INFO, registry, sorted=True, lazy=False):
+    """Return a future for the list of all items of type CLASS in 'registry',
+       converted to CLASS_INFO (or to LazyInfo views if 'lazy' is true)"""
+
+    items = yield CLASS.getQuery(registry).fetch_async()
 
-    items = CLASS.getQuery(registry).fetch()
+    if lazy:
+        convert = lambda item: LazyInfo(item, CLASS_INFO)
+    else:
+        convert = CLASS_INFO
 
     output = []
 
     if sorted:
         sorted_items = {}
         for item in items:
-            sorted_items[item.name] = CLASS_INFO(item)
+            sorted_items[item.name] = convert(item)
 
         keys = list(sorted_items.keys())
         keys.sort()
@@ -298,6 +513,83 @@ def list_items(CLASS, CLASS_INFO, registry, sorted=True):
 
     else:
         for item in items:
-            output.append( CLASS_INFO(item) )
+            output.append( convert(item) )
 
-    return output
+    raise ndb.Return(output)
+
+def list_items(CLASS, CLASS_INFO, registry, sorted=True, lazy=False):
+    """Function to return a list of all entries of type CLASS in the passed registry,
+       where each item is converted to an object of type CLASS_INFO. If 'lazy'
+       is true then each item is returned as a LazyInfo view, which is only 
+       converted when needed"""
+    return list_items_async(CLASS, CLASS_INFO, registry, sorted, lazy).get_result()
+
+# The default number of items shown on each page of a paginated listing
+DEFAULT_PAGE_SIZE = 50
+
+class ItemPage:
+    """Simple class that holds a single page of items from a paginated listing,
+       together with the cursors needed to move to the next and previous pages.
+       All cursors are urlsafe strings that point to the start of a page"""
+    def __init__(self, items, cursor=None, next_cursor=None, prev_cursor=None, has_prev=False):
+        self.items = items
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_prev = has_prev
+
+    def hasNext(self):
+        return self.next_cursor is not None
+
+    def hasPrevious(self):
+        return self.has_prev
+
+def _to_cursor(cursor):
+    """Convert the passed urlsafe string into a datastore cursor"""
+    if not cursor:
+        return None
+
+    try:
+        return ndb.Cursor(urlsafe=cursor)
+    except Exception as e:
+        raise InputError("The page cursor '%s' is not valid" % cursor, detail=e)
+
+def fetch_page(CLASS, registry, cursor=None, page_size=None):
+    """Return the page of items of type CLASS in the passed registry that starts at 
+       the urlsafe 'cursor'. Items are ordered by key (their idstring), which is
+       indexed, so the cost of each page does not depend on the number of items"""
+    if not page_size:
+        page_size = DEFAULT_PAGE_SIZE
+
+    if registry:
+        query = CLASS.getQuery(registry)
+    else:
+        query = CLASS.getQuery()
+
+    start = _to_cursor(cursor)
+
+    items, next_cursor, more = query.order(CLASS.key).fetch_page(page_size, start_cursor=start)
+
+    if more and next_cursor:
+        next_cursor = next_cursor.urlsafe()
+    else:
+        next_cursor = None
+
+    # find the start of the previous page by walking backwards from the start of this page
+    prev_cursor = None
+
+    if start:
+        keys, back_cursor, back_more = query.order(-CLASS.key).fetch_page(page_size, 
+                                                                          start_cursor=start.reversed(),
+                                                                          keys_only=True)
+        if back_more and back_cursor:
+            prev_cursor = back_cursor.reversed().urlsafe()
+
+    return ItemPage(items, cursor, next_cursor, prev_cursor, start is not None)
+
+def list_items_page(CLASS, CLASS_INFO, registry, cursor=None, page_size=None):
+    """Return the ItemPage of entries of type CLASS in the passed registry that starts
+       at 'cursor', where each item is converted to an object of type CLASS_INFO"""
+    page = fetch_page(CLASS, registry, cursor, page_size)
+    page.items = [ CLASS_INFO(item) for item in page.items ]
+    return page
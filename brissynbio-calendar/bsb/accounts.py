@@ -20,6 +20,9 @@ import re
 # import the project stuff
 import projects
 
+# maintained counts of accounts
+import counters
+
 from bsb import *
 
 # uses the db module, which should be kept private
@@ -37,9 +40,9 @@ DEFAULT_USERACCOUNT_REGISTRY = "bsb.equipment.users"
 def user_account_key(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Constructs a Datastore key for a user account entry.
        We use the account name as the key"""
-    return ndb.Key('Accounts', useraccount_registry)
+    return ndb.Key('Accounts', _db.registry(useraccount_registry))
 
-class Account(ndb.Model):
+class Account(_db.TrackedModel):
     """The main model for representing an individual user account."""
 
     # Nickname - used when writing nice text to the user
@@ -121,53 +124,120 @@ class AccountInfo(_db.StandardInfo):
         return _db.getAllFromDB(account, Account, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, Account, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, Account, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
         """Restore the database from the passed 'data' string containing a pickle of all of the objects"""
         _db.restore(account, cls, Account, data, registry, delete_existing=False)
+        reconcile_counters(registry or DEFAULT_USERACCOUNT_REGISTRY)
 
     @classmethod
     def deleteDB(cls, account, registry=None):
         """Delete the entire database"""
         _db.deleteDB(account, cls, Account, registry)
+        reconcile_counters(registry or DEFAULT_USERACCOUNT_REGISTRY)
 
 def list_accounts(sorted=True, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Function to return a string containing a list of all user accounts"""
     return _db.list_items(Account, AccountInfo, useraccount_registry, sorted)
 
-def number_of_accounts(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
-    """Function to return the total number of user accounts"""
-    return _db.number_of_items(Account, useraccount_registry)
+def list_accounts_page(cursor=None, page_size=None, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Function to return the page of user accounts that starts at 'cursor', 
+       ordered by email address"""
+    return _db.list_items_page(Account, AccountInfo, useraccount_registry, cursor, page_size)
 
-def number_of_admin_accounts(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
-    """Function to return the total number of admin accounts"""
+def _account_counts(account, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Return the dictionary of counters to which the passed account (either an
+       Account or AccountInfo) contributes"""
+    if not account:
+        return {}
 
-    accounts = list_accounts(False, useraccount_registry)
+    counts = { "%s:total" % useraccount_registry : 1 }
 
-    nadmin = 0
+    if account.is_approved:
+        counts["%s:approved" % useraccount_registry] = 1
 
-    for account in accounts:
-        if account.is_admin and account.is_approved:
-            nadmin += 1
+        if account.is_admin:
+            counts["%s:admin" % useraccount_registry] = 1
+    else:
+        counts["%s:pending" % useraccount_registry] = 1
 
-    return nadmin
+    return counts
 
-def number_of_account_to_approve(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
-    """Function to return the total number of accounts that need to be approved"""
+def _save_account(account, old_counts, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Save the passed account, updating the account counters in the same transaction.
+       'old_counts' are the counts for the account before it was changed"""
+    new_counts = _account_counts(account, useraccount_registry)
+    counters.commit( puts=[account], changes=counters.differences(old_counts, new_counts) )
+
+@ndb.tasklet
+def reconcile_counters_async(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Return a future that completes once all of the accounts have been
+       recounted and the account counters reset"""
+    counts = {}
 
-    accounts = list_accounts(False, useraccount_registry)
+    for state in ["total", "approved", "pending", "admin"]:
+        counts["%s:%s" % (useraccount_registry,state)] = 0
 
-    napprove = 0
+    accounts = yield Account.getQuery(useraccount_registry).fetch_async()
 
     for account in accounts:
-        if not account.is_approved:
-            napprove += 1
+        for (name, value) in _account_counts(account, useraccount_registry).items():
+            counts[name] += value
+
+    yield counters.set_counts_async(counts)
+
+def reconcile_counters(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Recount all of the accounts and reset the account counters"""
+    reconcile_counters_async(useraccount_registry).get_result()
+
+def _number_of_accounts_async(state, useraccount_registry):
+    return counters.get_count_async( "%s:%s" % (useraccount_registry,state),
+                                     lambda: reconcile_counters_async(useraccount_registry) )
+
+def _number_of_accounts(state, useraccount_registry):
+    return _number_of_accounts_async(state, useraccount_registry).get_result()
 
-    return napprove
+def number_of_accounts_async(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Return a future for the total number of user accounts"""
+    return _number_of_accounts_async("total", useraccount_registry)
+
+def number_of_account_to_approve_async(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Return a future for the total number of accounts that need to be approved"""
+    return _number_of_accounts_async("pending", useraccount_registry)
+
+def number_of_accounts(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Function to return the total number of user accounts"""
+    return _number_of_accounts("total", useraccount_registry)
+
+def number_of_approved_accounts(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Function to return the total number of approved accounts"""
+    return _number_of_accounts("approved", useraccount_registry)
+
+def number_of_admin_accounts(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Function to return the total number of admin accounts"""
+    return _number_of_accounts("admin", useraccount_registry)
+
+def number_of_account_to_approve(useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Function to return the total number of accounts that need to be approved"""
+    return _number_of_accounts("pending", useraccount_registry)
+
+def system_account():
+    """Return the account used by background tasks (e.g. cron jobs) that run without
+       a signed-in user. This is an approved administrator account that is never
+       stored in the datastore"""
+    account = AccountInfo()
+    account.idstring = "bsb.system"
+    account.id = account.idstring
+    account.email = account.idstring
+    account.name = "Scheduler"
+    account.initials = "SYS"
+    account.is_approved = True
+    account.is_admin = True
+    return account
 
 def get_account_by_email_unchecked(email, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     email = to_email(email)
@@ -176,6 +246,10 @@ def get_account_by_email_unchecked(email, useraccount_registry=DEFAULT_USERACCOU
         return None
 
     account = _db.get_item(Account, AccountInfo, email, useraccount_registry)
+
+    if account is None:
+        return None
+
     return account.publicData()
 
 def get_account_by_email(admin_account, email, 
@@ -232,6 +306,10 @@ def get_account_mapping(registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Return the dictionary mapping account emails to account names"""
     return _db.get_idstring_to_name_db(Account, registry)
 
+def get_account_mapping_async(registry=DEFAULT_USERACCOUNT_REGISTRY):
+    """Return a future for the dictionary mapping account emails to account names"""
+    return _db.get_idstring_to_name_db_async(Account, registry)
+
 def get_sorted_account_mapping(registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Return a sorted list of all account names, together with their emails"""
     return _db.get_sorted_names_to_idstring(Account,registry)
@@ -463,7 +541,7 @@ def add_account(user, name, initials, intro_text,
                        is_approved = is_first_account,
                        is_admin = is_first_account )
 
-    account.put()
+    _save_account(account, {}, useraccount_registry)
     _db.changed_idstring_to_name_db(Account,useraccount_registry)
 
     return
@@ -509,7 +587,8 @@ def delete_account(user, pin_number, useraccount_registry=DEFAULT_USERACCOUNT_RE
         if nadmin < 2:
             raise DeleteAccountError( """You cannot delete this account as this will not leave any other admin accounts left to administer the system!""" )
 
-    account.key.delete()
+    counters.commit( deletes=[account._getKey()],
+                     changes=counters.differences(_account_counts(account, useraccount_registry), {}) )
     _db.changed_idstring_to_name_db(Account,useraccount_registry)
 
 class AccountPermissionError:
@@ -545,8 +624,9 @@ def approve_account(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REG
     account = _get_account(account, email, useraccount_registry)
 
     if not account.is_approved:
+        old_counts = _account_counts(account, useraccount_registry)
         account.is_approved = True
-        account.put()
+        _save_account(account, old_counts, useraccount_registry)
 
 def make_admin_account(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Function that makes the account connected to the passed email an admin account. Note
@@ -559,8 +639,9 @@ def make_admin_account(account, email, useraccount_registry=DEFAULT_USERACCOUNT_
         raise AccountPermissionError( ["You cannot make the account '%s' an admin as it has not yet been approved." % email] )
 
     if not account.is_admin:
+        old_counts = _account_counts(account, useraccount_registry)
         account.is_admin = True
-        account.put()
+        _save_account(account, old_counts, useraccount_registry)
 
 def revoke_admin_access(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Function that makes the account connected to the passed email not an admin account. Note
@@ -577,8 +658,9 @@ def revoke_admin_access(account, email, useraccount_registry=DEFAULT_USERACCOUNT
                                           else left who has admin access!"""] )
 
     if account.is_admin:
+        old_counts = _account_counts(account, useraccount_registry)
         account.is_admin = False
-        account.put()
+        _save_account(account, old_counts, useraccount_registry)
 
 def revoke_access(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REGISTRY):
     """Function that makes the account connected to the passed email not an approved account. Note
@@ -588,6 +670,8 @@ def revoke_access(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REGIS
     account = _get_account(account, email, useraccount_registry)
 
     if account.is_approved:
+        old_counts = _account_counts(account, useraccount_registry)
+
         if account.is_admin:
             # count the number of admin accounts - we cannot go below 1 admin account
             nadmin = number_of_admin_accounts(useraccount_registry)
@@ -599,7 +683,7 @@ def revoke_access(account, email, useraccount_registry=DEFAULT_USERACCOUNT_REGIS
             account.is_admin = False
         
         account.is_approved = False
-        account.put()
+        _save_account(account, old_counts, useraccount_registry)
 
 class AccountEditError:
     def __init__(self, errors):
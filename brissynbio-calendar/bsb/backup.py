@@ -0,0 +1,1220 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the streaming backup and restore of the databases. A backup
+   is a gzip compressed file of newline-delimited JSON records, written as a series
+   of independent gzip members that each end at the end of a line, so that reading
+   can start again at any member. The first line is
+   a header giving the format and schema version, followed by one line per entity,
+   and the last line is a trailer holding the number of records and the SHA-1
+   checksum of all of the lines before it. Each kind is read a page at a time
+   using query cursors, and the file is written as it is read, so the memory used
+   does not depend on the size of the databases.
+
+   An incremental backup only holds the entities changed since the watermark of
+   an earlier backup, together with a record of each entity deleted since then,
+   so that it can be restored on top of the earlier backup.
+
+   A restore is run as a background job. The uploaded file is saved in chunks,
+   verified, and its records are then written in batches into new (shadow)
+   registries, saving the position reached after every batch so that the job
+   resumes where it stopped if it runs out of time. The registries are only
+   switched to the restored data once it is complete, so a failed restore never
+   leaves the databases half restored. Tasks and cron jobs keep running while
+   a restore runs, so the changes they make to the data that is kept are copied
+   into the shadow registries before, and again just after, the switch"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.runtime import apiproxy_errors
+
+import base64
+import datetime
+import hashlib
+import json
+import time
+import zlib
+
+from bsb import *
+
+import _db
+import _codec
+import admin
+import accounts
+import calendar
+import counters
+import equipment
+import feedback
+import ical
+import billing
+import projects
+
+# The format and version of the schema of the records written to a backup file
+BACKUP_FORMAT = "bsb-backup"
+SCHEMA_VERSION = 1
+
+# The number of entities read from (or written to) the datastore at a time
+BACKUP_PAGE_SIZE = 200
+
+# The approximate size of each compressed chunk of the backup file
+CHUNK_SIZE = 64 * 1024
+
+# The approximate uncompressed size of each gzip member of the backup file. A restore
+# that stops resumes from the start of the member that it was reading
+MEMBER_SIZE = 1024 * 1024
+
+# The size of the blocks read from an uploaded backup file
+READ_SIZE = 64 * 1024
+
+# The format of the times written to the header of a backup file
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# How far the watermark of a backup is set before the backup starts, so that
+# entities saved on instances with slightly different clocks are not missed
+WATERMARK_MARGIN = datetime.timedelta(minutes=1)
+
+# The size of the chunks in which an uploaded backup file is saved for restoring
+RESTORE_CHUNK_SIZE = 512 * 1024
+
+# How long (in seconds) each run of the restore task works before queueing the next run
+RESTORE_TASK_TIME = 5 * 60
+
+# The path of the task that runs the restore jobs
+RESTORE_TASK_PATH = "/tasks/restore_backup"
+
+# The path of the task that recounts the counters after a restore
+RECONCILE_TASK_PATH = "/tasks/reconcile_counters"
+
+class BackupError(SchedulerError):
+    pass
+
+# The errors that only stop the current run of a restore job. The task is retried,
+# and the job resumes from the last saved position. Any other error fails the job
+_TRANSIENT_ERRORS = (datastore_errors.Timeout, datastore_errors.TransactionFailedError,
+                     datastore_errors.InternalError, apiproxy_errors.DeadlineExceededError,
+                     apiproxy_errors.CapabilityDisabledError)
+
+class BackupKind(object):
+    """A kind that is backed up. Kinds derived from _db.TrackedModel record when each
+       entity was last changed, so an incremental backup only includes the changed
+       entities. Untracked children of a tracked kind (e.g. the messages of a feedback
+       discussion) are included when their parent has changed, while the other untracked
+       kinds are small, and are always included in full. 'ancestor' is the function
+       returning the root key of the kind, which changes when its registry is restored"""
+    def __init__(self, name, CLASS, ancestor=None, parent_kind=None):
+        self.name = name
+        self.CLASS = CLASS
+        self._ancestor = ancestor
+        self.parent_kind = parent_kind
+
+    def isTracked(self):
+        return issubclass(self.CLASS, _db.TrackedModel)
+
+    def ancestor(self):
+        """Return the current root key of the entities of this kind, or None if
+           they are root entities"""
+        if self._ancestor:
+            return self._ancestor()
+        else:
+            return None
+
+    def registry(self):
+        """Return the name of the registry holding this kind, or None if the entities
+           are root entities (which are restored in place)"""
+        if self._ancestor:
+            return _db.logical_registry(self.ancestor().string_id())
+        else:
+            return None
+
+    def query(self, since=None, ancestor=None):
+        """Return the query for the entities of this kind, optionally only those changed
+           after 'since', or only those that are descendants of 'ancestor'"""
+        ancestor = ancestor or self.ancestor()
+
+        if ancestor:
+            query = self.CLASS.query(ancestor=ancestor)
+        else:
+            query = self.CLASS.query()
+
+        if since and self.isTracked():
+            query = query.filter(self.CLASS.modified > since)
+
+        return query
+
+# The kinds that are backed up, in the order in which they are written. The generated
+# export files, the calendar sync states and the webhook channels are not backed up, as
+# they are rebuilt automatically (and channels belong to the running application)
+BACKUP_KINDS = [ BackupKind("Account", accounts.Account, accounts.Account.ancestor),
+                 BackupKind("Calendar", calendar.Calendar, calendar.Calendar.ancestor),
+                 BackupKind("Equipment", equipment.Equipment, equipment.Equipment.ancestor),
+                 BackupKind("EquipmentType", equipment.EquipmentType, equipment.EquipmentType.ancestor),
+                 BackupKind("Laboratory", equipment.Laboratory, equipment.Laboratory.ancestor),
+                 BackupKind("Project", projects.Project, projects.Project.ancestor),
+                 BackupKind("EquipmentACL", equipment.EquipmentACL, equipment.EquipmentACL.ancestor),
+                 BackupKind("EquipmentReqs", equipment.EquipmentReqs, equipment.EquipmentReqs.ancestor),
+                 BackupKind("Booking", equipment.Booking, equipment.Booking.ancestor),
+                 BackupKind("BookingReqs", equipment.BookingReqs, equipment.BookingReqs.ancestor),
+                 BackupKind("FeedBack", feedback.FeedBack, feedback.FeedBack.ancestor),
+                 BackupKind("FeedBackMessage", feedback.FeedBackMessage, feedback.FeedBack.ancestor,
+                            parent_kind="FeedBack"),
+                 BackupKind("Bug", feedback.Bug, feedback.Bug.ancestor),
+                 BackupKind("BillingRate", billing.BillingRate, billing.billing_key),
+                 BackupKind("BillingRun", billing.BillingRun, billing.billing_key),
+                 BackupKind("UsageRollup", billing.UsageRollup, billing.billing_key),
+                 BackupKind("Invoice", billing.Invoice, billing.billing_key),
+                 BackupKind("FeedSecret", ical.FeedSecret),
+                 BackupKind("CounterShard", counters.CounterShard) ]
+
+_kinds = dict( [(kind.name, kind) for kind in BACKUP_KINDS] )
+
+# the untracked kinds that are backed up with their parent, indexed by the parent's kind
+_child_kinds = {}
+
+for kind in BACKUP_KINDS:
+    if kind.parent_kind:
+        _child_kinds.setdefault(kind.parent_kind, []).append(kind)
+
+def backup_kinds():
+    """Return the names of all of the kinds that can be backed up"""
+    return [ kind.name for kind in BACKUP_KINDS ]
+
+class BackupState(ndb.Model):
+    """The watermark of the last complete backup of every kind, from which
+       the next incremental backup starts"""
+    watermark = ndb.DateTimeProperty(indexed=False)
+    last_backup = ndb.DateTimeProperty(indexed=False)
+    was_incremental = ndb.BooleanProperty(indexed=False)
+
+def _state_key():
+    return ndb.Key(BackupState, "bsb.backup")
+
+def get_last_watermark():
+    """Return the watermark of the last complete backup of every kind, or None if there
+       has not been one. An incremental backup from this time holds every change since"""
+    state = _state_key().get()
+
+    if state:
+        return state.watermark
+    else:
+        return None
+
+def _time_to_string(t):
+    if t:
+        return t.strftime(TIME_FORMAT)
+    else:
+        return None
+
+def _string_to_time(s):
+    if s:
+        return datetime.datetime.strptime(s, TIME_FORMAT)
+    else:
+        return None
+
+def is_backup_file(data):
+    """Return whether the passed start of a file is the start of a backup file written
+       by this module (a gzip file) rather than a pickled backup"""
+    return data[0:2] == "\x1f\x8b"
+
+def _encode_value(prop, value):
+    """Encode the passed value of property 'prop' as a JSON value"""
+    if value is None:
+        return None
+    elif isinstance(prop, ndb.StructuredProperty):
+        return _encode_properties(value)
+    elif isinstance(prop, ndb.DateTimeProperty):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    elif isinstance(prop, ndb.DateProperty):
+        return value.strftime("%Y-%m-%d")
+    elif isinstance(prop, ndb.TimeProperty):
+        return value.strftime("%H:%M:%S.%f")
+    elif isinstance(prop, ndb.GeoPtProperty):
+        return [value.lat, value.lon]
+    elif isinstance(prop, ndb.KeyProperty):
+        return list(value.flat())
+    elif isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    elif isinstance(prop, ndb.BlobProperty):
+        return base64.b64encode(value)
+    else:
+        return value
+
+def _decode_value(prop, value):
+    """Decode the passed JSON value of property 'prop'"""
+    if value is None:
+        return None
+    elif isinstance(prop, ndb.StructuredProperty):
+        return _decode_properties(prop._modelclass, value)
+    elif isinstance(prop, ndb.DateTimeProperty):
+        return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    elif isinstance(prop, ndb.DateProperty):
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    elif isinstance(prop, ndb.TimeProperty):
+        return datetime.datetime.strptime(value, "%H:%M:%S.%f").time()
+    elif isinstance(prop, ndb.GeoPtProperty):
+        return ndb.GeoPt(value[0], value[1])
+    elif isinstance(prop, ndb.KeyProperty):
+        return ndb.Key(flat=value)
+    elif isinstance(prop, (ndb.JsonProperty, ndb.TextProperty)):
+        return value
+    elif isinstance(prop, ndb.BlobProperty):
+        return base64.b64decode(value)
+    else:
+        return value
+
+def _encode_properties(entity):
+    """Return the dictionary of the stored properties of 'entity', indexed by attribute name"""
+    data = {}
+
+    for prop in entity._properties.values():
+        if isinstance(prop, ndb.ComputedProperty):
+            continue
+
+        value = prop._get_value(entity)
+
+        if prop._repeated:
+            data[prop._code_name] = [ _encode_value(prop, v) for v in (value or []) ]
+        else:
+            data[prop._code_name] = _encode_value(prop, value)
+
+    return data
+
+def _decode_properties(CLASS, data):
+    """Return an (unsaved) entity of 'CLASS' with the properties in 'data'. Properties
+       that are no longer part of the model are ignored"""
+    props = dict( [(prop._code_name, prop) for prop in CLASS._properties.values()
+                                           if not isinstance(prop, ndb.ComputedProperty)] )
+    values = {}
+
+    for (name, value) in data.items():
+        prop = props.get(name)
+
+        if prop is None:
+            continue
+
+        if prop._repeated:
+            values[str(name)] = [ _decode_value(prop, v) for v in (value or []) ]
+        else:
+            values[str(name)] = _decode_value(prop, value)
+
+    return CLASS(**values)
+
+def _logical_flat(key):
+    """Return the flat path of the passed key, naming its registry as the code does,
+       so that the backup does not depend on where the registry's data is held"""
+    flat = list(key.flat())
+
+    if len(flat) > 1 and isinstance(flat[1], basestring):
+        flat[1] = _db.logical_registry(flat[1])
+
+    return flat
+
+def _move_key(flat, registries):
+    """Return the key with the passed flat path, moved into the registry to which
+       'registries' maps its registry. Keys in other registries are not moved"""
+    flat = list(flat)
+
+    if len(flat) > 1 and isinstance(flat[1], basestring):
+        flat[1] = registries.get(_db.logical_registry(flat[1]), flat[1])
+
+    return ndb.Key(flat=flat)
+
+def entity_to_record(kind, entity):
+    """Return the backup record of the passed entity"""
+    return { "kind" : kind, "key" : _logical_flat(entity.key), "properties" : _encode_properties(entity) }
+
+def deletion_record(kind, key):
+    """Return the backup record of the deletion of the entity with the passed key"""
+    return { "kind" : kind, "deleted" : _logical_flat(key) }
+
+def record_to_entity(record, registries={}):
+    """Return the (unsaved) entity described by the passed backup record, moved into
+       the registries to which 'registries' maps the registries in the backup"""
+    kind = _kinds.get(record.get("kind"))
+
+    if kind is None:
+        raise BackupError("Cannot restore a record of unknown kind '%s'" % record.get("kind"),
+                          detail=record.get("kind"))
+
+    entity = _decode_properties(kind.CLASS, record["properties"])
+    entity.key = _move_key(record["key"], registries)
+
+    return entity
+
+def _iter_pages(query, keys_only=False):
+    """Return a generator of the pages of the results of 'query'"""
+    cursor = None
+
+    while True:
+        # the entities are not added to the context cache, as that would keep every page in memory
+        (items, cursor, more) = query.fetch_page(BACKUP_PAGE_SIZE, start_cursor=cursor, keys_only=keys_only,
+                                                 use_cache=False, use_memcache=False)
+
+        if items:
+            yield items
+
+        if not (more and cursor):
+            break
+
+def _iter_entities(query):
+    """Return a generator of all of the results of 'query', read a page at a time"""
+    for items in _iter_pages(query):
+        for item in items:
+            yield item
+
+def _registry_root(kind, registries):
+    """Return the root key of the entities of 'kind' in the registry to which 'registries'
+       maps its registry, or its current root key if its registry is not in 'registries'"""
+    root = kind.ancestor()
+
+    if root and kind.registry() in registries:
+        root = ndb.Key(root.kind(), registries[kind.registry()])
+
+    return root
+
+def _iter_deletions(kinds, since, registries={}):
+    """Return a generator of the (kind, key) of the entities of the passed kinds that were
+       deleted after 'since', and that have not been saved again since. The deletions are
+       read from the registries to which 'registries' maps each registry (default the
+       registries in use)"""
+    names = set(kinds)
+    roots = set( [_registry_root(_kinds[kind], registries) for kind in kinds if _kinds[kind].ancestor()] )
+
+    for root in roots:
+        query = _db.Tombstone.query(ancestor=root).filter(_db.Tombstone.deleted > since)
+
+        for tombstones in _iter_pages(query):
+            tombstones = [ tombstone for tombstone in tombstones if tombstone.deleted_kind in names ]
+            keys = [ tombstone.deleted_key for tombstone in tombstones ]
+            existing = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+
+            for (tombstone, entity) in zip(tombstones, existing):
+                if entity is None:
+                    yield (tombstone.deleted_kind, tombstone.deleted_key)
+
+def _to_line(data):
+    return json.dumps(data, sort_keys=True, separators=(",",":")) + "\n"
+
+def _iter_lines(kinds, since=None):
+    """Return a generator of the lines of the backup of the passed kinds, only including the
+       changes after 'since' if this is passed. The watermark of the backup is saved once
+       the last line has been generated, if every kind was backed up"""
+    checksum = hashlib.sha1()
+    counts = {}
+    num_deleted = 0
+
+    now_time = get_now_time()
+    watermark = now_time - WATERMARK_MARGIN
+
+    line = _to_line( { "format" : BACKUP_FORMAT, "schema_version" : SCHEMA_VERSION,
+                       "created" : _time_to_string(now_time), "kinds" : kinds,
+                       "since" : _time_to_string(since), "watermark" : _time_to_string(watermark) } )
+    checksum.update(line)
+    yield line
+
+    # the keys of the changed entities whose untracked children must also be backed up
+    changed_parents = {}
+
+    for name in kinds:
+        kind = _kinds[name]
+        counts[name] = 0
+
+        if since and kind.parent_kind:
+            queries = [ kind.query(ancestor=parent) for parent in changed_parents.get(kind.parent_kind, []) ]
+        else:
+            queries = [ kind.query(since) ]
+
+        for query in queries:
+            for entity in _iter_entities(query):
+                line = _to_line( entity_to_record(name, entity) )
+                checksum.update(line)
+                counts[name] += 1
+                yield line
+
+                if since and name in _child_kinds:
+                    changed_parents.setdefault(name, []).append(entity.key)
+
+    if since:
+        for (name, key) in _iter_deletions(kinds, since):
+            line = _to_line( deletion_record(name, key) )
+            checksum.update(line)
+            num_deleted += 1
+            yield line
+
+    num_records = sum(counts.values()) + num_deleted
+
+    yield _to_line( { "trailer" : True, "records" : num_records, "counts" : counts,
+                      "deleted" : num_deleted, "sha1" : checksum.hexdigest() } )
+
+    if set(kinds) == set(backup_kinds()):
+        BackupState(key=_state_key(), watermark=watermark, last_backup=now_time,
+                    was_incremental=(since is not None)).put()
+
+def stream_backup(account, kinds=None, since=None):
+    """Return a generator of the compressed chunks of a backup of the passed kinds (default
+       all kinds). If 'since' is passed then this is an incremental backup of the changes
+       made after 'since'. The chunks can be written to the response as they are generated"""
+    assert_is_admin(account, "Only administrator accounts can backup and restore the database.")
+
+    if kinds is None:
+        kinds = backup_kinds()
+
+    for kind in kinds:
+        if not kind in _kinds:
+            raise BackupError("There is no database called '%s' that can be backed up" % kind, detail=kind)
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buf = []
+    size = 0
+    member_size = 0
+
+    for line in _iter_lines(kinds, since):
+        data = compressor.compress(line)
+        member_size += len(line)
+
+        if member_size >= MEMBER_SIZE:
+            # end the gzip member after this line. Concatenated members are a valid gzip file
+            data += compressor.flush()
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            member_size = 0
+
+        if data:
+            buf.append(data)
+            size += len(data)
+
+            if size >= CHUNK_SIZE:
+                yield "".join(buf)
+                buf = []
+                size = 0
+
+    buf.append(compressor.flush())
+    yield "".join(buf)
+
+def _iter_member_lines(fileobj, position=0):
+    """Return a generator of the (position, line) of the uncompressed lines of the passed
+       backup file object, which has been read up to byte 'position', at which a gzip
+       member starts. 'position' in each result is the start of the last member that
+       started at the start of a line, so reading can start again from there"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    offset = position
+    rest = ""
+
+    while True:
+        block = fileobj.read(READ_SIZE)
+
+        if not block:
+            break
+
+        offset += len(block)
+        data = decompressor.decompress(block)
+
+        while decompressor.unused_data:
+            # the file is made from several gzip members. Finish the lines of the
+            # member that has ended before starting the next
+            unused = decompressor.unused_data
+            lines = (rest + data + decompressor.flush()).split("\n")
+            rest = lines.pop()
+
+            for line in lines:
+                yield (position, line + "\n")
+
+            if not rest:
+                position = offset - len(unused)
+
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = decompressor.decompress(unused)
+
+        lines = (rest + data).split("\n")
+        rest = lines.pop()
+
+        for line in lines:
+            yield (position, line + "\n")
+
+    rest += decompressor.flush()
+
+    if rest:
+        yield (position, rest)
+
+def _iter_file_lines(fileobj):
+    """Return a generator of the uncompressed lines of the passed backup file object"""
+    for (position, line) in _iter_member_lines(fileobj):
+        yield line
+
+def read_backup(fileobj):
+    """Return a generator of the records in the passed backup file object. The header is
+       checked first, and the checksum in the trailer is checked once every record has
+       been read, raising BackupError if the file is incomplete or has been changed.
+       As records are returned before the checksum is checked, call verify_backup first
+       to check a file before restoring from it"""
+    checksum = hashlib.sha1()
+    header = None
+    trailer = None
+    num_records = 0
+
+    try:
+        for line in _iter_file_lines(fileobj):
+            if trailer is not None:
+                raise BackupError("The backup file has data after its trailer")
+
+            data = json.loads(line)
+
+            if not isinstance(data, dict):
+                raise BackupError("The backup file is corrupted")
+
+            if header is None:
+                header = data
+
+                if header.get("format") != BACKUP_FORMAT:
+                    raise BackupError("This is not a backup file")
+
+                if header.get("schema_version") > SCHEMA_VERSION:
+                    raise BackupError("The backup file has schema version %s, which is newer than this "
+                                      "application can read (%d)" % (header.get("schema_version"), SCHEMA_VERSION),
+                                      detail=header.get("schema_version"))
+
+                checksum.update(line)
+
+            elif data.get("trailer"):
+                trailer = data
+
+            else:
+                checksum.update(line)
+                num_records += 1
+                yield data
+
+    except (ValueError, zlib.error) as e:
+        raise BackupError("The backup file is corrupted", detail=e)
+
+    if trailer is None:
+        raise BackupError("The backup file is incomplete, as it has no trailer")
+
+    if trailer.get("records") != num_records or trailer.get("sha1") != checksum.hexdigest():
+        raise BackupError("The checksum of the backup file does not match. The file has been corrupted.",
+                          detail=(trailer.get("sha1"), checksum.hexdigest()))
+
+def read_legacy_backup(data):
+    """Return the dictionary of the backup of each database held in the passed backup
+       of every database written by earlier versions. These were pickled, so are read
+       without allowing any objects to be created, as a changed file could run code"""
+    try:
+        backups = _codec.safe_unpickle(data)
+    except _codec.CodecError as e:
+        raise BackupError("This is not a backup file", detail=e)
+
+    if not isinstance(backups, dict):
+        raise BackupError("This is not a backup file")
+
+    return backups
+
+def read_header(fileobj):
+    """Return the header of the passed backup file object, leaving the file at its start"""
+    try:
+        for line in _iter_file_lines(fileobj):
+            header = json.loads(line)
+            break
+        else:
+            header = None
+    except (ValueError, zlib.error) as e:
+        raise BackupError("The backup file is corrupted", detail=e)
+
+    fileobj.seek(0)
+
+    if not header or header.get("format") != BACKUP_FORMAT:
+        raise BackupError("This is not a backup file")
+
+    return header
+
+def _check_record(record):
+    """Raise BackupError if the passed record cannot be restored"""
+    try:
+        if "deleted" in record:
+            if not record.get("kind") in _kinds:
+                raise BackupError("Cannot restore a record of unknown kind '%s'" % record.get("kind"),
+                                  detail=record.get("kind"))
+
+            ndb.Key(flat=record["deleted"])
+        else:
+            record_to_entity(record)
+    except BackupError:
+        raise
+    except Exception as e:
+        raise BackupError("The backup file holds a record of '%s' that cannot be restored" % record.get("kind"),
+                          detail=e)
+
+def verify_backup(fileobj):
+    """Check the passed backup file object, returning the number of records of each kind
+       in the file. Raises BackupError if the file is incomplete or has been changed,
+       or if any of its records cannot be restored"""
+    counts = {}
+
+    for record in read_backup(fileobj):
+        _check_record(record)
+        counts[record.get("kind")] = counts.get(record.get("kind"), 0) + 1
+
+    fileobj.seek(0)
+
+    return counts
+
+class RestoreJob(ndb.Model):
+    """A restore running in the background. 'phase' is the step that the job has
+       reached, and 'line' is the number of lines of the file that have been restored
+       in the current step, so that a job that stops can resume where it stopped"""
+    filename = ndb.StringProperty(indexed=False)
+    email = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(indexed=True, auto_now_add=True)
+    updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    phase = ndb.StringProperty(indexed=False, default="upload")
+    error = ndb.TextProperty()
+
+    kinds = ndb.JsonProperty()
+    is_incremental = ndb.BooleanProperty(indexed=False, default=False)
+    num_chunks = ndb.IntegerProperty(indexed=False, default=0)
+    size = ndb.IntegerProperty(indexed=False, default=0)
+
+    # the shadow registry into which each restored registry is written, and the
+    # registries that held the data before the switch
+    registries = ndb.JsonProperty()
+    previous = ndb.JsonProperty()
+    flipped = ndb.DateTimeProperty(indexed=False)
+    set_maintenance = ndb.BooleanProperty(indexed=False, default=False)
+
+    # the changes to the copied kinds made after 'caught_up' have not yet been
+    # copied into the shadow registries. 'catch_up_start' is the start of the
+    # copy of the changes that is running
+    caught_up = ndb.DateTimeProperty(indexed=False)
+    catch_up_start = ndb.DateTimeProperty(indexed=False)
+
+    # the position reached in the current phase
+    kind_index = ndb.IntegerProperty(indexed=False, default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    line = ndb.IntegerProperty(indexed=False, default=0)
+
+    # the byte position in the file of the gzip member holding line 'line', and the
+    # number of the first line of that member, from which the file is read again
+    position = ndb.IntegerProperty(indexed=False, default=0)
+    position_line = ndb.IntegerProperty(indexed=False, default=0)
+
+    counts = ndb.JsonProperty()
+    num_copied = ndb.IntegerProperty(indexed=False, default=0)
+    num_deleted = ndb.IntegerProperty(indexed=False, default=0)
+
+    def jobID(self):
+        return self.key.id()
+
+    def isFinished(self):
+        return self.phase in ("done", "failed", "discarded")
+
+    def isRunning(self):
+        """Return whether this job is restoring, so that no other restore can start"""
+        return self.phase in ("verify", "copy", "write", "catchup", "flip", "direct", "settle")
+
+    def canDiscard(self):
+        """Return whether the data replaced by this job (or, if it failed, the data it
+           had partly restored) can be deleted"""
+        return self.phase in ("done", "failed") and bool(self.registries)
+
+    def numRestored(self):
+        return sum((self.counts or {}).values())
+
+class RestoreChunk(ndb.Model):
+    """One chunk of the uploaded file of a restore job. Chunks are root entities
+       so that saving them does not contend on one entity group"""
+    data = ndb.BlobProperty()
+
+def _chunk_key(job_id, index):
+    return ndb.Key(RestoreChunk, "%s|%d" % (job_id, index))
+
+class _ChunkReader(object):
+    """A file object reading the uploaded file of a restore job, one chunk at a time.
+       Every chunk but the last holds RESTORE_CHUNK_SIZE bytes, so the reader can
+       seek to any position by reading only the chunk that holds it"""
+    def __init__(self, job):
+        self._job = job
+        self.seek(0)
+
+    def seek(self, position):
+        self._index = position // RESTORE_CHUNK_SIZE
+        self._skip = position % RESTORE_CHUNK_SIZE
+        self._data = ""
+
+    def read(self, size):
+        while not self._data and self._index < self._job.num_chunks:
+            chunk = _chunk_key(self._job.jobID(), self._index).get(use_cache=False, use_memcache=False)
+
+            if chunk is None:
+                raise BackupError("Part of the uploaded backup file is missing")
+
+            self._data = chunk.data[self._skip:]
+            self._skip = 0
+            self._index += 1
+
+        (data, self._data) = (self._data[0:size], self._data[size:])
+
+        return data
+
+def list_restore_jobs(limit=10):
+    """Return the most recent restore jobs"""
+    return RestoreJob.query().order(-RestoreJob.created).fetch(limit)
+
+def get_restore_job(job_id):
+    """Return the restore job with ID 'job_id', or None if there is no such job"""
+    try:
+        return ndb.Key(RestoreJob, int(job_id)).get(use_cache=False, use_memcache=False)
+    except (TypeError, ValueError):
+        return None
+
+def queue_restore(job, countdown=None):
+    """Queue the next run of the passed restore job"""
+    taskqueue.add(url=RESTORE_TASK_PATH, params={"job" : job.jobID()}, countdown=countdown)
+
+def start_restore(account, fileobj, kinds=None, filename=None):
+    """Start restoring the passed kinds (default every kind in the file) from the passed
+       backup file object in the background. The file is saved in chunks, and is verified
+       by the job before anything is changed. Returns the RestoreJob"""
+    assert_is_admin(account, "Only administrator accounts can backup and restore the database.")
+
+    read_header(fileobj)
+
+    for kind in (kinds or []):
+        if not kind in _kinds:
+            raise BackupError("There is no database called '%s' that can be restored" % kind, detail=kind)
+
+    for job in list_restore_jobs():
+        if job.isRunning():
+            raise BackupError("Another restore is already running. Wait until it has finished.")
+
+    job = RestoreJob(filename=filename, email=account.email, kinds=kinds)
+    job.put()
+
+    while True:
+        data = fileobj.read(RESTORE_CHUNK_SIZE)
+
+        if not data:
+            break
+
+        RestoreChunk(key=_chunk_key(job.jobID(), job.num_chunks), data=data).put(use_cache=False, use_memcache=False)
+        job.num_chunks += 1
+        job.size += len(data)
+
+    job.phase = "verify"
+    job.put()
+
+    queue_restore(job)
+
+    return job
+
+def _restored_kinds(job, shadowed):
+    """Return the kinds of the job that are written into the shadow registries
+       (if 'shadowed') or that are root entities written in place"""
+    return [ kind.name for kind in BACKUP_KINDS if kind.name in job.kinds and (kind.registry() is not None) == shadowed ]
+
+def _copied_kinds(job):
+    """Return the kinds that are copied from the current registries into the shadow
+       registries before the file is restored. These are the kinds that share a registry
+       with a restored kind, and, for an incremental backup, the restored kinds too"""
+    return [ kind.name for kind in BACKUP_KINDS if kind.registry() in job.registries and
+                                                   (job.is_incremental or not kind.name in job.kinds) ]
+
+def _verify(job, deadline):
+    """Check the uploaded file, and choose the shadow registries to restore into"""
+    reader = _ChunkReader(job)
+    header = read_header(reader)
+    counts = verify_backup(reader)
+    requested = bool(job.kinds)
+
+    if not requested:
+        job.kinds = header.get("kinds", [])
+
+    job.is_incremental = header.get("since") is not None
+
+    for kind in job.kinds:
+        if not kind in _kinds:
+            raise BackupError("There is no database called '%s' that can be restored" % kind, detail=kind)
+
+        # restoring a kind replaces all of its data, so the file must really hold it
+        if not kind in header.get("kinds", []):
+            raise BackupError("The backup file does not contain the database '%s'" % kind, detail=kind)
+
+        # a database that is empty in a backup of every database is restored as empty,
+        # but a single database is only replaced by a file that holds some of its data
+        if requested and not (job.is_incremental or counts.get(kind)):
+            raise BackupError("The backup file has no records of the database '%s', so restoring "
+                              "it would delete all of its data" % kind, detail=kind)
+    job.registries = {}
+    job.previous = {}
+    job.counts = {}
+
+    for name in _restored_kinds(job, True):
+        registry = _kinds[name].registry()
+        job.registries[registry] = "%s@%s" % (registry, job.jobID())
+
+    # no user can change anything while the registries are copied and switched
+    if not admin.under_maintenance():
+        job.set_maintenance = True
+        job.put()
+        admin.set_maintenance_state(True)
+
+    # tasks and cron jobs still run, so their changes from now on are copied later
+    job.caught_up = get_now_time() - WATERMARK_MARGIN
+    job.phase = "copy"
+    job.put()
+
+def _copy(job, deadline):
+    """Copy the entities that are not replaced by the backup into the shadow registries"""
+    kinds = _copied_kinds(job)
+
+    while job.kind_index < len(kinds):
+        query = _kinds[kinds[job.kind_index]].query()
+        cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+
+        (items, cursor, more) = query.fetch_page(BACKUP_PAGE_SIZE, start_cursor=cursor,
+                                                 use_cache=False, use_memcache=False)
+
+        for item in items:
+            item.key = _move_key(item.key.flat(), job.registries)
+
+        ndb.put_multi(items, use_cache=False, use_memcache=False)
+        job.num_copied += len(items)
+
+        if more and cursor:
+            job.cursor = cursor.urlsafe()
+        else:
+            job.kind_index += 1
+            job.cursor = None
+
+        job.put()
+
+        if time.time() > deadline:
+            return 0
+
+    job.kind_index = 0
+    job.phase = "write"
+    job.put()
+
+def _flush(job, batch, deleted):
+    if batch:
+        ndb.put_multi(batch, use_cache=False, use_memcache=False)
+
+    if deleted:
+        _db.delete_tracked(deleted)
+        job.num_deleted += len(deleted)
+
+def _restore_lines(job, deadline, shadowed):
+    """Restore the records of the file for the kinds written into the shadow registries
+       (if 'shadowed') or for the root kinds, starting from line 'job.line'. The lines
+       before that were restored by an earlier run. A resumed run starts reading at
+       the gzip member holding that line, so only the lines of that member are read
+       again (files written before backups were split into members are read again
+       from their start). Returns whether every line has been restored"""
+    kinds = set(_restored_kinds(job, shadowed))
+
+    if not kinds:
+        return True
+
+    batch = []
+    deleted = []
+
+    reader = _ChunkReader(job)
+    reader.seek(job.position)
+
+    n = job.position_line
+    member = (job.position, job.position_line)
+
+    for (position, line) in _iter_member_lines(reader, job.position):
+        if position != member[0]:
+            member = (position, n)
+
+        n += 1
+
+        if n <= job.line:
+            continue
+
+        record = json.loads(line)
+        name = record.get("kind")
+
+        if name in kinds:
+            if "deleted" in record:
+                key = _move_key(record["deleted"], job.registries)
+                deleted.append(key)
+
+                # the untracked children are deleted with their parent
+                for child in _child_kinds.get(name, []):
+                    deleted += child.query(ancestor=key).fetch(keys_only=True)
+            else:
+                batch.append( record_to_entity(record, job.registries) )
+                job.counts[name] = job.counts.get(name, 0) + 1
+
+        if len(batch) + len(deleted) >= BACKUP_PAGE_SIZE:
+            _flush(job, batch, deleted)
+            batch = []
+            deleted = []
+
+            job.line = n
+            (job.position, job.position_line) = member
+            job.put()
+
+            if time.time() > deadline:
+                return False
+
+    _flush(job, batch, deleted)
+
+    return True
+
+def _write(job, deadline):
+    """Write the records of the file into the shadow registries"""
+    if not _restore_lines(job, deadline, True):
+        return 0
+
+    job.line = 0
+    job.position = 0
+    job.position_line = 0
+    job.phase = "catchup"
+    job.put()
+
+def _copy_changes(job, deadline, sources):
+    """Copy the changes made to the copied kinds after 'job.caught_up' from the registries
+       to which 'sources' maps each restored registry into the shadow registries. The
+       kinds replaced by a full backup are not copied, as the backup replaces any change
+       made to them, just as it would had the change been made before the restore.
+       Returns whether every change has been copied"""
+    kinds = [ name for name in _copied_kinds(job) if _kinds[name].registry() in sources ]
+
+    if job.catch_up_start is None:
+        job.catch_up_start = get_now_time() - WATERMARK_MARGIN
+        job.put()
+
+    while job.kind_index < len(kinds):
+        kind = _kinds[kinds[job.kind_index]]
+        root = _registry_root(kind, sources)
+        cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+
+        if kind.parent_kind:
+            # the untracked children are copied with each changed parent
+            query = _kinds[kind.parent_kind].query(job.caught_up, ancestor=root)
+            (parents, cursor, more) = query.fetch_page(BACKUP_PAGE_SIZE, start_cursor=cursor, keys_only=True,
+                                                       use_cache=False, use_memcache=False)
+            items = []
+
+            for parent in parents:
+                items += kind.query(ancestor=parent).fetch(use_cache=False, use_memcache=False)
+        else:
+            query = kind.query(job.caught_up, ancestor=root)
+            (items, cursor, more) = query.fetch_page(BACKUP_PAGE_SIZE, start_cursor=cursor,
+                                                     use_cache=False, use_memcache=False)
+
+        for item in items:
+            item.key = _move_key(item.key.flat(), job.registries)
+
+        ndb.put_multi(items, use_cache=False, use_memcache=False)
+        job.num_copied += len(items)
+
+        if more and cursor:
+            job.cursor = cursor.urlsafe()
+        else:
+            job.kind_index += 1
+            job.cursor = None
+
+        job.put()
+
+        if time.time() > deadline:
+            return False
+
+    # there are few deletions, and deleting again does no harm, so these are not resumed
+    deleted = []
+
+    for (name, key) in _iter_deletions(kinds, job.caught_up, sources):
+        key = _move_key(key.flat(), job.registries)
+        deleted.append(key)
+
+        for child in _child_kinds.get(name, []):
+            deleted += child.query(ancestor=key).fetch(keys_only=True)
+
+        if len(deleted) >= BACKUP_PAGE_SIZE:
+            _flush(job, [], deleted)
+            deleted = []
+
+    _flush(job, [], deleted)
+
+    job.caught_up = job.catch_up_start
+    job.catch_up_start = None
+    job.kind_index = 0
+    job.put()
+
+    return True
+
+def _catch_up(job, deadline):
+    """Copy the changes made by tasks and cron jobs while the registries were copied
+       and the file was written into the shadow registries"""
+    current = dict( [(registry, _db.registry(registry)) for registry in job.registries.keys()] )
+
+    if not _copy_changes(job, deadline, current):
+        return 0
+
+    job.phase = "flip"
+    job.put()
+
+def _flip(job, deadline):
+    """Switch the restored registries to the shadow registries"""
+    previous = _db.set_registry_aliases(job.registries)
+
+    for (registry, physical) in previous.items():
+        # if this is run again the registries already point to the shadow registries
+        if physical != job.registries[registry]:
+            job.previous[registry] = physical
+
+    job.flipped = get_now_time()
+    job.phase = "direct"
+    job.put()
+
+def _direct(job, deadline):
+    """Restore the root kinds, which are not held in a registry, in place"""
+    if job.line == 0 and not job.is_incremental:
+        for name in _restored_kinds(job, False):
+            for keys in _iter_pages(_kinds[name].query(), keys_only=True):
+                _db.delete_tracked(keys)
+
+    if not _restore_lines(job, deadline, False):
+        return 0
+
+    job.line = 0
+    job.position = 0
+    job.position_line = 0
+    job.phase = "settle"
+    job.put()
+
+def _end_maintenance(job):
+    if job.set_maintenance:
+        admin.set_maintenance_state(False)
+        job.set_maintenance = False
+
+def _delete_chunks(job):
+    ndb.delete_multi( [_chunk_key(job.jobID(), i) for i in range(0, job.num_chunks)] )
+
+def _settle(job, deadline):
+    """Wait until every instance is using the new registries, then finish the job"""
+    waited = (get_now_time() - job.flipped).total_seconds()
+
+    if waited < _db.ALIAS_REFRESH_TIME:
+        return int(_db.ALIAS_REFRESH_TIME - waited) + 1
+
+    # copy the last changes made to the old registries before every instance switched
+    if not _copy_changes(job, deadline, job.previous or {}):
+        return 0
+
+    # remove anything cached from the old data while the instances were switching
+    memcache.flush_all()
+
+    _end_maintenance(job)
+    _delete_chunks(job)
+
+    taskqueue.add(url=RECONCILE_TASK_PATH)
+
+    job.finished = get_now_time()
+    job.phase = "done"
+    job.put()
+
+def _discard_registries(job):
+    """Return the registries whose data is deleted when the job is discarded. These hold
+       the replaced data once the job has switched the registries, or else the partly
+       restored data. A registry that is in use is never discarded"""
+    if job.flipped:
+        registries = job.previous or {}
+    else:
+        registries = job.registries or {}
+
+    return dict( [(name, physical) for (name, physical) in registries.items()
+                                   if _db.registry(name) != physical] )
+
+def _discard(job, deadline):
+    """Delete all of the data in the discarded registries"""
+    registries = _discard_registries(job)
+    roots = set()
+
+    for kind in BACKUP_KINDS:
+        if kind.registry() in registries:
+            roots.add( _registry_root(kind, registries) )
+
+    roots = sorted(roots, key=lambda root: root.flat())
+    ctx = ndb.get_context()
+
+    while job.kind_index < len(roots):
+        # the deleted data is not used, so no tombstones are written
+        keys = ndb.Query(ancestor=roots[job.kind_index]).fetch(BACKUP_PAGE_SIZE, keys_only=True)
+
+        if keys:
+            ndb.Future.wait_all( [ctx.delete(key) for key in keys] )
+        else:
+            job.kind_index += 1
+            job.put()
+
+        if time.time() > deadline:
+            return 0
+
+    job.kind_index = 0
+    job.phase = "discarded"
+    job.put()
+
+_PHASES = { "verify" : _verify, "copy" : _copy, "write" : _write, "catchup" : _catch_up, "flip" : _flip,
+            "direct" : _direct, "settle" : _settle, "discard" : _discard }
+
+def discard_restore(account, job_id):
+    """Start deleting the data that was replaced by the passed finished restore job (or,
+       if the job failed, the data that it partly restored) in the background"""
+    assert_is_admin(account, "Only administrator accounts can backup and restore the database.")
+
+    job = get_restore_job(job_id)
+
+    if not (job and job.canDiscard()):
+        raise BackupError("There is no finished restore job '%s' whose data can be discarded" % job_id,
+                          detail=job_id)
+
+    job.kind_index = 0
+    job.phase = "discard"
+    job.put()
+
+    queue_restore(job)
+
+def run_restore(job_id):
+    """Run the passed restore job for up to RESTORE_TASK_TIME seconds, queueing the next
+       run if it has not finished. A run that stops early (e.g. because the task is
+       retried) resumes from the last saved position. Returns the RestoreJob"""
+    job = get_restore_job(job_id)
+
+    if job is None or job.isFinished() or not job.phase in _PHASES:
+        return job
+
+    deadline = time.time() + RESTORE_TASK_TIME
+    countdown = None
+
+    try:
+        while not (job.isFinished() or countdown is not None):
+            countdown = _PHASES[job.phase](job, deadline)
+
+            if countdown is None and time.time() > deadline:
+                countdown = 0
+
+    except _TRANSIENT_ERRORS:
+        raise
+
+    except Exception as e:
+        if not isinstance(e, BackupError):
+            e = BackupError("The restore stopped because of an unexpected error: %s" % e, detail=e)
+
+        # the registries are only switched once everything has been written,
+        # so the current data is unchanged. Retrying would fail again, and
+        # would keep the website in maintenance mode
+        job.error = e.errorMessage()
+        job.phase = "failed"
+        job.finished = get_now_time()
+        _end_maintenance(job)
+        _delete_chunks(job)
+        job.put()
+
+        return job
+
+    if not job.isFinished():
+        queue_restore(job, countdown)
+
+    return job
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the billing engine, which charges projects for their use of
+   the equipment. A batch job scans the confirmed bookings of a month once, rounding
+   each booking up to the booking unit of its equipment, and saves the totals as
+   usage rollups (one per project and piece of equipment). Invoices are computed
+   from the rollups and the hourly rates, and are saved as immutable, versioned
+   snapshots. A new version is only saved if something has changed, so the job
+   can be run again (or retried) as often as needed, and the billing pages only
+   ever read the saved rollups and invoices"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+
+import datetime
+import hashlib
+import json
+
+from bsb import *
+
+import _db
+import equipment
+import projects
+
+# The default registry of the rates, rollups and invoices
+DEFAULT_BILLING_REGISTRY = "bsb.billing.billing"
+
+# The number of bookings read from the datastore in each page
+BILLING_PAGE_SIZE = 500
+
+# The number of pages scanned by each run of the billing task
+PAGES_PER_TASK = 20
+
+# The path of the task that runs the billing job
+BILLING_TASK_PATH = "/tasks/run_billing"
+
+# The rate of VAT charged to projects that are not VAT exempt
+VAT_RATE = 0.2
+
+# The ID used for the bookings that are not charged to a project
+NO_PROJECT = "no_project"
+
+# The billable minutes of one of each booking unit. Half-day, day and week bookings
+# give access for 9am-1pm or 2pm-6pm, 9am-6pm and Monday-Friday 9am-6pm respectively,
+# so these are charged for the hours of access, not the elapsed time
+UNIT_MINUTES = { "minute" : 1,
+                 "hour" : 60,
+                 "half-day" : 4 * 60,
+                 "day" : 9 * 60,
+                 "week" : 5 * 9 * 60 }
+
+# The local times of the half-day slots
+HALF_DAY_SLOTS = [ (9, 13), (14, 18) ]
+
+class BillingError(SchedulerError):
+    pass
+
+def billing_key(registry=DEFAULT_BILLING_REGISTRY):
+    """Construct the Datastore key for the billing data"""
+    return ndb.Key("Billing", _db.registry(registry))
+
+def period_string(t):
+    """Return the billing period (month) containing the date 't', e.g. '2016-05'"""
+    return t.strftime("%Y-%m")
+
+def period_range(period):
+    """Return the (start, end) of the passed billing period as local dates"""
+    try:
+        start = datetime.datetime.strptime(period, "%Y-%m")
+    except (TypeError, ValueError):
+        raise BillingError("'%s' is not a valid billing period. This should be a month, e.g. '2016-05'" % period,
+                           detail=period)
+
+    if start.month == 12:
+        end = datetime.datetime(start.year+1, 1, 1)
+    else:
+        end = datetime.datetime(start.year, start.month+1, 1)
+
+    return (start, end)
+
+def previous_period(t=None):
+    """Return the billing period before the one containing the local date 't' (or now)"""
+    if t is None:
+        t = get_local_now_time()
+
+    return period_string( datetime.datetime(t.year, t.month, 1) - datetime.timedelta(days=1) )
+
+def format_pence(pence):
+    """Return the passed amount of pence as a human-readable string of pounds"""
+    return u"£%.2f" % (pence / 100.0)
+
+class BillingRate(_db.TrackedModel):
+    """The hourly rate charged for a piece of equipment or for a type of equipment.
+       The key is 'equipment_<idstring>' or 'type_<idstring>'"""
+    hourly_rate = ndb.IntegerProperty(indexed=False)
+    changed_by = ndb.StringProperty(indexed=False)
+    changed = ndb.DateTimeProperty(indexed=False, auto_now=True)
+
+    @classmethod
+    def getQuery(cls, registry=DEFAULT_BILLING_REGISTRY):
+        return cls.query(ancestor=billing_key(registry))
+
+    @classmethod
+    def ancestor(cls, registry=DEFAULT_BILLING_REGISTRY):
+        return billing_key(registry)
+
+class BillingRun(_db.TrackedModel):
+    """The state of the billing job for one period. The key is the period. While the
+       bookings are being scanned the running totals are held here together with the
+       cursor, so that the scan can be resumed by the next run of the task"""
+    cursor = ndb.StringProperty(indexed=False)
+    totals = ndb.JsonProperty(indexed=False)
+    num_bookings = ndb.IntegerProperty(indexed=False, default=0)
+
+    is_scanning = ndb.BooleanProperty(indexed=False, default=False)
+    scanned = ndb.DateTimeProperty(indexed=False)
+    invoiced = ndb.DateTimeProperty(indexed=False)
+
+    # the latest invoice version of each project
+    invoices = ndb.JsonProperty(indexed=False)
+
+    def period(self):
+        return self.key.id()
+
+    def latestVersion(self, project):
+        return (self.invoices or {}).get(project, 0)
+
+    @classmethod
+    def getQuery(cls, registry=DEFAULT_BILLING_REGISTRY):
+        return cls.query(ancestor=billing_key(registry))
+
+    @classmethod
+    def ancestor(cls, registry=DEFAULT_BILLING_REGISTRY):
+        return billing_key(registry)
+
+class UsageRollup(_db.TrackedModel):
+    """The total use of one piece of equipment by one project in a billing period.
+       This is a child of the BillingRun, with key '<project>|<equipment>'"""
+    project = ndb.StringProperty(indexed=False)
+    equipment = ndb.StringProperty(indexed=False)
+    booking_unit = ndb.IntegerProperty(indexed=False)
+    num_bookings = ndb.IntegerProperty(indexed=False)
+    units = ndb.IntegerProperty(indexed=False)
+    minutes = ndb.IntegerProperty(indexed=False)
+    billable_minutes = ndb.IntegerProperty(indexed=False)
+
+class Invoice(_db.TrackedModel):
+    """A snapshot of the invoice of a project for a billing period. This is a child of
+       the BillingRun with key '<project>|<version>', and is never changed once saved"""
+    project = ndb.StringProperty(indexed=False)
+    project_name = ndb.StringProperty(indexed=False)
+    version = ndb.IntegerProperty(indexed=False)
+    created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    bsb_project = ndb.BooleanProperty(indexed=False, default=False)
+    vat_exempt = ndb.BooleanProperty(indexed=False, default=False)
+
+    # the fingerprint of the lines and totals, used to see if anything has changed
+    fingerprint = ndb.StringProperty(indexed=False)
+
+    # a list of dictionaries, one per piece of equipment
+    lines = ndb.JsonProperty(indexed=False)
+
+    subtotal = ndb.IntegerProperty(indexed=False)
+    vat = ndb.IntegerProperty(indexed=False)
+    total = ndb.IntegerProperty(indexed=False)
+
+    def period(self):
+        return self.key.parent().id()
+
+    def missingRates(self):
+        """Return the names of the equipment on this invoice that have no rate"""
+        return [ line["name"] for line in self.lines if line["rate"] is None ]
+
+def _rate_id(equipment_idstring=None, type_idstring=None):
+    if equipment_idstring:
+        return "equipment_%s" % equipment_idstring
+    else:
+        return "type_%s" % type_idstring
+
+def get_rates(registry=DEFAULT_BILLING_REGISTRY):
+    """Return the dictionary of all hourly rates (in pence), indexed by rate ID"""
+    rates = {}
+
+    for rate in BillingRate.getQuery(registry).fetch():
+        rates[rate.key.id()] = rate.hourly_rate
+
+    return rates
+
+def set_rate(account, hourly_rate, equipment_idstring=None, type_idstring=None,
+             registry=DEFAULT_BILLING_REGISTRY):
+    """Set the hourly rate (in pence) charged for the passed piece of equipment or type
+       of equipment. A rate of None removes the rate. Rates on equipment override the
+       rate on its type. Invoices are not changed until the billing job is run again"""
+    assert_is_admin(account, "Only administrators can set the billing rates")
+
+    if not (equipment_idstring or type_idstring):
+        raise BillingError("You must specify the equipment or type of equipment to be charged")
+
+    key = ndb.Key(BillingRate, _rate_id(equipment_idstring, type_idstring), parent=billing_key(registry))
+
+    if hourly_rate is None:
+        key.delete()
+        return
+
+    if hourly_rate < 0:
+        raise BillingError("The hourly rate cannot be negative", detail=hourly_rate)
+
+    BillingRate(key=key, hourly_rate=int(hourly_rate), changed_by=account.email).put()
+
+def find_rate(rates, equipment_idstring, type_idstring):
+    """Return the hourly rate (in pence) charged for the passed equipment, or None if
+       neither the equipment nor its type has a rate"""
+    rate = rates.get(_rate_id(equipment_idstring))
+
+    if rate is None and type_idstring:
+        rate = rates.get(_rate_id(type_idstring=type_idstring))
+
+    return rate
+
+def _local_days(start, end):
+    """Return the local dates of each day touched by the local interval 'start' to 'end'"""
+    day = start.date()
+    last = (end - datetime.timedelta(minutes=1)).date()
+
+    while day <= last:
+        yield day
+        day += datetime.timedelta(days=1)
+
+def count_units(start_time, end_time, constraints):
+    """Return the number of booking units of 'constraints' (a BookingConstraintInfo)
+       used by a booking from 'start_time' to 'end_time' (UTC). Time units are rounded
+       up, while half-day, day and week bookings count the slots that they touch"""
+    minutes = int( (end_time - start_time).total_seconds() + 59 ) // 60
+
+    if minutes <= 0:
+        return 0
+
+    unit = equipment.BookingConstraint.bookableUnitTypeByIndex(constraints.booking_unit)[1]
+
+    if unit in ("minute", "hour"):
+        return (minutes + UNIT_MINUTES[unit] - 1) // UNIT_MINUTES[unit]
+
+    start = localise_time(start_time).replace(tzinfo=None)
+    end = localise_time(end_time).replace(tzinfo=None)
+
+    if unit == "week":
+        first = start.date() - datetime.timedelta(days=start.weekday())
+        last = (end - datetime.timedelta(minutes=1)).date()
+        return (last - first).days // 7 + 1
+
+    units = 0
+
+    for day in _local_days(start, end):
+        if not constraints.allowed_days[day.weekday()]:
+            continue
+
+        if unit == "day":
+            units += 1
+        else:
+            for (slot_start, slot_end) in HALF_DAY_SLOTS:
+                slot_start = datetime.datetime(day.year, day.month, day.day, slot_start)
+                slot_end = datetime.datetime(day.year, day.month, day.day, slot_end)
+
+                if start < slot_end and end > slot_start:
+                    units += 1
+
+    return max(1, units)
+
+def _booking_query(range_start, range_end, registry):
+    """Return the query for the confirmed bookings that start between the passed UTC times"""
+    return equipment.Booking.getQuery(registry).filter(equipment.Booking.status == equipment.Booking.confirmed()) \
+                                               .filter(equipment.Booking.start_time >= range_start) \
+                                               .filter(equipment.Booking.start_time < range_end) \
+                                               .order(equipment.Booking.start_time, equipment.Booking.key)
+
+def _get_run(period, registry=DEFAULT_BILLING_REGISTRY):
+    return ndb.Key(BillingRun, period, parent=billing_key(registry)).get()
+
+def queue_billing(period, invoices_only=False, registry=DEFAULT_BILLING_REGISTRY, countdown=None):
+    """Queue the task that runs the billing job for 'period'. If 'invoices_only' then the
+       invoices are recomputed from the saved rollups, without scanning the bookings"""
+    params = {"period" : period, "registry" : registry}
+
+    if invoices_only:
+        params["invoices_only"] = "true"
+
+    taskqueue.add(url=BILLING_TASK_PATH, params=params, countdown=countdown)
+
+def start_billing(account, period, invoices_only=False, registry=DEFAULT_BILLING_REGISTRY):
+    """Start running the billing job for 'period' in the background"""
+    assert_is_admin(account, "Only administrators can run the billing")
+
+    period_range(period)
+
+    if invoices_only and not _get_run(period, registry):
+        raise BillingError("The bookings for %s have not been scanned yet, so there is no usage to invoice" \
+                                % period, detail=period)
+
+    queue_billing(period, invoices_only, registry)
+
+def _scan_bookings(run, bookings_registry):
+    """Scan up to PAGES_PER_TASK pages of the bookings of the run's period, adding them to
+       the running totals. The totals are saved with the cursor after every page, so a
+       retried run never counts a booking twice. Returns whether the scan is complete"""
+    (range_start, range_end) = period_range(run.period())
+    query = _booking_query(to_utc(range_start.replace(tzinfo=GMT_TZ())),
+                           to_utc(range_end.replace(tzinfo=GMT_TZ())), bookings_registry)
+
+    constraints = {}
+
+    for i in range(0, PAGES_PER_TASK):
+        cursor = ndb.Cursor(urlsafe=run.cursor) if run.cursor else None
+
+        (items, cursor, more) = query.fetch_page(BILLING_PAGE_SIZE, start_cursor=cursor,
+                                                 use_cache=False, use_memcache=False)
+
+        for item in items:
+            equip = item.equipment()
+
+            if not equip in constraints:
+                info = equipment.get_equipment(equip)
+
+                if info and info.getConstraints():
+                    constraints[equip] = info.getConstraints()
+                else:
+                    constraints[equip] = equipment.BookingConstraintInfo()
+
+            con = constraints[equip]
+            units = count_units(item.start_time, item.end_time, con)
+            unit = equipment.BookingConstraint.bookableUnitTypeByIndex(con.booking_unit)[1]
+
+            k = "%s|%s" % (item.project or NO_PROJECT, equip)
+            total = run.totals.get(k, { "booking_unit" : con.booking_unit, "num_bookings" : 0,
+                                         "units" : 0, "minutes" : 0, "billable_minutes" : 0 })
+
+            total["num_bookings"] += 1
+            total["units"] += units
+            total["minutes"] += int( (item.end_time - item.start_time).total_seconds() ) // 60
+            total["billable_minutes"] += units * UNIT_MINUTES[unit]
+
+            run.totals[k] = total
+
+        run.num_bookings += len(items)
+
+        if more and cursor:
+            run.cursor = cursor.urlsafe()
+            run.put()
+        else:
+            run.cursor = None
+            return True
+
+    return False
+
+def _save_rollups(run):
+    """Replace the rollups of the run's period with its running totals"""
+    rollups = []
+
+    for (k, total) in run.totals.items():
+        (project, equip) = k.split("|", 1)
+        rollups.append( UsageRollup(id=k, parent=run.key, project=project, equipment=equip, **total) )
+
+    keep = set( [rollup.key for rollup in rollups] )
+    old = [ key for key in UsageRollup.query(ancestor=run.key).fetch(keys_only=True) if not key in keep ]
+
+    ndb.put_multi(rollups)
+
+    if old:
+        ndb.delete_multi(old)
+
+def get_rollups(period, registry=DEFAULT_BILLING_REGISTRY):
+    """Return the usage rollups saved for 'period'"""
+    return UsageRollup.query(ancestor=ndb.Key(BillingRun, period, parent=billing_key(registry))).fetch()
+
+def _fingerprint(invoice):
+    data = [ invoice.project_name, invoice.bsb_project, invoice.vat_exempt,
+             invoice.lines, invoice.subtotal, invoice.vat, invoice.total ]
+
+    return hashlib.sha1( json.dumps(data, sort_keys=True) ).hexdigest()
+
+def compute_invoice(project_id, rollups, rates, project_info=None):
+    """Return the (unsaved) Invoice of the passed project computed from its 'rollups' and
+       the hourly 'rates'. Amounts are in pence, rounded per piece of equipment"""
+    names = equipment.get_equipment_mapping()
+    types = equipment.get_type_for_equipment_mapping()
+
+    invoice = Invoice(project=project_id)
+
+    if project_info:
+        invoice.project_name = project_info.name
+        invoice.bsb_project = bool(project_info.bsb_project)
+        invoice.vat_exempt = bool(project_info.vat_exempt)
+    elif project_id == NO_PROJECT:
+        invoice.project_name = "No project"
+    else:
+        invoice.project_name = project_id
+
+    lines = []
+    subtotal = 0
+
+    for rollup in sorted(rollups, key=lambda r: names.get(r.equipment, r.equipment)):
+        rate = find_rate(rates, rollup.equipment, types.get(rollup.equipment, (None,None))[0])
+
+        if rate is None:
+            amount = 0
+        else:
+            amount = (rate * rollup.billable_minutes + 30) // 60
+
+        lines.append( { "equipment" : rollup.equipment,
+                        "name" : names.get(rollup.equipment, rollup.equipment),
+                        "unit" : equipment.BookingConstraint.bookableUnitTypeByIndex(rollup.booking_unit)[1],
+                        "num_bookings" : rollup.num_bookings,
+                        "units" : rollup.units,
+                        "minutes" : rollup.minutes,
+                        "billable_minutes" : rollup.billable_minutes,
+                        "rate" : rate,
+                        "amount" : amount } )
+
+        subtotal += amount
+
+    invoice.lines = lines
+    invoice.subtotal = subtotal
+
+    if invoice.vat_exempt:
+        invoice.vat = 0
+    else:
+        invoice.vat = int( round(subtotal * VAT_RATE) )
+
+    invoice.total = invoice.subtotal + invoice.vat
+    invoice.fingerprint = _fingerprint(invoice)
+
+    return invoice
+
+def _save_invoices(run, registry):
+    """Compute the invoices of the run's period from its rollups, saving a new version of
+       each invoice whose fingerprint differs from its latest version. Returns the number
+       of new versions that were saved"""
+    rates = get_rates(registry)
+
+    by_project = {}
+
+    for rollup in UsageRollup.query(ancestor=run.key).fetch():
+        by_project.setdefault(rollup.project, []).append(rollup)
+
+    latest_keys = [ ndb.Key(Invoice, "%s|%d" % (project, version), parent=run.key)
+                        for (project, version) in (run.invoices or {}).items() ]
+
+    latest = dict( [(invoice.project, invoice) for invoice in ndb.get_multi(latest_keys) if invoice] )
+
+    # projects that no longer have any use get an empty invoice, so that the old one is superseded
+    for project in latest.keys():
+        if not project in by_project and latest[project].lines:
+            by_project[project] = []
+
+    new_invoices = []
+
+    for (project, rollups) in by_project.items():
+        invoice = compute_invoice(project, rollups, rates, projects.get_project_by_id(project))
+
+        if project in latest and latest[project].fingerprint == invoice.fingerprint:
+            continue
+
+        invoice.version = run.latestVersion(project) + 1
+        invoice.key = ndb.Key(Invoice, "%s|%d" % (project, invoice.version), parent=run.key)
+        new_invoices.append(invoice)
+
+    @ndb.transactional
+    def _save():
+        current = run.key.get()
+        versions = dict(current.invoices or {})
+
+        for invoice in new_invoices:
+            versions[invoice.project] = invoice.version
+
+        current.invoices = versions
+        current.invoiced = get_now_time()
+        ndb.put_multi( new_invoices + [current] )
+
+        return current
+
+    return (_save(), len(new_invoices))
+
+def run_billing(period, invoices_only=False, registry=DEFAULT_BILLING_REGISTRY,
+                bookings_registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Run the next part of the billing job for 'period'. Unless 'invoices_only', the
+       confirmed bookings that start in the period are scanned (queueing further runs
+       until the scan is complete) and saved as rollups. The invoices are then computed
+       from the rollups. Returns the (BillingRun, number of new invoice versions)"""
+    period_range(period)
+
+    run = _get_run(period, registry)
+
+    if not run:
+        run = BillingRun(id=period, parent=billing_key(registry))
+
+    if not invoices_only:
+        if not run.is_scanning:
+            # start a new scan of the bookings
+            run.is_scanning = True
+            run.cursor = None
+            run.totals = {}
+            run.num_bookings = 0
+            run.put()
+
+        if not _scan_bookings(run, bookings_registry):
+            queue_billing(period, False, registry)
+            return (run, 0)
+
+        _save_rollups(run)
+
+        run.is_scanning = False
+        run.totals = None
+        run.scanned = get_now_time()
+        run.put()
+
+    elif not run.scanned:
+        raise BillingError("The bookings for %s have not been scanned yet" % period, detail=period)
+
+    return _save_invoices(run, registry)
+
+def list_runs(account, registry=DEFAULT_BILLING_REGISTRY):
+    """Return the billing runs of every period, newest period first"""
+    assert_is_admin(account, "Only administrators can view the billing")
+
+    runs = BillingRun.getQuery(registry).fetch()
+    runs.sort(key=lambda run: run.period(), reverse=True)
+
+    return runs
+
+def get_run(account, period, registry=DEFAULT_BILLING_REGISTRY):
+    """Return the BillingRun of 'period', or None if billing has never been run for it"""
+    assert_is_admin(account, "Only administrators can view the billing")
+
+    period_range(period)
+
+    return _get_run(period, registry)
+
+def get_invoices(account, period, registry=DEFAULT_BILLING_REGISTRY):
+    """Return the latest version of the invoice of each project for 'period', sorted by
+       project name. These are read from the saved snapshots"""
+    run = get_run(account, period, registry)
+
+    if not (run and run.invoices):
+        return []
+
+    keys = [ ndb.Key(Invoice, "%s|%d" % (project, version), parent=run.key)
+                 for (project, version) in run.invoices.items() ]
+
+    invoices = [ invoice for invoice in ndb.get_multi(keys) if invoice and invoice.lines ]
+    invoices.sort(key=lambda invoice: invoice.project_name)
+
+    return invoices
+
+def get_invoice(account, period, project, version=None, registry=DEFAULT_BILLING_REGISTRY):
+    """Return the passed version (default the latest) of the invoice of 'project' for 'period'"""
+    run = get_run(account, period, registry)
+
+    if not run:
+        return None
+
+    if version is None:
+        version = run.latestVersion(project)
+
+    return ndb.Key(Invoice, "%s|%d" % (project, version), parent=run.key).get()
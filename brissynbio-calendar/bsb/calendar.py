@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from apiclient.discovery import build
+from apiclient.http import BatchHttpRequest
 from apiclient import errors
 
 from oauth2client import client
@@ -11,16 +12,23 @@ from oauth2client.appengine import CredentialsProperty
 from google.appengine.ext import ndb
 from google.appengine.ext import db
 from google.appengine.api import users
+from google.appengine.api import memcache
 
 import httplib2
+import httplib
+import socket
+import threading
 import cgi
 import os
 import time
+import random
 import re
 import datetime
 import pprint
 
 import bsb._db as _db
+import bsb.http_cache as http_cache
+import bsb.rate_limit as rate_limit
 
 from bsb import *
 
@@ -91,6 +99,15 @@ class MissingCalendarError(CalendarError):
 class DuplicateCalendarError(CalendarError):
     pass
 
+class SyncTokenExpiredError(CalendarError):
+    pass
+
+class CalendarUnavailableError(CalendarError):
+    pass
+
+class CalendarBusyError(CalendarUnavailableError):
+    pass
+
 calendar_account = "bsb.calendar.account"
 
 
@@ -135,6 +152,7 @@ def disconnectCalendarAccount(account):
     if credentials:
         # create an http object to ask to revoke the credentials
         storage.delete()
+        _service_pool.reset()
         http = httplib2.Http()
         credentials.revoke(http)
 
@@ -161,6 +179,7 @@ def setCalendarAccount(account, auth_code, session_key=None):
        raise InvalidCredentialsError("Cannot gain the necessary credentials from the passed authorization code")
 
     storage.put(credentials)
+    _service_pool.reset()
 
 def disconnectCalendarAccountURL():
     """Return the URL to call if you want to disconnect the calendar account"""
@@ -183,63 +202,340 @@ def hasCalendarAccount():
     else:
         return True
 
-def _getCalendarService():
-    """Internal function that gets the calendar service account without
-       checking if the user account is valid."""
-    storage = StorageByKeyName(CredentialsModel, calendar_account, 'credentials')
-    credentials = storage.get()
+# Idle connections older than this (in seconds) are assumed to have been closed by google
+HTTP_IDLE_TIMEOUT = 120
 
-    if credentials is None:
-        raise MissingCalendarAccountError()
+# Pooled connections are replaced once they are this old (in seconds)
+HTTP_MAX_AGE = 3600
+
+# The timeout (in seconds) of each HTTP request to google
+HTTP_TIMEOUT = 30
+
+# How often (in seconds) the pool re-reads the credentials from the datastore
+CREDENTIALS_CHECK_SECONDS = 60
+
+class _PooledService(object):
+    """An authorised calendar service together with the Http object it uses"""
+    __slots__ = ("service", "http", "generation", "created", "last_used")
+
+    def __init__(self, service, http, generation):
+        self.service = service
+        self.http = http
+        self.generation = generation
+        self.created = time.time()
+        self.last_used = self.created
+
+    def close(self):
+        """Close the connections held open by this service"""
+        for connection in self.http.connections.values():
+            try:
+                connection.close()
+            except:
+                pass
+
+        self.http.connections = {}
+
+class _ServicePool(object):
+    """Per-instance pool of authorised calendar services. An httplib2.Http object is not
+       thread-safe, so each request thread leases its own service, which is kept (with its
+       open keep-alive connection and discovery document) for reuse by later calls and
+       requests on the same thread. Services are replaced when they have been idle or alive
+       for too long, when a transport error occurs, or when the credentials change"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._credentials = None
+        self._checked = 0
+        self._generation = 0
+        self.stats = { "created" : 0, "reused" : 0, "expired" : 0, "discarded" : 0, "rotated" : 0 }
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _loadCredentials(self, force_refresh):
+        """Return the current credentials, re-reading them from the datastore when they
+           are stale and refreshing the access token if it has expired. This must be
+           called with the lock held, so only one thread on this instance refreshes"""
+        now = time.time()
+
+        if self._credentials and not force_refresh and \
+           not self._credentials.access_token_expired and \
+           now - self._checked < CREDENTIALS_CHECK_SECONDS:
+            return self._credentials
+
+        storage = StorageByKeyName(CredentialsModel, calendar_account, 'credentials')
+        credentials = storage.get()
+
+        if credentials is None:
+            raise MissingCalendarAccountError()
+
+        if credentials.access_token_expired or \
+           (force_refresh and self._credentials and
+            credentials.access_token == self._credentials.access_token):
+            # the access token has expired (or google has rejected it) - use the
+            # refresh token to get a new access token
+            credentials.refresh(httplib2.Http(timeout=HTTP_TIMEOUT))
+
+            if credentials.access_token_expired:
+                raise InvalidCredentialsError(
+                   """Cannot connect to the calendar service as have been unable to refresh the credentials.
+                      Please contact an administrator for more help.""")
+
+            # save the refreshed token
+            storage.put(credentials)
+
+        if credentials.invalid:
+            raise InvalidCredentialsError("Cannot get the calendar service as the credentials are invalid!")
+
+        if self._credentials is None or credentials.access_token != self._credentials.access_token:
+            # the credentials have rotated, so retire all of the services using the old ones
+            self._generation += 1
+            self.stats["rotated"] += 1
 
-    # create an http object, authenticate it
-    http = httplib2.Http()
+        self._credentials = credentials
+        self._checked = now
 
-    if credentials.access_token_expired:
-        # POSSIBLE RACE CONDITION - TWO PEOPLE MAY SIMULTANEOUSLY REFRESH
-        # THIS ACCESS TOKEN!
-        # the access token has expired - use the refresh token to get a new access token
-        credentials.refresh(http)
+        return credentials
 
-        if credentials.access_token_expired:
-            raise InvalidCredentialsError(
-               """Cannot connect to the calendar service as have been unable to refresh the credentials.
-                  Please contact an administrator for more help.""")
+    def get(self, force_refresh=False):
+        """Return the calendar service leased to the current thread"""
+        with self._lock:
+            credentials = self._loadCredentials(force_refresh)
+            generation = self._generation
 
-        # save the refreshed token
-        storage.put(credentials)
+        entry = getattr(self._local, "entry", None)
+        now = time.time()
 
-    if credentials.invalid:
-        raise InvalidCredentialsError("Cannot get the calendar service as the credentials are invalid!")
+        if entry:
+            if entry.generation != generation or \
+               now - entry.last_used > HTTP_IDLE_TIMEOUT or \
+               now - entry.created > HTTP_MAX_AGE:
+                entry.close()
+                entry = None
+                self._count("expired")
 
-    http = credentials.authorize(http)
+        if entry:
+            self._count("reused")
+        else:
+            http = httplib2.Http(cache=_http_cache, timeout=HTTP_TIMEOUT)
+
+            # the cached ETags are only used to make GETs conditional. httplib2 would
+            # otherwise send the ETag of a cached event as 'if-match' when the event is
+            # updated, so a remote change since the GET fails the update with a 412
+            # (and updateEvent would then insert a duplicate event)
+            http.optimistic_concurrency_methods = []
+
+            http = credentials.authorize(http)
+
+            # build a calendar service using this authentication
+            service = build(serviceName="calendar", version="v3", http=http)
+
+            entry = _PooledService(service, http, generation)
+            self._local.entry = entry
+            self._count("created")
+
+        entry.last_used = now
+
+        return entry.service
+
+    def discard(self):
+        """Discard the service leased to the current thread, e.g. after a transport error"""
+        entry = getattr(self._local, "entry", None)
+
+        if entry:
+            entry.close()
+            self._local.entry = None
+            self._count("discarded")
+
+    def reset(self):
+        """Forget the credentials and retire every pooled service, e.g. when the
+           calendar account is disconnected"""
+        with self._lock:
+            self._credentials = None
+            self._generation += 1
 
-    # build a calendar service using this authentication
-    service = build(serviceName="calendar", version="v3", http=http)
+        self.discard()
+        _http_cache.clear()
+
+# The cache of google responses shared by all of the pooled services, so that
+# repeated GETs (e.g. the discovery document and ACL lists) become conditional requests
+_http_cache = http_cache.MemcacheCache()
+
+_service_pool = _ServicePool()
+
+def service_pool_stats():
+    """Return a copy of the usage statistics of this instance's calendar service pool"""
+    return dict(_service_pool.stats)
+
+def http_cache_stats():
+    """Return a copy of the statistics of this instance's cache of google responses"""
+    return dict(_http_cache.stats)
+
+def _getCalendarService(force_refresh=False):
+    """Internal function that gets the calendar service account without
+       checking if the user account is valid. The service is taken from the
+       pool, so reuses the connection of earlier calls on this thread. Pass
+       'force_refresh' if google has rejected the current access token"""
+    return _service_pool.get(force_refresh)
+
+# The number of failed calls within BREAKER_WINDOW seconds that opens the circuit breaker
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_WINDOW = 60
+
+# How long (in seconds) the breaker stays open before a single trial call is allowed
+BREAKER_OPEN_SECONDS = 60
+
+# The longest (in seconds) that the budget of calls is held back when google
+# reports that the rate limit has been exceeded
+MAX_BACKOFF_SECONDS = 4
+
+class CircuitBreaker(object):
+    """Circuit breaker around the calendar service, shared by all instances via memcache.
+       The breaker is 'closed' while calls succeed. Once BREAKER_FAILURE_THRESHOLD calls
+       have failed within BREAKER_WINDOW seconds it 'opens', and calls fail immediately
+       with CalendarUnavailableError rather than waiting on google. After BREAKER_OPEN_SECONDS
+       it is 'half-open', when one trial call (across all instances) is let through.
+       The breaker closes if the trial succeeds, or opens again if it fails"""
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, window=BREAKER_WINDOW,
+                 open_seconds=BREAKER_OPEN_SECONDS):
+        self.threshold = threshold
+        self.window = window
+        self.open_seconds = open_seconds
+
+        self._failures_key = "breaker_%s_failures" % name
+        self._opened_key = "breaker_%s_opened" % name
+        self._trial_key = "breaker_%s_trial" % name
+
+    def state(self):
+        """Return the state of the breaker, "closed", "open" or "half-open" """
+        opened = memcache.get(self._opened_key)
+
+        if opened is None:
+            return "closed"
+        elif time.time() < opened + self.open_seconds:
+            return "open"
+        else:
+            return "half-open"
+
+    def begin(self):
+        """Call before making a call to the service. This returns the state of the
+           breaker, or raises CalendarUnavailableError if the call is not allowed"""
+        state = self.state()
+
+        if state == "open" or (state == "half-open" and
+                               not memcache.add(self._trial_key, 1, time=self.open_seconds)):
+            raise CalendarUnavailableError("""The calendar service is currently unavailable.
+                                              Please try again in a few minutes.""")
+
+        return state
+
+    def end(self, state):
+        """Call after every call that was allowed by 'begin', however it ended. This
+           releases the trial of a half-open breaker, so that a call that neither
+           succeeded nor failed does not block every other call until the breaker
+           next times out"""
+        if state == "half-open":
+            memcache.delete(self._trial_key)
+
+    def success(self, state):
+        """Record that a call made in the passed state succeeded"""
+        if state != "closed":
+            memcache.delete_multi([self._opened_key, self._trial_key, self._failures_key])
+
+    def failure(self, state):
+        """Record that a call made in the passed state failed. Returns whether
+           or not this has opened the breaker"""
+        if state == "half-open":
+            failures = self.threshold
+        else:
+            memcache.add(self._failures_key, 0, time=self.window)
+            failures = memcache.incr(self._failures_key) or 0
+
+        if failures >= self.threshold:
+            memcache.set(self._opened_key, time.time())
+            memcache.delete_multi([self._trial_key, self._failures_key])
+            return True
+        else:
+            return False
 
-    return service
+_breaker = CircuitBreaker("calendar")
+
+def is_calendar_available():
+    """Return whether or not the calendar service is available, i.e. the circuit
+       breaker is not open. When it is not available, bookings are saved locally
+       and the calendar is brought up to date once the service recovers"""
+    return _breaker.state() != "open"
+
+def calendar_breaker_state():
+    """Return the state of the calendar circuit breaker"""
+    return _breaker.state()
+
+# The budget of calls to google calendar, shared by all instances
+_limiter = rate_limit.RateLimiter("calendar")
+
+def _acquireBudget(cost=1):
+    """Take 'cost' calls from the shared budget, raising CalendarBusyError if the
+       budget is used up (immediately for background calls, or after a short wait
+       for interactive calls)"""
+    try:
+        _limiter.acquire(cost=cost)
+    except rate_limit.RateLimitError as e:
+        raise CalendarBusyError(e.errorMessage(), detail=e.detail)
+
+def calendar_budget_usage():
+    """Return a dictionary describing the use of the shared budget of calendar calls"""
+    return _limiter.usage()
 
 def getCalendarService(account):
     """Function used to return an authenticated calendar service object. 
-       You must pass in a valid user account"""
+       You must pass in a valid user account. This raises CalendarUnavailableError
+       if the circuit breaker is open"""
 
     if account is None or not account.is_approved:
         raise InvalidUserError()
 
+    if not is_calendar_available():
+        raise CalendarUnavailableError("""The calendar service is currently unavailable.
+                                          Please try again in a few minutes.""")
+
     return _getCalendarService()
 
 def service_call(func, max_repeat=5):
     """Wrapper that wraps a function containing a google api service
        call, handling the errors that may occur. Note that this may
        attempt to run 'func' several times, e.g. to re-run the 
-       service call if a timeout error occurred"""
+       service call if a timeout error occurred. Each call draws from
+       the shared budget of calls, failed calls are recorded by the
+       circuit breaker, and no call is made while the breaker is open"""
     def inner(service):
         authorization_failed = False
 
+        def failed(state, message, **kwargs):
+            """Record the failure, raising CalendarUnavailableError if the breaker opens"""
+            if _breaker.failure(state):
+                raise CalendarUnavailableError(message, **kwargs)
+
         for n in range(0, max_repeat):
+            _acquireBudget()
+            state = _breaker.begin()
+
             try:
                 result = func(service)
+                _breaker.success(state)
                 return result
+            except (httplib2.HttpLib2Error, httplib.HTTPException, socket.error), e:
+                # the connection has failed - replace it and try again
+                _service_pool.discard()
+
+                message = """Could not connect to the calendar service: %s""" % e
+                failed(state, message)
+
+                if n == max_repeat-1:
+                    raise ConnectionError(message)
+
+                service = _getCalendarService()
+
             except errors.HttpError, e:
                 try:
                     error = simplejson.loads(e.content).get('error')
@@ -273,7 +569,7 @@ def service_call(func, max_repeat=5):
                     else:
                         # We need to try to refresh
                         # the access token for the calendar account and see if this works
-                        service = _getCalendarService()
+                        service = _getCalendarService(force_refresh=True)
 
                         # loop around to try again, noting that we have already had one authorization failure
                         authorization_failed = True
@@ -281,21 +577,44 @@ def service_call(func, max_repeat=5):
                 elif error_code == 403:
                     # lots of things cause a 403 error...
                     if error_reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
-                        # Apply exponential backoff.
-                        time.sleep((2 ** n) + random.randint(0, 1000) / 1000)
+                        failed(state, "The calendar service is rejecting requests as the rate limit is exceeded",
+                               json=error)
+
+                        # Use up the shared budget for a while, so that the retry (and the calls
+                        # made by every other instance) wait for the rate limit to recover
+                        _limiter.backoff( min(MAX_BACKOFF_SECONDS, (2 ** n) + random.randint(0, 1000) / 1000.0) )
                     else:
                         # Other error, re-raise.
                         raise ConnectionError("""There has been an error when trying to connect to the calendar.
                                                  The error code is %s, with reason %s.""" % (error_code, error_reason),
                                               json=error)
 
+                elif error_code == 410:
+                    # the sync token has expired, so a full sync is needed
+                    raise SyncTokenExpiredError("""The calendar sync token has expired, so a full
+                                                   sync of the calendar is required.""", json=error)
+
                 elif error_code == 404 and error_reason == "notFound":
+                    # google is working, it just doesn't have this item
+                    _breaker.success(state)
                     raise MissingCalendarError("""The requested calendar (or calendar entry) could not be found.""",
                                                 json=error)
                 else:
-                    raise ConnectionError("""There has been an error when trying to connect to the calendar.
-                                             The error code is %s, with reason %s.""" % (error_code, error_reason),
-                                             json=error)
+                    message = """There has been an error when trying to connect to the calendar.
+                                 The error code is %s, with reason %s.""" % (error_code, error_reason)
+
+                    if error_code >= 500:
+                        # google itself is failing
+                        failed(state, message, json=error)
+                    else:
+                        _breaker.success(state)
+
+                    raise ConnectionError(message, json=error)
+
+            finally:
+                # however the call ended (e.g. an expired sync token or an error that is
+                # not caught here), let the next call be the trial of a half-open breaker
+                _breaker.end(state)
 
         return None
 
@@ -325,6 +644,13 @@ class Event:
         # All times will be local london times
         self.timezone = get_timezone_string()
 
+        # whether or not this event has been deleted from the calendar
+        self.is_cancelled = False
+
+        # the private extended properties of the event, which are only
+        # visible to this application (e.g. the ID of the booking)
+        self.private_properties = {}
+
     def setDuration(self, start_time, end_time):
         """Set the duration of the event to 'start_time' to 'end_time'"""
         if not start_time:
@@ -387,30 +713,78 @@ class Event:
         if self.gcal_id:
             event["id"] = self.gcal_id
 
+        if self.private_properties:
+            event["extendedProperties"] = { "private" : dict(self.private_properties) }
+
         return event
 
     @classmethod
     def fromGoogleCalendarDict(cls, event):
         e = cls()
 
+        e.setID( event.get('id') )
+
+        if event.get('status') == "cancelled":
+            # deleted events only carry their ID
+            e.is_cancelled = True
+            return e
+
         e.setSummary( event.get('summary') )
         e.setLocation( event.get('location') )
         e.setDescription( event.get('description') )
-        e.setID( event.get('id') )
-        e.setDuration( event.get('start').get('dateTime'), 
-                       event.get('end').get('dateTime') )
+        e.setDuration( _gcal_time_to_utc(event.get('start')),
+                       _gcal_time_to_utc(event.get('end')) )
+
+        e.private_properties = event.get('extendedProperties', {}).get('private', {})
 
         return e
 
+def _gcal_time_to_utc(value):
+    """Convert the passed google calendar time dictionary (holding either an RFC3339
+       'dateTime' or an all-day 'date') into a naive UTC datetime"""
+    if not value:
+        return None
+
+    text = value.get('dateTime')
+
+    if not text:
+        text = value.get('date')
+
+        if not text:
+            return None
+
+        return datetime.datetime.strptime(text, "%Y-%m-%d")
+
+    offset = datetime.timedelta(0)
+
+    if text.endswith("Z"):
+        text = text[0:-1]
+    elif len(text) > 19 and text[-6] in "+-":
+        sign = 1
+
+        if text[-6] == "-":
+            sign = -1
+
+        offset = sign * datetime.timedelta(hours=int(text[-5:-3]), minutes=int(text[-2:]))
+        text = text[0:-6]
+
+    # drop any fractional seconds
+    text = text.split(".")[0]
+
+    return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S") - offset
+
 # The default registry of calendars
 DEFAULT_CALENDAR_REGISTRY = "bsb.equipment.calendars"
 
+# The maximum number of event mutations sent in a single batch request
+MAX_BATCH_SIZE = 50
+
 def calendar_key(calendar_registry=DEFAULT_CALENDAR_REGISTRY):
     """Constructs a Datastore key for the calendar entry.
        We use the calendar name as the key"""
-    return ndb.Key('Calendars', calendar_registry)
+    return ndb.Key('Calendars', _db.registry(calendar_registry))
 
-class Calendar(ndb.Model):
+class Calendar(_db.TrackedModel):
     """The main model for representing an individual calendar."""
     
     # name of the calendar used to identify the calendar
@@ -471,9 +845,9 @@ class CalendarInfo(_db.StandardInfo):
         return _db.getAllFromDB(account, Calendar, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, Calendar, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, Calendar, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
@@ -561,27 +935,24 @@ class CalendarInfo(_db.StandardInfo):
         if len(emails) == 0:
             return
 
-        @service_call
-        def call_service( args ):
-            service = args[0]
-            email_address = args[1]
-
-            rule = {
-                'scope' : {
-                          'type': 'user',
-                          'value': email_address,
-                 },
-                 'role' : 'reader'
-            }
+        def add_viewer(email_address):
+            @service_call
+            def call_service(service):
+                rule = {
+                    'scope' : {
+                              'type': 'user',
+                              'value': email_address,
+                     },
+                     'role' : 'reader'
+                }
 
-            created_rule = service.acl().insert(calendarId=self.gcal_id, body=rule).execute()
+                return service.acl().insert(calendarId=self.gcal_id, body=rule).execute()
 
-            return created_rule
+            return call_service(service)
 
         created_rules = []
         for email in emails:
-            created_rule = call_service( (service, email) )
-            created_rules.append(created_rule)
+            created_rules.append( add_viewer(email) )
 
         return created_rules
 
@@ -634,16 +1005,15 @@ class CalendarInfo(_db.StandardInfo):
         if len(to_add) > 0:
             self._forceAddViewers(service, to_add)
 
-        if len(to_remove) > 0:
+        def remove_viewer(acl):
             @service_call
-            def call_service( args ):
-                service = args[0] 
-                acl = args[1]
-                rule_id = acl["id"]
-                service.acl().delete(calendarId=self.gcal_id, ruleId=rule_id).execute()
+            def call_service(service):
+                service.acl().delete(calendarId=self.gcal_id, ruleId=acl["id"]).execute()
+
+            call_service(service)
 
-            for acl in to_remove:
-                call_service( (service,acl) )        
+        for acl in to_remove:
+            remove_viewer(acl)
 
     def _createCalendar(self, service):
         """Internal function used to actually create the calendar in google calendar, 
@@ -706,13 +1076,11 @@ class CalendarInfo(_db.StandardInfo):
             # calendar as we always want to ensure that there is a valid google
             # calendar behind each calendar in the database
             calendar = self._getFromDB()
+            calendar.gcal_id = None
+            calendar.put()
+            self.gcal_id = None
 
-            cal_id = _createCalendar(service, name)
-
-            if cal_id:
-                calendar.gcal_id = cal_id
-                calendar.put()
-                self.gcal_id = cal_id
+            self._createCalendar(service)
 
     def connect(self, account, service=None):
         """Function to ensure that this calendar is connected to google calendar"""
@@ -780,6 +1148,159 @@ class CalendarInfo(_db.StandardInfo):
 
         return events
 
+    def listChangedEvents(self, account, sync_token=None, service=None):
+        """Function used to return the events that have changed in this calendar since
+           the sync token 'sync_token' was issued. If no sync token is passed then all of
+           the events are returned. This returns the tuple (events, next_sync_token), where
+           deleted events are included with 'is_cancelled' set. This raises
+           SyncTokenExpiredError if google requires a full sync"""
+        page_token = None
+        output = []
+
+        while True:
+            (events, page_token, next_sync_token) = self.listChangedEventsPage(account, sync_token,
+                                                                                page_token, service)
+            output += events
+
+            if not page_token:
+                return (output, next_sync_token)
+
+    def listChangedEventsPage(self, account, sync_token=None, page_token=None, service=None):
+        """Function used to return a single page of the events that have changed in this
+           calendar since the sync token 'sync_token' was issued (or of all of the events
+           if there is no sync token), starting from the page 'page_token'. This returns
+           the tuple (events, next_page_token, next_sync_token), where next_sync_token is
+           only returned with the last page. This raises SyncTokenExpiredError if google
+           requires a full sync"""
+        if not self.gcal_id:
+            return ([], None, None)
+
+        self.assertValidAccount(account)
+
+        if not service:
+            service = getCalendarService(account)
+
+        @service_call
+        def call_service(service):
+            if sync_token:
+                return service.events().list(calendarId=self.gcal_id, syncToken=sync_token,
+                                             pageToken=page_token).execute()
+            else:
+                return service.events().list(calendarId=self.gcal_id,
+                                             pageToken=page_token).execute()
+
+        events = call_service(service)
+        output = []
+
+        for event in events.get('items', []):
+            output.append( Event.fromGoogleCalendarDict(event) )
+
+        return (output, events.get('nextPageToken'), events.get('nextSyncToken'))
+
+    def watchEvents(self, account, channel, service=None):
+        """Ask google to send notifications of changes to the events in this calendar
+           to the webhook channel 'channel' (an apiclient.channel.Channel). The channel
+           is updated with the resource ID and expiry time assigned by google"""
+        if not self.gcal_id:
+            return None
+
+        self.assertValidAccount(account)
+
+        if not service:
+            service = getCalendarService(account)
+
+        @service_call
+        def call_service(service):
+            return service.events().watch(calendarId=self.gcal_id, body=channel.body()).execute()
+
+        channel.update( call_service(service) )
+
+        return channel
+
+    def stopChannel(self, account, channel, service=None):
+        """Stop google from sending notifications to the passed channel"""
+        self.assertValidAccount(account)
+
+        if not service:
+            service = getCalendarService(account)
+
+        @service_call
+        def call_service(service):
+            service.channels().stop(body=channel.body()).execute()
+
+        call_service(service)
+
+    def batchEvents(self, account, inserts=[], updates=[], deletes=[], service=None):
+        """Apply the passed lists of events to insert, update and delete to this calendar
+           using batched requests. This returns a dictionary mapping the index of each
+           event in 'inserts' to the event that was created, and a list of
+           (event, error) for each mutation that failed"""
+        if not self.gcal_id:
+            return ({}, [])
+
+        self.assertValidAccount(account)
+
+        if not service:
+            service = getCalendarService(account)
+
+        requests = []
+
+        for i in range(0,len(inserts)):
+            requests.append( ("insert_%d" % i, inserts[i],
+                              service.events().insert(calendarId=self.gcal_id,
+                                                      body=inserts[i].toGoogleCalendarDict())) )
+
+        for i in range(0,len(updates)):
+            requests.append( ("update_%d" % i, updates[i],
+                              service.events().update(calendarId=self.gcal_id, eventId=updates[i].gcal_id,
+                                                      body=updates[i].toGoogleCalendarDict())) )
+
+        for i in range(0,len(deletes)):
+            requests.append( ("delete_%d" % i, deletes[i],
+                              service.events().delete(calendarId=self.gcal_id, eventId=deletes[i].gcal_id)) )
+
+        inserted = {}
+        failed = []
+        events = dict( (request_id, event) for (request_id, event, request) in requests )
+
+        def callback(request_id, response, exception):
+            if exception:
+                failed.append( (events[request_id], exception) )
+            elif request_id.startswith("insert_"):
+                inserted[int(request_id[7:])] = Event.fromGoogleCalendarDict(response)
+
+        # google limits the number of requests that can be sent in a single batch, and
+        # each request in the batch counts against the per-second budget of calls
+        batch_size = min(MAX_BATCH_SIZE, _limiter.maxCost())
+
+        for i in range(0, len(requests), batch_size):
+            chunk = requests[i:i+batch_size]
+
+            try:
+                _acquireBudget( len(chunk) )
+            except CalendarBusyError, e:
+                # the budget is used up, so report the remaining changes as failed so
+                # that they are retried later, keeping the results of the sent batches
+                for (request_id, event, request) in requests[i:]:
+                    failed.append( (event, e) )
+
+                break
+
+            batch = BatchHttpRequest()
+
+            for (request_id, event, request) in chunk:
+                batch.add(request, callback=callback, request_id=request_id)
+
+            # the batch is not retried as a whole, as this could repeat the inserts
+            try:
+                batch.execute()
+            except errors.HttpError, e:
+                raise ConnectionError("""There has been an error when sending a batch of changes
+                                         to the calendar. HTTP status code %d""" % e.resp.status,
+                                      json=e.content)
+
+        return (inserted, failed)
+
     def removeEvent(self, account, event, service=None):
         """Removes the event 'event' from the google calendar."""
         if not event:
@@ -872,7 +1393,7 @@ class CalendarInfo(_db.StandardInfo):
 
         @service_call
         def call_service(service):
-            e = service.events().list(calendarId=self.gcal_id, eventId=event_id).execute()
+            e = service.events().get(calendarId=self.gcal_id, eventId=event_id).execute()
             return e
 
         e = call_service(service)
@@ -984,8 +1505,12 @@ class CalendarInfo(_db.StandardInfo):
             mode = "MONTH"
 
         if not self.gcal_id:
-            if account.is_admin:
-                self.connect(account)
+            if account.is_admin and is_calendar_available():
+                try:
+                    self.connect(account)
+                except CalendarUnavailableError:
+                    pass
+
                 if self.gcal_id:
                     return self.getEmbedHTML(account, width, height)
 
@@ -1011,19 +1536,26 @@ def number_of_calendars(calendar_registry=DEFAULT_CALENDAR_REGISTRY):
     """Function to return the total number of calendars"""
     return _db.number_of_items(Calendar, calendar_registry)
 
-def get_calendar(account, idstring, calendar_registry=DEFAULT_CALENDAR_REGISTRY):
-    """Function used to return the CalendarInfo object for the calendar with matching IDString"""
+@ndb.tasklet
+def get_calendar_async(account, idstring, calendar_registry=DEFAULT_CALENDAR_REGISTRY):
+    """Return a future for the CalendarInfo object for the calendar with matching IDString.
+       If 'account' may not see the calendar then the InvalidUserError is raised when
+       the result of the future is read"""
     assertValidAccount(account, """You must have a valid, approved account to get access to 
                                    the calendar with ID '%s'""" % idstring)
 
-    calendar = _db.get_item(Calendar, CalendarInfo, idstring, calendar_registry)    
+    calendar = yield _db.get_item_async(Calendar, CalendarInfo, idstring, calendar_registry)
 
     if calendar:
         if calendar.needs_admin:
             assertAdminAccount(account, """You must have a valid administrator's account to get access to 
                                            the calendar with name '%s'""" % calendar.name)
 
-    return calendar
+    raise ndb.Return(calendar)
+
+def get_calendar(account, idstring, calendar_registry=DEFAULT_CALENDAR_REGISTRY):
+    """Function used to return the CalendarInfo object for the calendar with matching IDString"""
+    return get_calendar_async(account, idstring, calendar_registry).get_result()
 
 def get_calendar_by_name(account, name, calendar_registry=DEFAULT_CALENDAR_REGISTRY):
     """Function to return a CalendarInfo object for the calendar with name 'name'"""
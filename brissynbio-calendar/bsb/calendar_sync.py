@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the functions used to reconcile the google calendars against
+   the booking store. Each calendar keeps a google sync token and a mirror of its
+   upcoming events, so that each run only fetches the events that have changed
+   since the last run, rather than paging through every event ever created"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+
+import datetime
+import uuid
+
+from bsb import *
+
+import calendar
+import calendar_watch
+import equipment
+
+# The default registry of calendar sync states
+DEFAULT_SYNC_REGISTRY = "bsb.calendar.sync"
+
+# Bookings and events that finished more than this long ago are not reconciled
+RECONCILE_WINDOW = datetime.timedelta(days=1)
+
+# Format used to store times in the event mirror and drift reports
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# How long (in seconds) a reconciliation holds the lease on its calendar. The lease
+# is renewed each time the sync state is saved, and is the longest time that a task can run
+LEASE_SECONDS = 600
+
+class CalendarSyncBusyError(calendar.CalendarBusyError):
+    """Raised when another reconciliation of the same calendar is already running"""
+    pass
+
+def sync_key(registry=DEFAULT_SYNC_REGISTRY):
+    """Construct the Datastore key for the calendar sync states"""
+    return ndb.Key("CalendarSyncs", registry)
+
+class CalendarSync(ndb.Model):
+    """The sync state of a single google calendar. The key is the IDString of the calendar"""
+
+    # the google sync token returned by the last listing of the calendar
+    sync_token = ndb.StringProperty(indexed=False)
+
+    # the page token of a listing that has not finished, so that an
+    # interrupted sync carries on from the last page that was saved
+    page_token = ndb.StringProperty(indexed=False)
+
+    # mirror of the upcoming events in the calendar, mapping event ID to
+    # [start, end, booking_id], where booking_id is None if the event
+    # was not created by this application for a booking
+    events = ndb.JsonProperty(indexed=False, compressed=True)
+
+    # the time of the last sync, and of the last full (non-incremental) sync
+    last_sync = ndb.DateTimeProperty(indexed=False)
+    last_full_sync = ndb.DateTimeProperty(indexed=False)
+
+    # the drift report from the last sync
+    report = ndb.JsonProperty(indexed=False)
+
+    @classmethod
+    def getQuery(cls, registry=DEFAULT_SYNC_REGISTRY):
+        return cls.query(ancestor=sync_key(registry))
+
+    @classmethod
+    def ancestor(cls, registry=DEFAULT_SYNC_REGISTRY):
+        return sync_key(registry)
+
+def _time_to_string(t):
+    if t:
+        return t.strftime(TIME_FORMAT)
+    else:
+        return None
+
+def _string_to_time(s):
+    if s:
+        return datetime.datetime.strptime(s, TIME_FORMAT)
+    else:
+        return None
+
+class DriftReport:
+    """The differences found between a google calendar and the bookings of
+       the equipment that uses that calendar"""
+    def __init__(self, data=None):
+        self.calendar = None
+        self.equipment = None
+        self.sync_time = None
+        self.full_sync = False
+        self.num_changed = 0
+        self.num_events = 0
+        self.num_bookings = 0
+        self.repaired = False
+
+        # bookings that have no matching event in the calendar
+        self.missing = []
+
+        # events created for bookings that no longer match any booking
+        self.extra = []
+
+        # events that do not match any booking and were not created by this
+        # application. These are reported, but are never removed
+        self.unmarked = []
+
+        # events whose times do not match those of their booking
+        self.mismatched = []
+
+        self.errors = []
+
+        if data:
+            for key in data.keys():
+                setattr(self, key, data[key])
+
+            self.sync_time = _string_to_time(self.sync_time)
+
+    def toData(self):
+        """Return this report as a dictionary that can be saved as JSON"""
+        data = dict(self.__dict__)
+        data["sync_time"] = _time_to_string(self.sync_time)
+        return data
+
+    def numDrifted(self):
+        """Return the number of drifted bookings and events"""
+        return len(self.missing) + len(self.extra) + len(self.mismatched) + len(self.unmarked)
+
+    def needsRepair(self):
+        """Return whether or not a repair would change the calendar. Events that were
+           not created by this application are never repaired"""
+        return len(self.missing) + len(self.extra) + len(self.mismatched) > 0
+
+    def isClean(self):
+        """Return whether or not the calendar matched the bookings"""
+        return self.numDrifted() == 0 and len(self.errors) == 0
+
+def _mirror_entry(event):
+    """Return the entry in the event mirror for the passed event"""
+    return [ _time_to_string(event.start_time), _time_to_string(event.end_time),
+             event.private_properties.get("booking_id") ]
+
+def _booking_summary(booking, event_times=None):
+    summary = { "booking" : booking.booking_id,
+                "user" : booking.email,
+                "gcal_id" : booking.gcal_id,
+                "start" : _time_to_string(booking.start_time),
+                "end" : _time_to_string(booking.end_time) }
+
+    if event_times:
+        summary["event_start"] = event_times[0]
+        summary["event_end"] = event_times[1]
+
+    return summary
+
+def _lease_key(key):
+    return "calendar_sync_lease_%s" % key.urlsafe()
+
+def _acquire_lease(key):
+    """Take the lease on the calendar whose sync state has key 'key', returning the
+       sync state. This raises CalendarSyncBusyError if another reconciliation of the
+       calendar holds the lease"""
+    lease_id = uuid.uuid4().hex
+
+    if not memcache.add(_lease_key(key), lease_id, time=LEASE_SECONDS):
+        raise CalendarSyncBusyError("""The calendar '%s' is already being reconciled.
+                                       Please try again in a few minutes.""" % key.string_id())
+
+    # read the state once the lease is held, so that it includes everything
+    # saved by the last reconciliation
+    state = key.get()
+
+    if not state:
+        state = CalendarSync(key=key, events={})
+
+    state._lease_id = lease_id
+    return state
+
+def _save_state(state):
+    """Save the passed sync state, renewing its lease. This raises CalendarSyncBusyError
+       (and does not save) if the lease has expired and been taken by another
+       reconciliation, so that the two never overwrite each other's state"""
+    if memcache.get(_lease_key(state.key)) != state._lease_id:
+        raise CalendarSyncBusyError("""The lease on the calendar '%s' has expired, and the
+                                       calendar is being reconciled again.""" % state.key.string_id())
+
+    memcache.set(_lease_key(state.key), state._lease_id, time=LEASE_SECONDS)
+    state.put()
+
+def _release_lease(state):
+    """Release the lease on the calendar of the passed sync state, if it is still held"""
+    if memcache.get(_lease_key(state.key)) == state._lease_id:
+        memcache.delete(_lease_key(state.key))
+
+def _sync_events(account, cal, state, service):
+    """Fetch the events that have changed since the last sync of 'cal' and apply them
+       to the mirror in 'state'. This falls back to a full sync if there is no sync token,
+       or if google has expired the token. The state is saved after each page, so that
+       an interrupted sync carries on from the page it reached. Returns the number of
+       changed events and whether or not this was a full sync"""
+    full_sync = not state.sync_token
+
+    if full_sync and not state.page_token:
+        state.events = {}
+        state.last_full_sync = get_now_time()
+
+    mirror = state.events or {}
+    num_changed = 0
+
+    # only keep the upcoming events, so that the mirror does not grow forever
+    cutoff = _time_to_string(get_now_time() - RECONCILE_WINDOW)
+
+    while True:
+        try:
+            (changed, page_token, sync_token) = cal.listChangedEventsPage(account, state.sync_token,
+                                                                           state.page_token, service)
+        except calendar.SyncTokenExpiredError:
+            if not (state.sync_token or state.page_token):
+                raise
+
+            # start again with a full sync
+            full_sync = True
+            mirror = {}
+            state.sync_token = None
+            state.page_token = None
+            state.last_full_sync = get_now_time()
+            continue
+
+        for event in changed:
+            entry = None
+
+            if not event.is_cancelled:
+                entry = _mirror_entry(event)
+
+            if entry and entry[1] >= cutoff:
+                mirror[event.gcal_id] = entry
+            else:
+                mirror.pop(event.gcal_id, None)
+
+        num_changed += len(changed)
+        state.events = mirror
+
+        if not page_token:
+            break
+
+        state.page_token = page_token
+        _save_state(state)
+
+    # remove the events that have finished since they were mirrored
+    for gcal_id in list(mirror.keys()):
+        if mirror[gcal_id][1] < cutoff:
+            del mirror[gcal_id]
+
+    state.events = mirror
+    state.sync_token = sync_token
+    state.page_token = None
+
+    return (num_changed, full_sync)
+
+def _repair(account, cal, state, report, missing, mismatched, extra, removed, service):
+    """Repair the calendar 'cal' by adding the missing events, updating the mismatched
+       events and removing the extra events using batched requests. Only events that
+       were created by this application for a booking should be passed in 'extra'.
+       'removed' maps the IDs of the events of cancelled bookings to those bookings,
+       whose event IDs are cleared once the events are removed. The state is saved
+       after each batch, so that an interrupted repair does not send the batches
+       that have already been applied again"""
+    changes = []
+
+    for booking in missing + mismatched:
+        try:
+            event = booking.toEvent()
+        except SchedulerError as e:
+            report.errors.append("Cannot create the event for booking %s: %s" % (booking.booking_id, e))
+            continue
+
+        if booking.gcal_id:
+            # update the event in place so that its ID (and the booking) is unchanged
+            changes.append( ("update", event, booking) )
+        else:
+            changes.append( ("insert", event, booking) )
+
+    for gcal_id in extra:
+        changes.append( ("delete", calendar.Event(gcal_id=gcal_id), removed.get(gcal_id)) )
+
+    for i in range(0, len(changes), calendar.MAX_BATCH_SIZE):
+        batch = changes[i:i+calendar.MAX_BATCH_SIZE]
+
+        _repair_batch(account, cal, state, report,
+                      [event for (action, event, booking) in batch if action == "insert"],
+                      [booking for (action, event, booking) in batch if action == "insert"],
+                      [event for (action, event, booking) in batch if action == "update"],
+                      [event for (action, event, booking) in batch if action == "delete"],
+                      [booking for (action, event, booking) in batch if action == "delete"],
+                      service)
+
+        _save_state(state)
+
+    report.repaired = True
+
+def _repair_batch(account, cal, state, report, inserts, inserted_bookings, updates, deletes,
+                  deleted_bookings, service):
+    """Send a single batch of repairs to the calendar 'cal', recording the new events
+       against their bookings and in the mirror in 'state'. The event IDs are cleared
+       from the bookings in 'deleted_bookings' (which may be None) once their events
+       in 'deletes' are removed"""
+    (inserted, failed) = cal.batchEvents(account, inserts, updates, deletes, service)
+
+    for (event, error) in failed:
+        report.errors.append("Failed to repair event %s: %s" % (event.gcal_id, error))
+
+    failed_ids = set( [event.gcal_id for (event, error) in failed] )
+
+    # save the IDs of the new events against their bookings
+    bookings = ndb.get_multi( [booking._getKey() for booking in inserted_bookings] )
+    changed = []
+
+    for i in inserted.keys():
+        event = inserted[i]
+
+        if bookings[i]:
+            bookings[i].gcal_id = event.gcal_id
+            changed.append(bookings[i])
+
+        state.events[event.gcal_id] = _mirror_entry(event)
+
+    if changed:
+        ndb.put_multi(changed)
+
+    for event in updates:
+        if not event.gcal_id in failed_ids:
+            state.events[event.gcal_id] = _mirror_entry(event)
+
+    for event in deletes:
+        if not event.gcal_id in failed_ids:
+            state.events.pop(event.gcal_id, None)
+
+    # the removal of the events of these bookings was deferred, so they kept their event IDs
+    removed = [ (event.gcal_id, booking._getKey()) for (event, booking) in zip(deletes, deleted_bookings)
+                    if booking and not event.gcal_id in failed_ids ]
+    bookings = ndb.get_multi( [key for (gcal_id, key) in removed] )
+    changed = []
+
+    for i in range(0, len(removed)):
+        if bookings[i] and bookings[i].gcal_id == removed[i][0]:
+            bookings[i].gcal_id = None
+            changed.append(bookings[i])
+
+    if changed:
+        ndb.put_multi(changed)
+
+def reconcile_equipment(account, equip, repair=True, service=None, registry=DEFAULT_SYNC_REGISTRY):
+    """Reconcile the google calendar of the equipment 'equip' against its upcoming bookings.
+       This fetches only the events that have changed since the last reconciliation, and
+       (if 'repair' is true) adds, updates or removes events so that the calendar matches
+       the bookings. This returns the DriftReport, or None if the equipment has no
+       connected calendar"""
+    assert_is_admin(account, "Only administrators can reconcile the equipment calendars")
+
+    if not equip.calendar:
+        return None
+
+    cal = calendar.get_calendar(account, equip.calendar)
+
+    if not (cal and cal.gcal_id):
+        return None
+
+    if not service:
+        service = calendar.getCalendarService(account)
+
+    # only one reconciliation of each calendar can run at a time, as each
+    # saves the sync token and mirror that the other is working from
+    state = _acquire_lease( ndb.Key(CalendarSync, cal.idstring, parent=sync_key(registry)) )
+
+    try:
+        return _reconcile(account, equip, cal, state, repair, service)
+    finally:
+        _release_lease(state)
+
+def _reconcile(account, equip, cal, state, repair, service):
+    """Reconcile the calendar 'cal' of the equipment 'equip' using the sync state
+       'state', whose lease must be held. Returns the DriftReport"""
+    report = DriftReport()
+    report.calendar = cal.idstring
+    report.equipment = equip.idstring
+    report.sync_time = get_now_time()
+
+    (report.num_changed, report.full_sync) = _sync_events(account, cal, state, service)
+
+    # only bookings that end within the reconcile window are compared
+    bookings = equipment.get_bookings(equip, start_time=get_now_time()-RECONCILE_WINDOW, sorted=False)
+    active = []
+
+    # bookings that were cancelled or denied while the calendar was unavailable keep
+    # the IDs of their events until the events have been removed
+    removed = {}
+
+    for booking in bookings:
+        if booking.status in [equipment.Booking.confirmed(), equipment.Booking.pendingAuthorisation()]:
+            active.append(booking)
+        elif booking.gcal_id:
+            removed[booking.gcal_id] = booking
+
+    booked_ids = set( [booking.gcal_id for booking in active if booking.gcal_id] )
+
+    missing = []
+    mismatched = []
+
+    for booking in active:
+        event_times = state.events.get(booking.gcal_id)
+
+        if not event_times:
+            missing.append(booking)
+            report.missing.append( _booking_summary(booking) )
+        elif event_times[0:2] != [ _time_to_string(booking.start_time), _time_to_string(booking.end_time) ]:
+            mismatched.append(booking)
+            report.mismatched.append( _booking_summary(booking, event_times) )
+
+    extra = []
+
+    for gcal_id in state.events.keys():
+        if not gcal_id in booked_ids:
+            entry = state.events[gcal_id]
+            summary = { "gcal_id" : gcal_id, "start" : entry[0], "end" : entry[1] }
+
+            # events that were not created for a booking (e.g. added by hand
+            # in google) are never removed. Entries mirrored by earlier versions
+            # did not record the booking, so are treated in the same way unless
+            # they belong to a booking that has been cancelled
+            if (len(entry) > 2 and entry[2]) or gcal_id in removed:
+                extra.append(gcal_id)
+                report.extra.append(summary)
+            else:
+                report.unmarked.append(summary)
+
+    report.num_events = len(state.events)
+    report.num_bookings = len(active)
+
+    if repair and (missing or mismatched or extra):
+        _repair(account, cal, state, report, missing, mismatched, extra, removed, service)
+
+    state.last_sync = report.sync_time
+    state.report = report.toData()
+    _save_state(state)
+
+    return report
+
+def reconcile_all(account, repair=True, registry=DEFAULT_SYNC_REGISTRY):
+    """Reconcile the calendars of all of the equipment, returning the list of DriftReports.
+       Calendars that cannot be reconciled because the budget of calls is used up are
+       queued to be synced later"""
+    assert_is_admin(account, "Only administrators can reconcile the equipment calendars")
+
+    service = calendar.getCalendarService(account)
+    reports = []
+
+    for equip in equipment.list_equipment(sorted=False):
+        try:
+            report = reconcile_equipment(account, equip, repair, service, registry)
+        except calendar.CalendarBusyError as e:
+            # the budget of calls is used up, so sync this calendar later
+            calendar_watch.queue_sync(equip.idstring, countdown=60, repair=repair)
+            continue
+        except calendar.CalendarError as e:
+            report = DriftReport()
+            report.calendar = equip.calendar
+            report.equipment = equip.idstring
+            report.sync_time = get_now_time()
+            report.errors.append(str(e))
+
+        if report:
+            reports.append(report)
+
+    return reports
+
+def get_drift_report(calendar_idstring, registry=DEFAULT_SYNC_REGISTRY):
+    """Return the DriftReport from the last reconciliation of the calendar with
+       IDString 'calendar_idstring', or None if it has not been reconciled"""
+    state = ndb.Key(CalendarSync, calendar_idstring, parent=sync_key(registry)).get()
+
+    if state and state.report:
+        return DriftReport(state.report)
+    else:
+        return None
+
+def get_drift_reports(registry=DEFAULT_SYNC_REGISTRY):
+    """Return a dictionary of the last DriftReport of every reconciled calendar,
+       indexed by calendar IDString"""
+    reports = {}
+
+    for state in CalendarSync.getQuery(registry).fetch():
+        if state.report:
+            reports[state.key.string_id()] = DriftReport(state.report)
+
+    return reports
+
+def reset_sync(account, calendar_idstring, registry=DEFAULT_SYNC_REGISTRY):
+    """Forget the sync token and event mirror of the passed calendar, so that the
+       next reconciliation performs a full sync"""
+    assert_is_admin(account, "Only administrators can reset the calendar sync state")
+    ndb.Key(CalendarSync, calendar_idstring, parent=sync_key(registry)).delete()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the watch channels used to receive push notifications from
+   google calendar. Each equipment calendar is watched by a webhook channel, and
+   each notification queues an incremental sync of just that calendar, so that
+   external edits are noticed without polling every calendar"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+
+from apiclient import channel as gchannel
+
+import datetime
+import hashlib
+import os
+import re
+import time
+import uuid
+
+from bsb import *
+
+import calendar
+import equipment
+
+# The default registry of watch channels
+DEFAULT_WATCH_REGISTRY = "bsb.calendar.watch"
+
+# How long to ask google to keep each channel open. Google may choose a shorter time
+CHANNEL_LIFETIME = datetime.timedelta(days=7)
+
+# Channels are renewed when they will expire within this time
+RENEW_BEFORE = datetime.timedelta(days=1)
+
+# The path of the webhook that receives the notifications
+NOTIFY_PATH = "/calendar/notify"
+
+# The path of the task that syncs a single calendar
+SYNC_TASK_PATH = "/tasks/sync_calendar"
+
+# Notifications for the same calendar within this many seconds share a single sync
+SYNC_COALESCE_SECONDS = 30
+
+# The resource ID given to channels that are not registered with google
+# because the application is running locally
+LOCAL_RESOURCE_ID = "local"
+
+class InvalidNotificationError(calendar.CalendarError):
+    pass
+
+def watch_key(registry=DEFAULT_WATCH_REGISTRY):
+    """Construct the Datastore key for the watch channels"""
+    return ndb.Key("WatchChannels", registry)
+
+def _ms_to_time(ms):
+    """Convert the passed number of milliseconds since the epoch into a UTC datetime"""
+    return gchannel.EPOCH + datetime.timedelta(milliseconds=int(ms))
+
+class WatchChannel(ndb.Model):
+    """A webhook channel watching the events of a calendar. The key is the channel ID"""
+
+    # the IDString of the watched calendar, and of the equipment that uses it
+    calendar = ndb.StringProperty(indexed=True)
+    equipment = ndb.StringProperty(indexed=False)
+
+    # the secret token that google sends with each notification
+    token = ndb.StringProperty(indexed=False)
+
+    # the webhook address to which notifications are sent
+    address = ndb.StringProperty(indexed=False)
+
+    # the ID google assigned to the watched resource, needed to stop the channel
+    resource_id = ndb.StringProperty(indexed=False)
+
+    # when the channel expires
+    expiration = ndb.DateTimeProperty(indexed=False)
+
+    created = ndb.DateTimeProperty(indexed=False, auto_now_add=True)
+
+    # the number of the last notification received, used to ignore repeats
+    last_message = ndb.IntegerProperty(indexed=False, default=0)
+
+    # whether this channel only exists locally, with notifications posted by the local stand-in
+    is_local = ndb.BooleanProperty(indexed=False, default=False)
+
+    def toChannel(self):
+        """Return the apiclient channel for this watch channel"""
+        return gchannel.Channel("web_hook", self.key.string_id(), self.token, self.address,
+                                resource_id=self.resource_id)
+
+    def expiresSoon(self, now=None):
+        """Return whether or not this channel needs to be renewed"""
+        if not now:
+            now = get_now_time()
+
+        return self.expiration is None or self.expiration <= now + RENEW_BEFORE
+
+    @classmethod
+    def getQuery(cls, registry=DEFAULT_WATCH_REGISTRY):
+        return cls.query(ancestor=watch_key(registry))
+
+    @classmethod
+    def ancestor(cls, registry=DEFAULT_WATCH_REGISTRY):
+        return watch_key(registry)
+
+def watch_calendar(account, equip, address, service=None, registry=DEFAULT_WATCH_REGISTRY):
+    """Open a new channel that sends notifications of changes to the calendar of 'equip'
+       to the webhook at 'address'. When running locally the channel is not registered
+       with google, and notifications are instead posted by post_local_notifications.
+       Returns the WatchChannel, or None if the equipment has no connected calendar"""
+    assert_is_admin(account, "Only administrators can watch the equipment calendars")
+
+    if not equip.calendar:
+        return None
+
+    cal = calendar.get_calendar(account, equip.calendar)
+
+    if not (cal and cal.gcal_id):
+        return None
+
+    expiration = get_now_time() + CHANNEL_LIFETIME
+    token = hashlib.sha1(os.urandom(32)).hexdigest()
+    channel = gchannel.new_webhook_channel(address, token=token, expiration=expiration)
+
+    item = WatchChannel(key=ndb.Key(WatchChannel, channel.id, parent=watch_key(registry)),
+                        calendar=cal.idstring, equipment=equip.idstring, token=token,
+                        address=address, expiration=expiration, is_local=calendar.isLocal())
+
+    # save the channel first, as notifications can arrive before the watch call returns
+    item.put()
+
+    if item.is_local:
+        item.resource_id = LOCAL_RESOURCE_ID
+    else:
+        try:
+            cal.watchEvents(account, channel, service)
+        except:
+            item.key.delete()
+            raise
+
+        item.resource_id = channel.resource_id
+
+        if channel.expiration:
+            item.expiration = _ms_to_time(channel.expiration)
+
+    item.put()
+
+    return item
+
+def stop_channel(account, item, service=None):
+    """Stop the passed watch channel and delete it"""
+    assert_is_admin(account, "Only administrators can stop watching the equipment calendars")
+
+    if not item.is_local and item.expiration and item.expiration > get_now_time():
+        cal = calendar.get_calendar(account, item.calendar)
+
+        if cal:
+            try:
+                cal.stopChannel(account, item.toChannel(), service)
+            except calendar.MissingCalendarError:
+                # google has already forgotten this channel
+                pass
+
+    item.key.delete()
+
+def get_channels(calendar_idstring=None, registry=DEFAULT_WATCH_REGISTRY):
+    """Return the watch channels, optionally only those watching the calendar 'calendar_idstring'"""
+    query = WatchChannel.getQuery(registry)
+
+    if calendar_idstring:
+        query = query.filter(WatchChannel.calendar == calendar_idstring)
+
+    return query.fetch()
+
+def renew_channels(account, address, registry=DEFAULT_WATCH_REGISTRY):
+    """Make sure that every equipment calendar is watched by a channel sending notifications
+       to 'address' that will not expire soon. New channels are opened before the old ones
+       are stopped so that no notifications are missed. Returns the tuple
+       (number of channels opened, number of channels stopped)"""
+    assert_is_admin(account, "Only administrators can watch the equipment calendars")
+
+    service = None
+
+    if not calendar.isLocal():
+        service = calendar.getCalendarService(account)
+
+    now = get_now_time()
+    by_calendar = {}
+
+    for item in get_channels(registry=registry):
+        by_calendar.setdefault(item.calendar, []).append(item)
+
+    opened = 0
+    keep = set()
+
+    for equip in equipment.list_equipment(sorted=False):
+        if not equip.calendar:
+            continue
+
+        live = [ item for item in by_calendar.get(equip.calendar, [])
+                        if item.address == address and not item.expiresSoon(now) ]
+
+        if live:
+            live.sort(key=lambda x: x.expiration, reverse=True)
+            keep.add(live[0].key)
+        else:
+            item = watch_calendar(account, equip, address, service, registry)
+
+            if item:
+                keep.add(item.key)
+                opened += 1
+
+    stopped = 0
+
+    for items in by_calendar.values():
+        for item in items:
+            if not item.key in keep:
+                try:
+                    stop_channel(account, item, service)
+                except calendar.CalendarError:
+                    # the channel will expire on its own
+                    item.key.delete()
+
+                stopped += 1
+
+    return (opened, stopped)
+
+def queue_sync(equipment_idstring, countdown=SYNC_COALESCE_SECONDS, repair=False):
+    """Queue an incremental sync of the calendar of the passed equipment, to run in
+       'countdown' seconds. If 'repair' is true then the sync also repairs any drift
+       that it finds. Requests made within SYNC_COALESCE_SECONDS of each other
+       share the same named task"""
+    window = int(time.time() / SYNC_COALESCE_SECONDS)
+    name = "calendar-%s-%s-%d" % ("repair" if repair else "sync",
+                                  re.sub(r"[^\w-]", "-", equipment_idstring), window)
+
+    try:
+        taskqueue.add(url=SYNC_TASK_PATH, params={"equipment" : equipment_idstring,
+                                                  "repair" : "1" if repair else "0"},
+                      name=name, countdown=countdown)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # a sync is already queued for this calendar
+        pass
+
+def handle_notification(headers, registry=DEFAULT_WATCH_REGISTRY):
+    """Handle the notification in the passed webhook request headers, queueing a sync
+       of the calendar if its events have changed. Returns the WatchChannel that received
+       the notification, or None if the channel is unknown. Raises InvalidNotificationError
+       if the notification does not carry the secret token of its channel"""
+    upper = {}
+
+    for key in headers.keys():
+        upper[key.upper()] = headers[key]
+
+    channel_id = upper.get(gchannel.X_GOOG_CHANNEL_ID)
+
+    if not channel_id:
+        raise InvalidNotificationError("The notification does not have a channel ID")
+
+    item = ndb.Key(WatchChannel, channel_id, parent=watch_key(registry)).get()
+
+    if not item:
+        # this is an old channel that is no longer needed
+        return None
+
+    if upper.get("X-GOOG-CHANNEL-TOKEN") != item.token:
+        raise InvalidNotificationError("The token for channel '%s' is incorrect" % channel_id)
+
+    try:
+        notification = gchannel.notification_from_headers(item.toChannel(), upper)
+    except Exception as e:
+        raise InvalidNotificationError("Cannot read the notification for channel '%s'" % channel_id,
+                                       detail=e)
+
+    if notification.state == "sync":
+        # this is sent when the channel is opened, and does not indicate a change
+        return item
+
+    @ndb.transactional
+    def _record(message_number):
+        channel = item.key.get()
+
+        if channel is None or message_number <= channel.last_message:
+            return False
+
+        channel.last_message = message_number
+        channel.put()
+        return True
+
+    if _record(notification.message_number):
+        # most notifications are of changes made by this application, so the sync
+        # only checks the calendar, and a repair is only queued if it finds drift
+        queue_sync(item.equipment)
+
+    return item
+
+def post_local_notifications(host_url, calendar_idstring=None, state="exists",
+                             registry=DEFAULT_WATCH_REGISTRY):
+    """Local stand-in for google that posts a notification to the webhook of every local
+       channel (or only those watching 'calendar_idstring'). This is used to test the
+       notification path on the development server, which google cannot reach.
+       Returns a list of (channel ID, HTTP status code)"""
+    results = []
+
+    for item in get_channels(calendar_idstring, registry):
+        if not item.is_local:
+            continue
+
+        headers = { gchannel.X_GOOG_CHANNEL_ID : item.key.string_id(),
+                    "X-Goog-Channel-Token" : item.token,
+                    gchannel.X_GOOG_MESSAGE_NUMBER : str(item.last_message + 1),
+                    gchannel.X_GOOG_RESOURCE_STATE : state,
+                    gchannel.X_GOOG_RESOURCE_URI : "local://calendars/%s/events" % item.calendar,
+                    gchannel.X_GOOG_RESOURCE_ID : item.resource_id }
+
+        response = urlfetch.fetch(host_url + NOTIFY_PATH, method=urlfetch.POST,
+                                  headers=headers, follow_redirects=False)
+
+        results.append( (item.key.string_id(), response.status_code) )
+
+    return results
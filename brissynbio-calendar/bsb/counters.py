@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the sharded counters used to maintain the number of
+   items of each kind (and in each state) without having to count or scan
+   the datastore"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+
+import random
+
+from bsb import *
+
+# The default registry of counters
+DEFAULT_COUNTERS_REGISTRY = "bsb.counters"
+
+# The number of shards over which each counter is spread. Each shard
+# is its own entity group, so can sustain its own write rate
+NUM_SHARDS = 10
+
+class CounterShard(ndb.Model):
+    """One shard of a counter. The value of the counter is the sum of all shards.
+       Shard 0 always exists once the counter has been initialised"""
+    count = ndb.IntegerProperty(indexed=False, default=0)
+
+def _shard_key(name, index, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Return the key of shard 'index' of the counter 'name'. Each shard
+       is a root entity so that shards do not contend with one another"""
+    return ndb.Key(CounterShard, "%s|%s|%d" % (registry, name, index))
+
+def _shard_keys(name, registry=DEFAULT_COUNTERS_REGISTRY):
+    return [ _shard_key(name, i, registry) for i in range(0,NUM_SHARDS) ]
+
+def _cache_key(name, registry=DEFAULT_COUNTERS_REGISTRY):
+    return "counter_%s_%s" % (registry, name)
+
+@ndb.tasklet
+def get_count_async(name, reconcile=None, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Return a future for the value of the counter 'name'. The cached total is read
+       through the context's batched memcache calls, and otherwise all of the shards
+       are fetched in a single batch. If the counter has never been initialised then
+       'reconcile' (if passed) is called, and must return a future that completes
+       once the counter has been recounted"""
+    k = _cache_key(name, registry)
+    ctx = ndb.get_context()
+    count = yield ctx.memcache_get(k)
+
+    if count is not None:
+        raise ndb.Return(count)
+
+    shards = yield ndb.get_multi_async( _shard_keys(name, registry) )
+
+    if shards[0] is None:
+        if reconcile is None:
+            raise ndb.Return(None)
+
+        yield reconcile()
+        count = yield get_count_async(name, None, registry)
+        raise ndb.Return(count)
+
+    count = 0
+
+    for shard in shards:
+        if shard:
+            count += shard.count
+
+    yield ctx.memcache_add(k, count)
+
+    raise ndb.Return(count)
+
+def get_count(name, reconcile=None, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Return the value of the counter 'name'. If the counter has never been
+       initialised then 'reconcile' (if passed) is called to initialise it,
+       else None is returned. 'reconcile' must return a future, e.g. it
+       should be one of the reconcile_*_async functions"""
+    return get_count_async(name, reconcile, registry).get_result()
+
+def get_counts(names, reconcile=None, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Return a dictionary of the values of the counters in 'names'"""
+    counts = memcache.get_multi( [_cache_key(name, registry) for name in names] )
+
+    output = {}
+
+    for name in names:
+        k = _cache_key(name, registry)
+
+        if k in counts:
+            output[name] = counts[k]
+        else:
+            output[name] = get_count(name, reconcile, registry)
+
+    return output
+
+def _flush_cache(changes, registry):
+    """Called once the transaction has committed to update the cached totals"""
+    for name in changes.keys():
+        delta = changes[name]
+        k = _cache_key(name, registry)
+
+        if delta > 0:
+            memcache.incr(k, delta)
+        elif delta < 0:
+            memcache.decr(k, -delta)
+
+def _apply(changes, registry):
+    """Internal function that applies 'changes' to randomly chosen shards.
+       This must be called within a transaction"""
+    changes = dict( (name, changes[name]) for name in changes.keys() if changes[name] )
+
+    if not changes:
+        return
+
+    names = list(changes.keys())
+    keys = []
+
+    for name in names:
+        keys.append( _shard_key(name, random.randint(0,NUM_SHARDS-1), registry) )
+
+    shards = ndb.get_multi(keys)
+
+    for i in range(0,len(keys)):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=keys[i], count=0)
+
+        shards[i].count += changes[names[i]]
+
+    ndb.put_multi(shards)
+
+    ndb.get_context().call_on_commit( lambda: _flush_cache(changes, registry) )
+
+def differences(old, new):
+    """Return the changes needed to go from the counter values in the dictionary 'old'
+       to those in the dictionary 'new'"""
+    changes = {}
+
+    for name in set(old.keys()) | set(new.keys()):
+        delta = new.get(name, 0) - old.get(name, 0)
+
+        if delta != 0:
+            changes[name] = delta
+
+    return changes
+
+def commit(puts=[], deletes=[], changes={}, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Put the entities in 'puts' and delete the keys in 'deletes' in the same
+       transaction as applying 'changes' (a dictionary of counter name to delta)
+       to the counters"""
+    def _txn():
+        if puts:
+            ndb.put_multi(puts)
+
+        if deletes:
+            ndb.delete_multi(deletes)
+
+        _apply(changes, registry)
+
+    ndb.transaction(_txn, xg=True)
+
+def update(changes, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Apply 'changes' (a dictionary of counter name to delta) to the counters.
+       If this is called within a transaction then the changes will be part
+       of that transaction"""
+    if ndb.in_transaction():
+        _apply(changes, registry)
+    else:
+        ndb.transaction(lambda: _apply(changes, registry), xg=True)
+
+@ndb.tasklet
+def set_counts_async(counts, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Return a future that completes once the counters in the dictionary 'counts'
+       have been set to the passed values. The shards of all of the counters
+       are written in a single batch"""
+    shards = []
+
+    for name in counts.keys():
+        keys = _shard_keys(name, registry)
+        shards.append( CounterShard(key=keys[0], count=counts[name]) )
+
+        for key in keys[1:]:
+            shards.append( CounterShard(key=key, count=0) )
+
+    yield ndb.put_multi_async(shards)
+
+    ctx = ndb.get_context()
+    yield [ ctx.memcache_set(_cache_key(name, registry), counts[name]) for name in counts.keys() ]
+
+def set_counts(counts, registry=DEFAULT_COUNTERS_REGISTRY):
+    """Set the counters in the dictionary 'counts' to the passed values. This is
+       used to (re)initialise counters from a full count of the datastore"""
+    set_counts_async(counts, registry).get_result()
+
+def reconcile_all():
+    """Recount everything in the datastore and reset all of the counters. This
+       is run periodically to correct any drift in the maintained counts"""
+    import accounts
+    import equipment
+
+    accounts.reconcile_counters()
+    equipment.reconcile_counters()
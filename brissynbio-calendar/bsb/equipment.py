@@ -18,6 +18,9 @@ from bsb import *
 # uses the db module, which should be kept private
 import bsb._db as _db
 
+# maintained counts of equipment and bookings
+import bsb.counters as counters
+
 class EquipmentError(SchedulerError):
     pass
 
@@ -45,28 +48,28 @@ DEFAULT_BOOKING_REGISTRY = "bsb.equipment.bookings"
 def equipment_key(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
     """Constructs a Datastore key for a equipment entry.
        We use the equipment idstring as the key"""
-    return ndb.Key('Equipment', equipment_registry)
+    return ndb.Key('Equipment', _db.registry(equipment_registry))
 
 def types_key(types_registry=DEFAULT_TYPES_REGISTRY):
     """Constructs a Datastore key for a equipment type entry.
        We use the equipment type idstring as the key"""
-    return ndb.Key('EquipmentType', types_registry)
+    return ndb.Key('EquipmentType', _db.registry(types_registry))
 
 def labs_key(labs_registry=DEFAULT_LABS_REGISTRY):
     """Constructs a Datastore key for a lab entry.
        We use the lab idstring as the key"""
-    return ndb.Key('Laboratory', labs_registry)
+    return ndb.Key('Laboratory', _db.registry(labs_registry))
 
 def acls_key(acls_registry=DEFAULT_ACLS_REGISTRY):
     """Constructs a Datastore key for an ACL entry.
        We use the equipment idstring and email as the key"""
-    return ndb.Key('EquipmentACL', acls_registry)
+    return ndb.Key('EquipmentACL', _db.registry(acls_registry))
 
 def bookings_key(bookings_registry=DEFAULT_BOOKING_REGISTRY):
     """Constructs a Datastore key for a bookings entry for a particular piece of equipment"""
-    return ndb.Key('Booking', bookings_registry)
+    return ndb.Key('Booking', _db.registry(bookings_registry))
 
-class Booking(ndb.Model):
+class Booking(_db.TrackedModel):
     """The main model for representing a booking on the system"""
     # The start time of the booking
     start_time = ndb.DateTimeProperty(indexed=True, auto_now_add=False, auto_now=False)
@@ -661,7 +664,6 @@ class BookingConstraintInfo:
             self.allowed_range_end = range_end
             self.has_range = True
 
-
 class EquipmentReq(ndb.Model):
     """An individual equipment booking requirement"""
     # The type of requirement - temperature, speed, number, string etc.
@@ -711,11 +713,8 @@ class EquipmentReqInfo:
         if self.validator:
             return self.validator
 
-        if self.allowed_values:
-            self.validator = AllowedValues(self.allowed_values,self.reqtype)
-            return self.validator
-
-        return AllowedValues()
+        self.validator = get_allowed_values(self.allowed_values,self.reqtype)
+        return self.validator
 
     def isText(self):
         """Return whether or not this value is a piece of text"""
@@ -762,7 +761,7 @@ class EquipmentReqInfo:
         """Validate that the passed value is acceptable for this requirement"""
         if not self.getValidator().isValid(value):
             raise InputError("The passed value '%s' does not fit into the valid range of values %s" \
-                             % (value, self.validator.toString()))
+                             % (value, self.getValidator().toString()))
 
     def processResponse(self, value):
         """Process and validate the passed value and return it"""
@@ -775,7 +774,7 @@ class EquipmentReqInfo:
         else:
             return value
 
-class EquipmentReqs(ndb.Model):
+class EquipmentReqs(_db.TrackedModel):
     """The requirements that must be provided by the user when making a booking"""
     # A help or description paragraph that is printed with the requirements
     intro = ndb.StringProperty(indexed=False)
@@ -1050,6 +1049,23 @@ class AllowedValues:
         except:
             return False
 
+# Instance-local cache of parsed AllowedValues, indexed by (values string, units).
+# AllowedValues are never changed once parsed, so can be shared
+_allowed_values_cache = {}
+
+def get_allowed_values(vals=None, units=None):
+    """Return the (shared) AllowedValues parsed from 'vals' with units 'units'"""
+    key = (to_string(vals), units)
+
+    try:
+        return _allowed_values_cache[key]
+    except KeyError:
+        pass
+
+    allowed = AllowedValues(vals, units)
+    _allowed_values_cache[key] = allowed
+    return allowed
+
 class EquipmentReqsInfo:
     def __init__(self, reqs=None, reqs_id=None, registry=DEFAULT_EQUIPMENT_REGISTRY):
         self.intro = None
@@ -1058,6 +1074,10 @@ class EquipmentReqsInfo:
 
         self.reqs_id = None
 
+        # the piece of equipment that inherits these requirements from its
+        # type. The requirements are copied to the equipment when first edited
+        self._inherited_by = None
+
         if reqs_id:
             self.reqs_id = reqs_id
             self._registry = registry
@@ -1088,9 +1108,10 @@ class EquipmentReqsInfo:
         acl.assertIsAdministrator(account)
 
         if needs_authorisation != self.needs_authorisation:
-            reqs = self._getFromDB()
+            reqs = self._getWritable()
             reqs.needs_authorisation = needs_authorisation
             reqs.put()
+            self._changed()
             self.needs_authorisation = needs_authorisation
 
     def setIntroduction(self, account, acl, introduction):
@@ -1100,9 +1121,10 @@ class EquipmentReqsInfo:
         introduction = to_string(introduction)
 
         if introduction != self.intro:
-            reqs = self._getFromDB()
+            reqs = self._getWritable()
             reqs.intro = introduction
             reqs.put()
+            self._changed()
             self.intro = introduction
 
     def moveDown(self, account, acl, req_name):
@@ -1123,11 +1145,12 @@ class EquipmentReqsInfo:
         if index == len(self.requirements)-1:
             return
 
-        item = self._getFromDB()
+        item = self._getWritable()
 
         r = item.requirements.pop(index)
         item.requirements.insert(index+1, r)
         item.put()
+        self._changed()
 
         r = self.requirements.pop(index)
         self.requirements.insert(index+1, r)
@@ -1150,11 +1173,12 @@ class EquipmentReqsInfo:
         if index < 1:
             return
 
-        item = self._getFromDB()
+        item = self._getWritable()
 
         r = item.requirements.pop(index)
         item.requirements.insert(index-1, r)
         item.put()
+        self._changed()
 
         r = self.requirements.pop(index)
         self.requirements.insert(index-1, r)
@@ -1176,9 +1200,10 @@ class EquipmentReqsInfo:
                 break
 
         if index != -1:
-            item = self._getFromDB()
+            item = self._getWritable()
             item.requirements.pop(index)
             item.put()
+            self._changed()
 
             self.requirements.pop(index)
 
@@ -1188,7 +1213,7 @@ class EquipmentReqsInfo:
 
         req_name = to_string(req_name) 
         req_type = to_string(req_type)
-        allowed_values = AllowedValues(allowed_values).toString()
+        allowed_values = get_allowed_values(allowed_values).toString()
         req_help = to_string(req_help)
 
         if not (req_name and req_type):
@@ -1206,7 +1231,7 @@ class EquipmentReqsInfo:
                 index = i
                 break
 
-        item = self._getFromDB()
+        item = self._getWritable()
 
         if index == -1:
             item.requirements.append( EquipmentReq( reqname=req_name,
@@ -1221,6 +1246,7 @@ class EquipmentReqsInfo:
             item.requirements[index].reqhelp = req_help
 
         item.put()
+        self._changed()
 
         self.requirements.append( EquipmentReqInfo(item.requirements[index]) )                
 
@@ -1234,10 +1260,72 @@ class EquipmentReqsInfo:
             for requirement in self.requirements:
                 dup.requirements.append( EquipmentReq(reqtype=requirement.reqtype,
                                                       reqname=requirement.reqname,
+                                                      allowed_values=requirement.allowed_values,
                                                       reqhelp=requirement.reqhelp) )
 
             dup.put()
-            return EquipmentReqsInfo(dup)
+            return EquipmentReqsInfo(dup, registry=registry)
+
+    def _getWritable(self):
+        """Return the datastore object that should be edited. If these requirements are
+           inherited from the equipment type then they are first copied to the equipment,
+           so that editing them does not change the requirements of the type"""
+        if not self._inherited_by:
+            return self._getFromDB()
+
+        equipment = self._inherited_by
+
+        # the copy and the equipment are in the same entity group, so are changed
+        # together in a transaction. Otherwise two edits at the same time could each
+        # make a copy, with the equipment ending up pointing at only one of them
+        @ndb.transactional
+        def _copy():
+            equip = equipment._getFromDB()
+
+            if equip.requirements:
+                # another edit has already copied the requirements
+                item = ndb.Key(EquipmentReqs, int(equip.requirements),
+                               parent=equipment_key(equipment._registry)).get()
+
+                if item:
+                    return item
+
+            item = EquipmentReqs( parent=equipment_key(equipment._registry),
+                                  intro=self.intro,
+                                  needs_authorisation=self.needs_authorisation )
+
+            for requirement in self.requirements:
+                item.requirements.append( EquipmentReq(reqtype=requirement.reqtype,
+                                                       reqname=requirement.reqname,
+                                                       allowed_values=requirement.allowed_values,
+                                                       reqhelp=requirement.reqhelp) )
+
+            item.put()
+
+            equip.requirements = item.requirementsID()
+            equip.put()
+
+            return item
+
+        item = _copy()
+
+        equipment.requirements = item.requirementsID()
+
+        self.reqs_id = item.requirementsID()
+        self._CLASS = EquipmentReqs
+        self._registry = equipment._registry
+        self._inherited_by = None
+
+        return item
+
+    def _changed(self):
+        """Signal that the stored requirements have been changed"""
+        changed_equipment_requirements(self.reqs_id, self._registry)
+
+    def prepare(self):
+        """Parse all of the allowed values now, so that they are stored with any cached copy"""
+        for requirement in self.requirements:
+            requirement.getValidator()
 
     def processResponse(self, response, is_demo=False, registry=DEFAULT_BOOKING_REGISTRY):
         """Process the response from the user so that the requirements can be created"""
@@ -1338,7 +1426,7 @@ class BookingReqInfo:
             if req.reqvalue:
                 self.reqvalue = unicode(req.reqvalue)
 
-class BookingReqs(ndb.Model):
+class BookingReqs(_db.TrackedModel):
     """The requirements provided by the user when they made a booking"""
     # the ID of the EquipmentReqs to which this is attached
     reqid = ndb.IntegerProperty(indexed=False)
@@ -1433,11 +1521,11 @@ class BookingReqsInfo:
     def equipmentRequirements(self):
         """Return the equipment requirements for this booking"""
         if self.reqid:
-            return EquipmentReqsInfo(reqs_id=self.reqid, registry=DEFAULT_EQUIPMENT_REGISTRY)
+            return get_equipment_requirements(self.reqid, DEFAULT_EQUIPMENT_REGISTRY)
         else:
             return None
 
-class EquipmentType(ndb.Model):
+class EquipmentType(_db.TrackedModel):
     """The main model for representing a type of equipment (e.g. shaker)."""
     # The human readable name of the equipment
     name = ndb.StringProperty(indexed=False)
@@ -1461,7 +1549,7 @@ class EquipmentType(ndb.Model):
     def ancestor(cls, types_registry=DEFAULT_TYPES_REGISTRY):
         return types_key(types_registry)
 
-class Equipment(ndb.Model):
+class Equipment(_db.TrackedModel):
     """The main model for representing an individual piece of equipment (e.g. Song's first shaker)."""
     # The human readable name of the equipment
     name = ndb.StringProperty(indexed=False)
@@ -1496,7 +1584,7 @@ class Equipment(ndb.Model):
     def ancestor(cls, equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
         return equipment_key(equipment_registry)
 
-class Laboratory(ndb.Model):
+class Laboratory(_db.TrackedModel):
     """The main model for representing an individual laboratory (that can
        contain lots of different pieces of equipment, but which has a single
        contact point and location"""
@@ -1523,7 +1611,7 @@ class Laboratory(ndb.Model):
     def ancestor(cls, labs_registry=DEFAULT_LABS_REGISTRY):
         return labs_key(labs_registry)
 
-class EquipmentACL(ndb.Model):
+class EquipmentACL(_db.TrackedModel):
     """The main model for representing an access control rule
        for a piece of equipment"""
     # The ACL (integer)
@@ -1579,8 +1667,12 @@ class EquipmentACL(ndb.Model):
         return 3
 
 
-class BookingInfo:
+class BookingInfo(object):
     """Simple class that holds information about a booking"""
+    __slots__ = ("equipment", "email", "project", "start_time", "end_time", "booking_time",
+                 "status", "booking_id", "information", "gcal_id", "requirements",
+                 "_registry", "_CLASS")
+
     def __init__(self, booking=None, equipment=None, booking_id=None, registry=DEFAULT_BOOKING_REGISTRY):
         self.equipment = None
         self.email = None
@@ -1680,6 +1772,11 @@ class BookingInfo:
 
         event = calendar.Event(self.start_time, self.end_time, summary, location, desc, self.gcal_id)
 
+        # mark the event as created for this booking, so that reconciling the calendar
+        # only ever removes events that were created by this application
+        event.private_properties["booking_id"] = str(self.booking_id)
+        event.private_properties["equipment"] = self.equipment
+
         return event
 
     def idString(self):
@@ -1869,7 +1966,7 @@ class BookingInfo:
         my_booking.user = account.email
         my_booking.status = Booking.reserved()
 
-        my_booking.put()
+        _save_booking(my_booking, {})
 
         # now see whether or not this reservation clashes with anyone else...
         bookings = Booking.getEquipmentQuery(equipment.idstring,registry) \
@@ -1891,18 +1988,21 @@ class BookingInfo:
                             # we booked at the same time - the winner is the one with the alphabetically
                             # later email address
                             if booking.user < my_booking.user:
+                                old_counts = _booking_counts(booking)
                                 booking.status = Booking.cancelled()
-                                booking.put()
+                                _save_booking(booking, old_counts)
                             else:
                                 clashing_bookings.append( BookingInfo(booking) )
                         else:
                             # we have won - automatically cancel the other booking
+                            old_counts = _booking_counts(booking)
                             booking.status = Booking.cancelled()
-                            booking.put()
+                            _save_booking(booking, old_counts)
 
         if len(clashing_bookings) > 0:
             # we cannot get a unique booking
-            my_booking.key.delete()
+            counters.commit( deletes=[my_booking.key],
+                             changes=counters.differences(_booking_counts(my_booking), {}) )
             raise BookingError("""Cannot create a reservation for this time as someone else has already
                                   created a booking. '%s'""" % cls._describeBookings(clashing_bookings),
                                   detail=clashing_bookings)
@@ -1910,6 +2010,33 @@ class BookingInfo:
         return BookingInfo(my_booking)
 
 
+class BookingView(_db.LazyInfo):
+    """Lightweight, read-only view of a Booking that is used for large listings.
+       The commonly-used fields are read directly from the Booking, and the full
+       BookingInfo is only created if anything else is needed"""
+    __slots__ = ()
+
+    _FIELDS = { "equipment" : lambda item: item.equipment(),
+                "email" : lambda item: item.email(),
+                "booking_id" : lambda item: item.bookingID(),
+                "project" : lambda item: unicode(item.project) if item.project else None,
+                "start_time" : lambda item: item.start_time,
+                "end_time" : lambda item: item.end_time,
+                "booking_time" : lambda item: item.booking_time,
+                "status" : lambda item: int(item.status) if item.status else 0,
+                "gcal_id" : lambda item: item.gcal_id }
+
+    def __init__(self, booking):
+        _db.LazyInfo.__init__(self, booking, BookingInfo)
+
+# The read-only BookingInfo functions only use the fields above, so can be
+# shared by BookingView without having to create the full BookingInfo
+for _name in [ "idString", "getProjectID", "getProjectName", "getEquipmentID", "getEquipmentName",
+               "getLaboratoryName", "getLaboratoryID", "getTypeName", "getTypeID",
+               "isCancelled", "isReserved", "isConfirmed", "isPendingAuthorisation", 
+               "isDeniedAuthorisation", "isPast", "isCurrentOrFuture", "isActive", "isOwner" ]:
+    setattr(BookingView, _name, BookingInfo.__dict__[_name])
+
 class EquipmentACLInfo:
     """Simple class that holds the equipment ACL"""
     def __init__(self, acl=None, registry=DEFAULT_ACLS_REGISTRY):
@@ -2005,20 +2132,27 @@ class EquipmentACLInfo:
             return None
 
     @classmethod
-    def getRule(cls, account, equipment, registry=DEFAULT_ACLS_REGISTRY):
-        """Return the access rule for the passed piece of equipment"""
+    @ndb.tasklet
+    def getRule_async(cls, account, equipment, registry=DEFAULT_ACLS_REGISTRY):
+        """Return a future for the access rule of 'account' for 'equipment'. This is a
+           single get by key, so can be run alongside the other lookups for a page"""
         if not account or not equipment:
-            return None
+            raise ndb.Return(None)
 
         key = ndb.Key(Equipment, equipment.idstring, EquipmentACL, account.email,
                       parent=acls_key(registry))
 
-        item = key.get()
+        item = yield key.get_async()
 
         if item:
-            return EquipmentACLInfo(item)
+            raise ndb.Return( EquipmentACLInfo(item) )
         else:
-            return None
+            raise ndb.Return(None)
+
+    @classmethod
+    def getRule(cls, account, equipment, registry=DEFAULT_ACLS_REGISTRY):
+        """Return the access rule for the passed piece of equipment"""
+        return cls.getRule_async(account, equipment, registry).get_result()
 
     @classmethod
     def _getEquipmentFromRules(cls, items):
@@ -2379,24 +2513,28 @@ class EquipmentTypeInfo(_db.StandardInfo):
            This is a template that can be modifed by each individual piece 
            of equipment"""
         if self.requirements:
-            return EquipmentReqsInfo( reqs_id=self.requirements, registry=registry )
+            return get_equipment_requirements( self.requirements, registry )
         else:
             return None
 
+    def getRequirements_async(self, registry=None):
+        """Return a future for the booking requirements used for equipment of this type"""
+        return get_equipment_requirements_async( self.requirements, registry )
+
     @classmethod
     def getAll(cls, account, registry=None):
         """Return all of the items in the database"""
         return _db.getAllFromDB(account, EquipmentType, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, EquipmentType, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, EquipmentType, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
         """Restore the database from the passed 'data' string containing a pickle of all of the objects"""
-        _db.restore(account, cls, EquipmentType, registry)
+        _db.restore(account, cls, EquipmentType, data, registry)
 
     @classmethod
     def deleteDB(cls, account, registry=None):
@@ -2423,9 +2561,9 @@ class LaboratoryInfo(_db.StandardInfo):
         return _db.getAllFromDB(account, Laboratory, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, Laboratory, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, Laboratory, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
@@ -2496,9 +2634,51 @@ class LaboratoryInfo(_db.StandardInfo):
 
             self.owners = new_owners
 
+def _requirements_cache_key(reqs_id, registry):
+    return "equip_reqs_%s_%s" % (registry, reqs_id)
+
+@ndb.tasklet
+def get_equipment_requirements_async(reqs_id, registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return a future for the parsed requirements with ID 'reqs_id'. The cached copy
+       is read through the context's memcache, and the requirements are only fetched
+       by key and parsed if they are not cached"""
+    if not reqs_id:
+        raise ndb.Return(None)
+
+    k = _requirements_cache_key(reqs_id, registry)
+    ctx = ndb.get_context()
+    reqs = yield ctx.memcache_get(k)
+
+    if reqs is None:
+        item = yield ndb.Key(EquipmentReqs, int(reqs_id), 
+                             parent=EquipmentReqs.ancestor(registry)).get_async()
+
+        if not item:
+            raise DataError("There are no requirements available with ID = '%s'" % reqs_id)
+
+        reqs = EquipmentReqsInfo(item, registry=registry)
+        reqs.prepare()
+        yield ctx.memcache_set(k, reqs)
+
+    raise ndb.Return(reqs)
+
+def get_equipment_requirements(reqs_id, registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return the parsed requirements with ID 'reqs_id'. These are read from
+       the memcache if possible, so do not need to be re-read or re-parsed"""
+    return get_equipment_requirements_async(reqs_id, registry).get_result()
+
+def changed_equipment_requirements(reqs_id, registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Function called whenever the requirements with ID 'reqs_id' are changed"""
+    if reqs_id:
+        memcache.delete(_requirements_cache_key(reqs_id, registry))
+
+def get_equipment_type_async(idstring, registry=DEFAULT_TYPES_REGISTRY):
+    """Return a future for the equipment type matching the IDString 'idstring'"""
+    return _db.get_item_async(EquipmentType, EquipmentTypeInfo, idstring, registry)
+
 def get_equipment_type(idstring, registry=DEFAULT_TYPES_REGISTRY):
     """Return the equipment type matching the IDString 'idstring')"""
-    return _db.get_item(EquipmentType, EquipmentTypeInfo, idstring, registry)
+    return get_equipment_type_async(idstring, registry).get_result()
 
 def get_laboratory(idstring, registry=DEFAULT_LABS_REGISTRY):
     """Return the laboratory matching the IDString 'idstring'"""
@@ -2506,6 +2686,8 @@ def get_laboratory(idstring, registry=DEFAULT_LABS_REGISTRY):
 
 class EquipmentInfo(_db.StandardInfo):
     """Simple class that holds the information about each piece of equipment"""
+    _LEGACY_CLASSES = [ BookingConstraintInfo ]
+
     def __init__(self, equip=None, registry=DEFAULT_EQUIPMENT_REGISTRY):
         _db.StandardInfo.__init__(self, equip, registry)
         self.equipment_type = None
@@ -2536,19 +2718,21 @@ class EquipmentInfo(_db.StandardInfo):
         return _db.getAllFromDB(account, Equipment, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, Equipment, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, Equipment, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
         """Restore the database from the passed 'data' string containing a pickle of all of the objects"""
         _db.restore(account, cls, Equipment, data, registry)
+        reconcile_equipment_counters(registry or DEFAULT_EQUIPMENT_REGISTRY)
 
     @classmethod
     def deleteDB(cls, account, registry=None):
         """Delete the entire database"""
         _db.deleteDB(account, cls, Equipment, registry)
+        reconcile_equipment_counters(registry or DEFAULT_EQUIPMENT_REGISTRY)
  
     def getLaboratoryID(self):
         """Return the IDString for the laboratory"""
@@ -2586,6 +2770,10 @@ class EquipmentInfo(_db.StandardInfo):
         """Return the ACL rule for this piece of equipment for this user"""
         return EquipmentACLInfo.getRule(account, self)
 
+    def getACL_async(self, account):
+        """Return a future for the ACL rule for this piece of equipment for this user"""
+        return EquipmentACLInfo.getRule_async(account, self)
+
     def getBannedUsers(self, account, include_reasons=False):
         """Return a list of banned users for this piece of equipment"""
         return EquipmentACLInfo.getBannedUsers(account, self, include_reasons)
@@ -2655,6 +2843,74 @@ class EquipmentInfo(_db.StandardInfo):
         """Return the calendar for this piece of equipment"""
         return calendar.get_calendar(account, self.calendar)
 
+    def getCalendar_async(self, account):
+        """Return a future for the calendar for this piece of equipment"""
+        return calendar.get_calendar_async(account, self.calendar)
+
+    def _deferCalendarWork(self):
+        """Called when the calendar could not be updated because the calendar service is
+           unavailable. The booking is still saved, and a sync of this calendar is queued
+           for when the service should have recovered, which adds, updates or removes
+           the events to match the bookings"""
+        import calendar_watch
+        calendar_watch.queue_sync(self.idstring, countdown=calendar.BREAKER_OPEN_SECONDS, repair=True)
+
+    def _addCalendarEvent(self, account, booking):
+        """Add the passed booking to the calendar, saving the ID of the event in the booking.
+           This is deferred if the calendar service is unavailable"""
+        try:
+            event = self.getCalendar(account).addEvent(account, BookingInfo(booking).toEvent())
+        except (calendar.CalendarUnavailableError, calendar.ConnectionError):
+            self._deferCalendarWork()
+            return
+
+        if event:
+            booking.gcal_id = event.gcal_id
+
+    def _updateCalendarEvent(self, account, booking):
+        """Update the event for the passed booking in the calendar. This is deferred if
+           the calendar service is unavailable"""
+        try:
+            event = self.getCalendar(account).updateEvent(account, BookingInfo(booking).toEvent())
+        except (calendar.CalendarUnavailableError, calendar.ConnectionError):
+            self._deferCalendarWork()
+            return
+
+        if event:
+            booking.gcal_id = event.gcal_id
+
+    def _removeCalendarEvent(self, account, booking):
+        """Remove the event for the passed booking from the calendar. This is deferred if
+           the calendar service is unavailable, in which case the booking keeps the ID of
+           its event until the sync has removed it"""
+        try:
+            self.getCalendar(account).removeEvent(account, BookingInfo(booking).toEvent())
+        except (calendar.CalendarUnavailableError, calendar.ConnectionError):
+            self._deferCalendarWork()
+            return
+
+        booking.gcal_id = None
+
+    def getTimeline(self, days=7):
+        """Return the upcoming confirmed and pending bookings for this equipment over the
+           next 'days' days, as a list of (day, bookings) for each day. This is shown in
+           place of the embedded google calendar when that is unavailable"""
+        start = get_day_from(get_now_time())
+        end = start + datetime.timedelta(days=days)
+
+        timeline = []
+
+        for i in range(0,days):
+            timeline.append( (start + datetime.timedelta(days=i), []) )
+
+        for booking in get_bookings(self, start, end):
+            if booking.status in [Booking.confirmed(), Booking.pendingAuthorisation()]:
+                for (day, bookings) in timeline:
+                    if booking.start_time < day + datetime.timedelta(days=1) and booking.end_time > day:
+                        bookings.append(booking)
+
+        return timeline
+
     def createCalendar(self, account):
         """Function used to create the calendar for this piece of equipment"""
         if self.calendar:
@@ -2753,6 +3009,8 @@ class EquipmentInfo(_db.StandardInfo):
             raise BookingError("You cannot confirm a booking that is not in the 'reserved' state.",
                                detail=BookingInfo(booking))
 
+        old_counts = _booking_counts(booking)
+
         if booking_reqs:
             booking.requirements = booking_reqs.reqs_id
 
@@ -2766,12 +3024,9 @@ class EquipmentInfo(_db.StandardInfo):
             booking.status = Booking.confirmed()
 
         # Add the event to the google calendar so that it is visible
-        event = self.getCalendar(account).addEvent(account, BookingInfo(booking).toEvent())
-
-        if event:
-            booking.gcal_id = event.gcal_id
+        self._addCalendarEvent(account, booking)
 
-        booking.put()
+        _save_booking(booking, old_counts)
 
         return BookingInfo(booking)
 
@@ -2796,22 +3051,19 @@ class EquipmentInfo(_db.StandardInfo):
             if booking.start_time <= now_time:
                 # we can modify the booking to cancel the remaining time
                 booking.end_time = now_time
-                event = self.getCalendar(account).updateEvent(account, BookingInfo(booking).toEvent())
-
-                if event:
-                    booking.gcal_id = event.gcal_id
-                    booking.put()
-                    return "The time remaining on the booking has been cancelled"
+                self._updateCalendarEvent(account, booking)
+                _save_booking(booking, _booking_counts(booking))
+                return "The time remaining on the booking has been cancelled"
 
             # remove this booking from the calendar
-            self.getCalendar(account).removeEvent(account, BookingInfo(booking).toEvent())
-            booking.gcal_id = None
+            self._removeCalendarEvent(account, booking)
         else:
             is_confirmed = False
 
         # cancel this booking
+        old_counts = _booking_counts(booking)
         booking.status = booking.cancelled()
-        booking.put()
+        _save_booking(booking, old_counts)
 
         if is_confirmed:
             return "The booking has been cancelled"
@@ -2836,11 +3088,11 @@ class EquipmentInfo(_db.StandardInfo):
                                    detail = BookingInfo(booking))
 
             # remove this booking from the calendar
-            self.getCalendar(account).removeEvent(account, BookingInfo(booking).toEvent())
-            booking.gcal_id = None
+            self._removeCalendarEvent(account, booking)
+            old_counts = _booking_counts(booking)
             booking.status = Booking.deniedAuthorisation()       
             booking.setInformation("denied_reason", reason)
-            booking.put()
+            _save_booking(booking, old_counts)
 
     def allowBooking(self, account, acl, reservation):
         """Authorise the booking with the passed reservation"""
@@ -2862,8 +3114,9 @@ class EquipmentInfo(_db.StandardInfo):
                 raise BookingError("""You cannot authorise booking '%s' as it has already started.
                                       Please ask the user to cancel the booking and remake it.""" % reservation)
 
+            old_counts = _booking_counts(booking)
             booking.status = Booking.confirmed()
-            booking.put()
+            _save_booking(booking, old_counts)
 
     def getBookings(self, account, acl, start_time=None, end_time=None, status=Booking.confirmed()):
         """Get all future bookings of this piece of equipment"""
@@ -2877,40 +3130,47 @@ class EquipmentInfo(_db.StandardInfo):
         """Return all of the unresolved feedback about this piece of equipment"""
         return feedback.FeedBackInfo.getUnresolvedFeedBackForEquipment(self)
 
-    def getRequirements(self, create_if_nonexistant=False):
-        """Return the requirements that must be supplied by the user when booking
-           this equipment. Note that this grabs the requirements from the equipment
-           type if none have been specified"""
-        if self.requirements:
-            return EquipmentReqsInfo(reqs_id=self.requirements, registry=self._registry)
-        else:
-            reqs = self.getEquipmentType().getRequirements(self._registry)
+    def getUnresolvedFeedBack_async(self):
+        """Return a future for all of the unresolved feedback about this piece of equipment"""
+        return feedback.FeedBackInfo.getUnresolvedFeedBackForEquipment_async(self)
 
-            if reqs:
-                item = self._getFromDB()
-                requirements = reqs.duplicateAndStore(self._registry)
-                item.requirements = requirements.reqs_id
-                item.put()
+    @ndb.tasklet
+    def getRequirements_async(self, create_if_nonexistant=False):
+        """Return a future for the requirements returned by getRequirements. The
+           equipment type and then its requirements are fetched without blocking"""
+        if self.requirements:
+            reqs = yield get_equipment_requirements_async(self.requirements, self._registry)
+            raise ndb.Return(reqs)
 
-                self.requirements = requirements.reqs_id
+        typ = yield get_equipment_type_async(self.equipment_type)
 
-                return requirements
+        if typ:
+            reqs = yield typ.getRequirements_async(self._registry)
+        else:
+            reqs = None
 
-            elif create_if_nonexistant:
-                reqs = EquipmentReqs( parent=equipment_key(self._registry),
-                                      needs_authorisation=False )
-                reqs.put()
+        if reqs:
+            reqs._inherited_by = self
+            raise ndb.Return(reqs)
 
-                requirements = EquipmentReqsInfo(reqs)
+        elif create_if_nonexistant:
+            reqs = EquipmentReqsInfo(registry=self._registry)
+            reqs._registry = self._registry
+            reqs._CLASS = EquipmentReqs
+            reqs._inherited_by = self
+            raise ndb.Return(reqs)
 
-                item = self._getFromDB()
-                item.requirements = requirements.reqs_id
-                item.put()
+        else:
+            raise ndb.Return(None)
 
-                self.requirements = requirements.reqs_id
-                return reqs
-            else:
-                return None
+    def getRequirements(self, create_if_nonexistant=False):
+        """Return the requirements that must be supplied by the user when booking
+           this equipment. Note that this grabs the requirements from the equipment
+           type if none have been specified. This never writes to the datastore - 
+           inherited requirements are only copied to this equipment when they
+           are edited. If 'create_if_nonexistant' is true then empty, editable
+           requirements are returned if neither the equipment nor its type have any"""
+        return self.getRequirements_async(create_if_nonexistant).get_result()
 
     def getConstraints(self, create_if_nonexistant=False):
         """Return the booking constraints that apply at the time of booking this equipment"""
@@ -2929,6 +3189,10 @@ def get_equipment(idstring, registry=DEFAULT_EQUIPMENT_REGISTRY):
     """Return the piece of equipment matching the IDString 'idstring'"""
     return _db.get_item(Equipment, EquipmentInfo, idstring, registry)
 
+def get_equipment_async(idstring, registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return a future for the piece of equipment matching the IDString 'idstring'"""
+    return _db.get_item_async(Equipment, EquipmentInfo, idstring, registry)
+
 def get_booking(idstring, registry=DEFAULT_BOOKING_REGISTRY):
     """Return the booking matching the IDString 'idstring'"""
     return _db.get_item(Booking, BookingInfo, idstring, registry)
@@ -2937,13 +3201,31 @@ def list_equipment(sorted=True, equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
     """Return a list of all pieces of equipment"""
     return _db.list_items(Equipment, EquipmentInfo, equipment_registry, sorted)
 
-def get_equipment_dict(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
-    """Return a dictionary of all equipment indexed by ID"""
+def get_equipment_for_calendar(calendar_idstring, equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return the piece of equipment that uses the calendar with IDString 'calendar_idstring',
+       or None if no equipment uses this calendar"""
+    for equip in list_equipment(False, equipment_registry):
+        if equip.calendar == calendar_idstring:
+            return equip
+
+    return None
+
+def list_equipment_page(cursor=None, page_size=None, equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return the page of pieces of equipment that starts at 'cursor', ordered by IDString"""
+    return _db.list_items_page(Equipment, EquipmentInfo, equipment_registry, cursor, page_size)
+
+@ndb.tasklet
+def get_equipment_dict_async(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY, lazy=False):
+    """Return a future for the dictionary of all equipment indexed by ID"""
     d = {}
-    equips = list_equipment(False, equipment_registry)
+    equips = yield _db.list_items_async(Equipment, EquipmentInfo, equipment_registry, False, lazy)
     for equip in equips:
         d[equip.idstring] = equip
-    return d
+    raise ndb.Return(d)
+
+def get_equipment_dict(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY, lazy=False):
+    """Return a dictionary of all equipment indexed by ID"""
+    return get_equipment_dict_async(equipment_registry, lazy).get_result()
 
 def list_equipment_by_type(sorted=True, equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
     """Return a dictionary of all pieces of equipment, keyyed by equipment type"""
@@ -3065,6 +3347,18 @@ def get_sorted_laboratory_mapping(registry=DEFAULT_LABS_REGISTRY):
     """Return a sorted list of all laboratory names, together with their idstrings"""
     return _db.get_sorted_names_to_idstring(Laboratory,registry)
 
+def get_equipment_mapping_async(registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return a future for the dictionary mapping equipment ID strings to equipment names"""
+    return _db.get_idstring_to_name_db_async(Equipment, registry)
+
+def get_laboratory_mapping_async(registry=DEFAULT_LABS_REGISTRY):
+    """Return a future for the dictionary mapping laboratory ID strings to laboratory names"""
+    return _db.get_idstring_to_name_db_async(Laboratory, registry)
+
+def get_equipment_type_mapping_async(registry=DEFAULT_TYPES_REGISTRY):
+    """Return a future for the dictionary mapping equipment type ID strings to equipment type names"""
+    return _db.get_idstring_to_name_db_async(EquipmentType, registry)
+
 def changed_laboratory_info(registry=DEFAULT_LABS_REGISTRY):
     """Function called whenever lab info is changed"""
     memcache.set("lab_for_equip_mapping", None)
@@ -3137,47 +3431,55 @@ def get_equipment_hierarchy(registry=DEFAULT_EQUIPMENT_REGISTRY):
         memcache.set(key=k, value=lab_output)
         return lab_output
 
-def get_laboratory_for_equipment_mapping(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,labs_reg=DEFAULT_LABS_REGISTRY):
-    """Return a dictionary of the laboratories for each piece of equipment, 
-       indexed by piece of equipment"""
+@ndb.tasklet
+def get_laboratory_for_equipment_mapping_async(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,labs_reg=DEFAULT_LABS_REGISTRY):
+    """Return a future for the dictionary of (ID, name) of the laboratory of each piece
+       of equipment. The equipment query and the laboratory names are fetched together"""
     k = "lab_for_equip_mapping"
-    d = memcache.get(k)
+    ctx = ndb.get_context()
+    d = yield ctx.memcache_get(k)
 
-    if d:
-        return d
-    else:
+    if not d:
         d = {}
-        items = Equipment.getQuery(equip_reg).fetch()
-
-        labs_mapping = get_laboratory_mapping(labs_reg)
+        (items, labs_mapping) = yield ( Equipment.getQuery(equip_reg).fetch_async(),
+                              get_laboratory_mapping_async(labs_reg) )
 
         for item in items:
             d[unicode(item.key.string_id())] = (unicode(item.laboratory), unicode(labs_mapping[item.laboratory]))
 
-        memcache.set(key=k, value=d)
+        yield ctx.memcache_set(k, d)
 
-        return d
+    raise ndb.Return(d)
 
-def get_type_for_equipment_mapping(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,types_reg=DEFAULT_TYPES_REGISTRY):
-    """Return a dictionary of the equipment types for each piece of equipment, 
+def get_laboratory_for_equipment_mapping(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,labs_reg=DEFAULT_LABS_REGISTRY):
+    """Return a dictionary of the laboratories for each piece of equipment, 
        indexed by piece of equipment"""
+    return get_laboratory_for_equipment_mapping_async(equip_reg, labs_reg).get_result()
+
+@ndb.tasklet
+def get_type_for_equipment_mapping_async(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,types_reg=DEFAULT_TYPES_REGISTRY):
+    """Return a future for the dictionary of (ID, name) of the type of each piece of
+       equipment. The equipment query and the type names are fetched together"""
     k = "type_for_equip_mapping"
-    d = memcache.get(k)
+    ctx = ndb.get_context()
+    d = yield ctx.memcache_get(k)
 
-    if d:
-        return d
-    else:
+    if not d:
         d = {}
-        items = Equipment.getQuery(equip_reg).fetch()
-
-        types_mapping = get_equipment_type_mapping(types_reg)
+        (items, types_mapping) = yield ( Equipment.getQuery(equip_reg).fetch_async(),
+                              get_equipment_type_mapping_async(types_reg) )
 
         for item in items:
             d[unicode(item.key.string_id())] = (unicode(item.equipment_type), unicode(types_mapping[item.equipment_type]))
 
-        memcache.set(key=k, value=d)
+        yield ctx.memcache_set(k, d)
 
-        return d
+    raise ndb.Return(d)
+
+def get_type_for_equipment_mapping(equip_reg=DEFAULT_EQUIPMENT_REGISTRY,types_reg=DEFAULT_TYPES_REGISTRY):
+    """Return a dictionary of the equipment types for each piece of equipment, 
+       indexed by piece of equipment"""
+    return get_type_for_equipment_mapping_async(equip_reg, types_reg).get_result()
 
 def get_acl(equipment, email, registry=DEFAULT_ACLS_REGISTRY):
     """Return the ACL for the equipment with idstring 'equipment' for the 
@@ -3308,13 +3610,14 @@ def sort_times(start_time, end_time):
     else:
         return (start_time, end_time)
 
-def get_bookings_for_user(account, range_start=None, range_end=None, sorted=True,
-                          reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY):
-    """Return all bookings for the passed user. If range_start or range_end are specified then these
-       limit the ranges to only those bookings that include the passed times"""
+@ndb.tasklet
+def get_bookings_for_user_async(account, range_start=None, range_end=None, sorted=True,
+                                reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY, lazy=False):
+    """Return a future for the bookings of 'account' that overlap the range. Only one end
+       of a double range is used in the query, with the other end applied in memory"""
 
     if not account or not account.is_approved:
-        return None
+        raise ndb.Return(None)
 
     double_range=False
 
@@ -3326,7 +3629,7 @@ def get_bookings_for_user(account, range_start=None, range_end=None, sorted=True
             range_start = range_end
             range_end = tmp
         elif range_start == range_end:
-            return []
+            raise ndb.Return([])
 
     query = Booking.getQuery(registry).filter(Booking.user==account.email)
 
@@ -3335,28 +3638,41 @@ def get_bookings_for_user(account, range_start=None, range_end=None, sorted=True
     elif range_end:
         query = query.filter( Booking.end_time <= range_end )
 
-    items = query.fetch()
+    items = yield query.fetch_async()
+
+    if lazy:
+        convert = BookingView
+    else:
+        convert = BookingInfo
 
     bookings = []
 
     if double_range:
         for item in items:
             if item.end_time <= range_end:
-                bookings.append( BookingInfo(item) )
+                bookings.append( convert(item) )
     else:
         for item in items:
-            bookings.append( BookingInfo(item) )
+            bookings.append( convert(item) )
 
     if sorted:
         bookings.sort(key=lambda x: x.start_time, reverse=reverse_sort)
 
-    return bookings
+    raise ndb.Return(bookings)
 
-def get_bookings(equipment=None, start_time=None, end_time=None, status=None, 
-                 sorted=True, reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY):
-    """Return all bookings for the passed piece of equipment between 'start_time' and "end_time.
-       If 'equipment' is None, then this returns the bookings for all equipment. If 'start_time'
-       or 'end_time' are None then they default to the beginning or end of time."""
+def get_bookings_for_user(account, range_start=None, range_end=None, sorted=True,
+                          reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY, lazy=False):
+    """Return all bookings for the passed user. If range_start or range_end are specified then these
+       limit the ranges to only those bookings that include the passed times. If 'lazy' is true
+       then the bookings are returned as read-only BookingView objects"""
+    return get_bookings_for_user_async(account, range_start, range_end, sorted, 
+                                       reverse_sort, registry, lazy).get_result()
+
+@ndb.tasklet
+def get_bookings_async(equipment=None, start_time=None, end_time=None, status=None, 
+                       sorted=True, reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY, lazy=False):
+    """Return a future for the bookings of 'equipment' (or of all equipment), optionally
+       with only the passed status, that overlap the range from start_time to end_time"""
 
     if equipment:
         try:
@@ -3381,33 +3697,116 @@ def get_bookings(equipment=None, start_time=None, end_time=None, status=None,
             start_time = end_time
             end_time = tmp
         elif start_time == end_time:
-            return []
+            raise ndb.Return([])
 
     if start_time:
         query = query.filter( Booking.end_time > start_time )
     elif end_time:
         query = query.filter( Booking.start_time <= end_time )
 
-    items = query.fetch()
+    items = yield query.fetch_async()
+
+    if lazy:
+        convert = BookingView
+    else:
+        convert = BookingInfo
 
     bookings = []
 
     if double_range:
         for item in items:
             if item.start_time <= end_time:
-                bookings.append( BookingInfo(item) )
+                bookings.append( convert(item) )
     else:
         for item in items:
-            bookings.append( BookingInfo(item) )
+            bookings.append( convert(item) )
 
     if sorted:
         bookings.sort(key=lambda x: x.start_time, reverse=reverse_sort)
 
-    return bookings
+    raise ndb.Return(bookings)
+
+def get_bookings(equipment=None, start_time=None, end_time=None, status=None, 
+                 sorted=True, reverse_sort=False, registry=DEFAULT_BOOKING_REGISTRY, lazy=False):
+    """Return all bookings for the passed piece of equipment between 'start_time' and "end_time.
+       If 'equipment' is None, then this returns the bookings for all equipment. If 'start_time'
+       or 'end_time' are None then they default to the beginning or end of time. If 'lazy' is
+       true then the bookings are returned as read-only BookingView objects"""
+    return get_bookings_async(equipment, start_time, end_time, status, sorted, 
+                              reverse_sort, registry, lazy).get_result()
+
+def _booking_counts(booking):
+    """Return the dictionary of counters to which the passed booking contributes"""
+    if not booking:
+        return {}
+
+    registry = _db.logical_registry(booking.key.root().string_id())
+
+    return { "%s:total" % registry : 1,
+             "%s:status_%d" % (registry,booking.status) : 1 }
+
+def _save_booking(booking, old_counts):
+    """Save the passed booking, updating the booking counters in the same transaction.
+       'old_counts' are the counts for the booking before it was changed"""
+    counters.commit( puts=[booking], changes=counters.differences(old_counts, _booking_counts(booking)) )
+
+    # update the calendar feeds that show this booking
+    import ical
+    ical.booking_changed(booking)
+
+    # replace the cached reports, which may include this booking
+    import reports
+    reports.bookings_changed(_db.logical_registry(booking.key.root().string_id()))
+
+@ndb.tasklet
+def reconcile_equipment_counters_async(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return a future that completes once the equipment has been recounted
+       and the equipment counter reset"""
+    count = yield Equipment.getQuery(equipment_registry).count_async()
+    yield counters.set_counts_async( {"%s:total" % equipment_registry : count} )
+
+def reconcile_equipment_counters(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Recount all of the equipment and reset the equipment counter"""
+    reconcile_equipment_counters_async(equipment_registry).get_result()
+
+@ndb.tasklet
+def reconcile_booking_counters_async(bookings_registry=DEFAULT_BOOKING_REGISTRY):
+    """Return a future that completes once the bookings have been recounted and
+       the booking counters reset. The total and the count for each status are
+       run as concurrent count queries"""
+    statuses = [Booking.cancelled(), Booking.reserved(), Booking.confirmed(),
+                Booking.pendingAuthorisation(), Booking.deniedAuthorisation()]
+
+    names = [ "%s:total" % bookings_registry ]
+    queries = [ Booking.getQuery(bookings_registry) ]
+
+    for status in statuses:
+        names.append( "%s:status_%d" % (bookings_registry,status) )
+        queries.append( Booking.getQuery(bookings_registry).filter(Booking.status == status) )
+
+    totals = yield [ query.count_async() for query in queries ]
+
+    yield counters.set_counts_async( dict(zip(names, totals)) )
+
+def reconcile_booking_counters(bookings_registry=DEFAULT_BOOKING_REGISTRY):
+    """Recount all of the bookings and reset the booking counters"""
+    reconcile_booking_counters_async(bookings_registry).get_result()
+
+def reconcile_counters(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY,
+                       bookings_registry=DEFAULT_BOOKING_REGISTRY):
+    """Recount all of the equipment and bookings and reset their counters"""
+    reconcile_equipment_counters(equipment_registry)
+    reconcile_booking_counters(bookings_registry)
 
 def number_of_equipment(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
     """Function to return the total number pieces of equipment"""
-    return _db.number_of_items(Equipment, equipment_registry)
+    return counters.get_count( "%s:total" % equipment_registry,
+                               lambda: reconcile_equipment_counters_async(equipment_registry) )
+
+def number_of_equipment_async(equipment_registry=DEFAULT_EQUIPMENT_REGISTRY):
+    """Return a future for the total number pieces of equipment"""
+    return counters.get_count_async( "%s:total" % equipment_registry,
+                                     lambda: reconcile_equipment_counters_async(equipment_registry) )
 
 def number_of_equipment_types(equipment_type_registry=DEFAULT_TYPES_REGISTRY):
     """Function to return the total number types of equipment"""
@@ -3419,7 +3818,18 @@ def number_of_laboratories(labs_registry=DEFAULT_LABS_REGISTRY):
 
 def number_of_bookings(bookings_registry=DEFAULT_BOOKING_REGISTRY):
     """Function to return the total number of bookings"""
-    return _db.number_of_items(Booking, bookings_registry)
+    return counters.get_count( "%s:total" % bookings_registry,
+                               lambda: reconcile_booking_counters_async(bookings_registry) )
+
+def number_of_bookings_async(bookings_registry=DEFAULT_BOOKING_REGISTRY):
+    """Return a future for the total number of bookings"""
+    return counters.get_count_async( "%s:total" % bookings_registry,
+                                     lambda: reconcile_booking_counters_async(bookings_registry) )
+
+def number_of_bookings_with_status(status, bookings_registry=DEFAULT_BOOKING_REGISTRY):
+    """Function to return the number of bookings with the passed status"""
+    return counters.get_count( "%s:status_%d" % (bookings_registry,status),
+                               lambda: reconcile_booking_counters_async(bookings_registry) )
 
 def get_sorted_equipment_for_account(account):
     """Return all of the equipment IDstrings associated with the account 'account', sorted
@@ -3519,7 +3929,7 @@ def add_equipment(account, item_name, item_type, item_lab, registry=DEFAULT_EQUI
                           name = item_name,
                           equipment_type = item_type,
                           laboratory = item_lab )                          
-        item.put()
+        counters.commit( puts=[item], changes={"%s:total" % registry : 1} )
 
         changed_equipment_info(registry)
 
@@ -3551,7 +3961,7 @@ def delete_equipment(account, idstring, registry=DEFAULT_EQUIPMENT_REGISTRY):
             # we don't need this calendar any more
             calendar.delete_calendar(account, item.calendar)
 
-        item.key.delete()
+        counters.commit( deletes=[item.key], changes={"%s:total" % registry : -1} )
 
         changed_equipment_info(registry)
 
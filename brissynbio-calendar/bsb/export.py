@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the CSV export of the bookings. The bookings are read one page
+   at a time using query cursors, and each page is written as CSV before the next
+   is read, so the memory used does not depend on the size of the range. Exports
+   can either be streamed straight to the response, or (for long ranges) generated
+   by a background task into a file that is saved in chunks and downloaded later"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import taskqueue
+
+import cStringIO
+import csv
+import datetime
+import zlib
+
+from bsb import *
+
+import accounts
+import equipment
+import projects
+
+# The default registry of the generated export files
+DEFAULT_EXPORT_REGISTRY = "bsb.export.exports"
+
+# The number of bookings read from the datastore in each page
+EXPORT_PAGE_SIZE = 500
+
+# The number of pages written by each run of the export task
+PAGES_PER_TASK = 20
+
+# The path of the task that generates the export files
+EXPORT_TASK_PATH = "/tasks/export_bookings"
+
+# Generated export files are deleted once they are older than this
+EXPORT_LIFETIME = datetime.timedelta(days=7)
+
+# The columns of the CSV file
+CSV_COLUMNS = [ "booking_id", "equipment_id", "equipment", "equipment_type", "laboratory",
+                "email", "user", "project_id", "project", "status",
+                "start_time_utc", "end_time_utc", "start_time_local", "end_time_local",
+                "duration_minutes", "booking_time_utc" ]
+
+STATUS_NAMES = { equipment.Booking.cancelled() : "cancelled",
+                 equipment.Booking.reserved() : "reserved",
+                 equipment.Booking.confirmed() : "confirmed",
+                 equipment.Booking.pendingAuthorisation() : "pending authorisation",
+                 equipment.Booking.deniedAuthorisation() : "denied authorisation" }
+
+class ExportError(SchedulerError):
+    pass
+
+def export_filename(range_start, range_end, compress=False):
+    """Return the name of the file holding the export of the passed range"""
+    name = "bookings_%s_%s.csv" % (range_start.strftime("%Y%m%d") if range_start else "start",
+                                   range_end.strftime("%Y%m%d") if range_end else "end")
+
+    if compress:
+        name += ".gz"
+
+    return name
+
+def exports_key(registry=DEFAULT_EXPORT_REGISTRY):
+    """Construct the Datastore key for the generated export files"""
+    return ndb.Key("BookingExports", registry)
+
+class BookingExport(ndb.Model):
+    """A generated export file. The CSV is held in ExportChunk children of this entity"""
+    owner = ndb.StringProperty(indexed=False)
+    created = ndb.DateTimeProperty(indexed=True, auto_now_add=True)
+
+    # the parameters of the export
+    range_start = ndb.DateTimeProperty(indexed=False)
+    range_end = ndb.DateTimeProperty(indexed=False)
+    equipment = ndb.StringProperty(indexed=False)
+    status = ndb.IntegerProperty(indexed=False)
+    compress = ndb.BooleanProperty(indexed=False, default=False)
+
+    # the cursor of the next page of bookings to export
+    cursor = ndb.StringProperty(indexed=False)
+
+    is_complete = ndb.BooleanProperty(indexed=False, default=False)
+    num_rows = ndb.IntegerProperty(indexed=False, default=0)
+    num_chunks = ndb.IntegerProperty(indexed=False, default=0)
+    size = ndb.IntegerProperty(indexed=False, default=0)
+
+    def exportID(self):
+        return self.key.integer_id()
+
+    def filename(self):
+        return export_filename(self.range_start, self.range_end, self.compress)
+
+    @classmethod
+    def getQuery(cls, registry=DEFAULT_EXPORT_REGISTRY):
+        return cls.query(ancestor=exports_key(registry))
+
+    @classmethod
+    def ancestor(cls, registry=DEFAULT_EXPORT_REGISTRY):
+        return exports_key(registry)
+
+class ExportChunk(ndb.Model):
+    """One chunk of a generated export file. The key is the index of the chunk"""
+    data = ndb.BlobProperty(indexed=False)
+
+class _Names(object):
+    """The names joined into each row, read once per export from the cached mappings"""
+    def __init__(self):
+        (self.accounts, self.equipment, self.projects, self.labs, self.types) = \
+                 [ future.get_result() for future in
+                     ( accounts.get_account_mapping_async(),
+                       equipment.get_equipment_mapping_async(),
+                       projects.get_project_mapping_async(),
+                       equipment.get_laboratory_for_equipment_mapping_async(),
+                       equipment.get_type_for_equipment_mapping_async() ) ]
+
+def _to_utf8(value):
+    if value is None:
+        return ""
+    elif isinstance(value, unicode):
+        return value.encode("utf-8")
+    else:
+        return str(value)
+
+def _format_time(t):
+    if t is None:
+        return ""
+    else:
+        return t.strftime("%Y-%m-%d %H:%M")
+
+def _row(item, names):
+    """Return the CSV row for the passed Booking"""
+    equip = item.equipment()
+    duration = (item.end_time - item.start_time).total_seconds() / 60.0
+
+    return [ _to_utf8(value) for value in
+               [ item.bookingID(), equip, names.equipment.get(equip), names.types.get(equip, (None,None))[1],
+                 names.labs.get(equip, (None,None))[1], item.user, names.accounts.get(item.user),
+                 item.project, names.projects.get(item.project), STATUS_NAMES.get(item.status, item.status),
+                 _format_time(item.start_time), _format_time(item.end_time),
+                 _format_time(localise_time(item.start_time)), _format_time(localise_time(item.end_time)),
+                 "%.0f" % duration, _format_time(item.booking_time) ] ]
+
+def _to_csv(rows):
+    """Return the passed rows written as CSV"""
+    buf = cStringIO.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def _end_bound(range_end):
+    """Return the exclusive bound on the start time of the bookings in an export
+       that ends on the day 'range_end', so that bookings on that day are included"""
+    if range_end:
+        return range_end + datetime.timedelta(days=1)
+    else:
+        return None
+
+def _query(range_start, range_end, equipment_idstring, status, registry):
+    """Return the query for the bookings that end after the start of the day 'range_start'
+       (or, if there is no start, that start before the end of the day 'range_end').
+       Only one property can have an inequality filter, so bookings are also checked
+       against 'range_end' as they are read. The bookings are ordered by the filtered
+       time so that the same query can be resumed from a cursor"""
+    if equipment_idstring:
+        query = equipment.Booking.getEquipmentQuery(equipment_idstring, registry)
+    else:
+        query = equipment.Booking.getQuery(registry)
+
+    if status is not None:
+        query = query.filter(equipment.Booking.status == status)
+
+    if range_start:
+        query = query.filter(equipment.Booking.end_time > range_start)
+    elif range_end:
+        query = query.filter(equipment.Booking.start_time < _end_bound(range_end))
+        return query.order(equipment.Booking.start_time, equipment.Booking.key)
+
+    return query.order(equipment.Booking.end_time, equipment.Booking.key)
+
+def _fetch_rows(query, cursor, range_end, names, page_size=EXPORT_PAGE_SIZE):
+    """Read the page of bookings starting at 'cursor', returning the tuple
+       (rows, cursor of the next page or None if this was the last page).
+       Only bookings that start before the end of the day 'range_end' are included"""
+    # the bookings are not added to the context cache, as that would keep every page in memory
+    (items, next_cursor, more) = query.fetch_page(page_size, start_cursor=cursor,
+                                                  use_cache=False, use_memcache=False)
+
+    end_bound = _end_bound(range_end)
+    rows = []
+
+    for item in items:
+        if end_bound is None or item.start_time < end_bound:
+            rows.append( _row(item, names) )
+
+    if more and next_cursor:
+        return (rows, next_cursor)
+    else:
+        return (rows, None)
+
+def _gzip(chunks):
+    """Compress the passed CSV chunks as a single gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+def _iter_csv(range_start, range_end, equipment_idstring, status, registry):
+    names = _Names()
+    query = _query(range_start, range_end, equipment_idstring, status, registry)
+
+    yield _to_csv([CSV_COLUMNS])
+
+    cursor = None
+
+    while True:
+        (rows, cursor) = _fetch_rows(query, cursor, range_end, names)
+
+        if rows:
+            yield _to_csv(rows)
+
+        if cursor is None:
+            break
+
+def stream_bookings(account, range_start=None, range_end=None, equipment_idstring=None, status=None,
+                    compress=False, registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Return a generator of the chunks of the CSV export of the bookings that overlap
+       the days 'range_start' to 'range_end' (inclusive), optionally only of one piece of equipment or with
+       one status. If 'compress' is true then the chunks are of a gzip file"""
+    assert_is_admin(account, "Only administrators can export the bookings")
+
+    chunks = _iter_csv(range_start, range_end, equipment_idstring, status, registry)
+
+    if compress:
+        chunks = _gzip(chunks)
+
+    return chunks
+
+def start_export(account, range_start=None, range_end=None, equipment_idstring=None, status=None,
+                 compress=False, registry=DEFAULT_EXPORT_REGISTRY):
+    """Start generating an export file of the bookings in the background, returning
+       the BookingExport. This is used for ranges too large to stream in one request"""
+    assert_is_admin(account, "Only administrators can export the bookings")
+
+    delete_old_exports(account, registry)
+
+    export = BookingExport(parent=exports_key(registry), owner=account.email,
+                           range_start=range_start, range_end=range_end,
+                           equipment=equipment_idstring, status=status, compress=compress)
+    export.put()
+
+    queue_export(export.exportID(), registry)
+
+    return export
+
+def queue_export(export_id, registry=DEFAULT_EXPORT_REGISTRY):
+    """Queue the task that writes the next pages of the passed export"""
+    taskqueue.add(url=EXPORT_TASK_PATH, params={"export" : export_id, "registry" : registry})
+
+def run_export(export_id, registry=DEFAULT_EXPORT_REGISTRY,
+               bookings_registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Write up to PAGES_PER_TASK pages of the passed export, one chunk per page, queueing
+       another run if there are more pages. Each chunk is saved in the same transaction
+       as the cursor, so a retried run never writes a page twice. Returns the BookingExport"""
+    key = ndb.Key(BookingExport, int(export_id), parent=exports_key(registry))
+    export = key.get()
+
+    if not export or export.is_complete:
+        return export
+
+    names = _Names()
+    query = _query(export.range_start, export.range_end, export.equipment, export.status, bookings_registry)
+
+    for i in range(0, PAGES_PER_TASK):
+        cursor = ndb.Cursor(urlsafe=export.cursor) if export.cursor else None
+        (rows, cursor) = _fetch_rows(query, cursor, export.range_end, names)
+        export.num_rows += len(rows)
+
+        if export.num_chunks == 0:
+            rows.insert(0, CSV_COLUMNS)
+
+        data = _to_csv(rows)
+
+        if export.compress:
+            # each chunk is a separate gzip member. Concatenated members are a valid gzip file
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+
+        chunk = ExportChunk(key=ndb.Key(ExportChunk, export.num_chunks + 1, parent=key), data=data)
+
+        export.num_chunks += 1
+        export.size += len(data)
+
+        if cursor:
+            export.cursor = cursor.urlsafe()
+        else:
+            export.cursor = None
+            export.is_complete = True
+
+        ndb.transaction(lambda: ndb.put_multi([export, chunk]))
+
+        if export.is_complete:
+            return export
+
+    queue_export(export_id, registry)
+
+    return export
+
+def get_export(account, export_id, registry=DEFAULT_EXPORT_REGISTRY):
+    """Return the BookingExport with the passed ID, or None if there is no such export"""
+    assert_is_admin(account, "Only administrators can export the bookings")
+
+    try:
+        return ndb.Key(BookingExport, int(export_id), parent=exports_key(registry)).get()
+    except ValueError:
+        return None
+
+def list_exports(account, registry=DEFAULT_EXPORT_REGISTRY):
+    """Return all of the generated export files, newest first"""
+    assert_is_admin(account, "Only administrators can export the bookings")
+
+    return BookingExport.getQuery(registry).order(-BookingExport.created).fetch()
+
+def iter_export(account, export_id, registry=DEFAULT_EXPORT_REGISTRY):
+    """Return a generator of the chunks of the passed generated export file. The chunks
+       are read one at a time. Raises ExportError if the file is not complete"""
+    export = get_export(account, export_id, registry)
+
+    if not export:
+        raise ExportError("There is no export with ID '%s'" % export_id)
+
+    if not export.is_complete:
+        raise ExportError("The export '%s' has not finished yet" % export_id)
+
+    # the chunks are not cached, so that only one is held in memory at a time
+    def _chunks():
+        for i in range(1, export.num_chunks+1):
+            chunk = ndb.Key(ExportChunk, i, parent=export.key).get(use_cache=False, use_memcache=False)
+
+            if chunk:
+                yield chunk.data
+
+    return (export, _chunks())
+
+def delete_export(account, export_id, registry=DEFAULT_EXPORT_REGISTRY):
+    """Delete the passed generated export file"""
+    export = get_export(account, export_id, registry)
+
+    if export:
+        keys = ExportChunk.query(ancestor=export.key).fetch(keys_only=True)
+        ndb.delete_multi(keys + [export.key])
+
+def delete_old_exports(account, registry=DEFAULT_EXPORT_REGISTRY):
+    """Delete the generated export files that are older than EXPORT_LIFETIME"""
+    assert_is_admin(account, "Only administrators can export the bookings")
+
+    oldest = get_now_time() - EXPORT_LIFETIME
+
+    for key in BookingExport.getQuery(registry).filter(BookingExport.created < oldest).fetch(keys_only=True):
+        delete_export(account, key.integer_id(), registry)
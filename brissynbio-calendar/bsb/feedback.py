@@ -4,6 +4,7 @@
 
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 
 # cgi module
 import cgi
@@ -14,9 +15,15 @@ import datetime
 # to get a traceback from an exception
 import traceback
 
+# used to fingerprint bugs
+import hashlib
+
 # regular expression module used to validate user account details
 import re
 
+# used to schedule the flush of buffered bug occurrences
+import time
+
 # import the bsb module
 from bsb import *
 import bsb
@@ -33,18 +40,104 @@ DEFAULT_BUGS_REGISTRY = "bsb.equipment.bugs"
 # The default registry for feedback
 DEFAULT_FEEDBACK_REGISTRY = "bsb.equipment.feedback"
 
+# The maximum number of sample occurrences that are kept for each bug
+MAX_BUG_SAMPLES = 10
+
+# Occurrences of an already-recorded bug are only written to the datastore
+# at most once in this many seconds. Occurrences in between are buffered
+# in memcache and are added on to the next write
+BUG_FLUSH_INTERVAL = 60
+
+# The path of the task that writes the buffered occurrences of a bug. This is
+# queued when an occurrence is buffered, so the tail of a burst is always written
+BUG_FLUSH_TASK_PATH = "/tasks/flush_bug"
+
 def bugs_key(registry=DEFAULT_BUGS_REGISTRY):
     """Constructs a Datastore key for a bug entry."""
-    return ndb.Key('Bug', registry)
+    return ndb.Key('Bug', _db.registry(registry))
 
 def feedback_key(registry=DEFAULT_FEEDBACK_REGISTRY):
     """Constructs a Datastore key for a feedback entry"""
-    return ndb.Key('Feedback', registry)
+    return ndb.Key('Feedback', _db.registry(registry))
+
+class BugSample(ndb.Model):
+    """A single occurrence of a bug"""
+
+    """The time of the occurrence"""
+    report_time = ndb.DateTimeProperty(indexed=False, auto_now_add=False, auto_now=False)
+
+    """The user who triggered the occurrence"""
+    email = ndb.StringProperty(indexed=False)
+
+    """The simple description of this occurrence"""
+    description = ndb.StringProperty(indexed=False)
+
+    """The detailed description of this occurrence"""
+    detail = ndb.StringProperty(indexed=False)
+
+class BugSampleInfo:
+    """Simple class to hold a sample occurrence of a bug"""
+    def __init__(self, sample):
+        self.report_time = sample.report_time
+        self.email = unicode(sample.email) if sample.email else None
+        self.description = unicode(sample.description) if sample.description else None
+        self.detail = unicode(sample.detail) if sample.detail else None
+
+_re_bug_line = re.compile(r", line \d+")
+_re_bug_address = re.compile(r"0x[0-9a-fA-F]+")
+
+def _normalise_backtrace(backtrace):
+    """Return the normalised form of the passed backtrace, in which only the
+       stack frames remain, with their line numbers, memory addresses and 
+       deployment-specific paths removed"""
+    if not backtrace:
+        return ""
+
+    frames = []
+
+    for line in backtrace.split("\n"):
+        if not line.lstrip().startswith("File "):
+            continue
+
+        line = _re_bug_line.sub("", line.strip())
+        line = _re_bug_address.sub("0x", line)
+
+        # only keep the filename, as the path changes with every deployment
+        parts = line.split('"')
+        if len(parts) > 2:
+            parts[1] = parts[1].replace("\\","/").split("/")[-1]
+            line = '"'.join(parts)
+
+        frames.append(line)
+
+    return "\n".join(frames)
 
-class Bug(ndb.Model):
-    """The time when the bug was reported"""
+def bug_fingerprint(etype, backtrace):
+    """Return the fingerprint of a bug with exception type 'etype' and the
+       passed backtrace. Bugs with the same fingerprint are the same bug"""
+    data = "%s\n%s" % (etype, _normalise_backtrace(backtrace))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+def _fingerprint_to_id(fingerprint):
+    """Return the (positive, 60 bit) integer ID of the Bug with the passed fingerprint"""
+    return int(fingerprint[0:15], 16) or 1
+
+class Bug(_db.TrackedModel):
+    """The time when the bug was last reported"""
     report_time = ndb.DateTimeProperty(indexed=True, auto_now_add=False, auto_now=False)
 
+    """The time when the bug was first reported"""
+    first_seen = ndb.DateTimeProperty(indexed=False, auto_now_add=False, auto_now=False)
+
+    """The fingerprint of the bug (exception type plus normalised backtrace)"""
+    fingerprint = ndb.StringProperty(indexed=False)
+
+    """The number of times that this bug has occurred"""
+    occurrences = ndb.IntegerProperty(indexed=False, default=1)
+
+    """A capped sample of the most recent occurrences of the bug"""
+    samples = ndb.StructuredProperty(BugSample, repeated=True, indexed=False)
+
     """The class type of the exception"""
     etype = ndb.StringProperty(indexed=True)
 
@@ -71,6 +164,26 @@ class Bug(ndb.Model):
         self.description = info.description
         self.detail = info.detail
         self.backtrace = info.backtrace
+        self.first_seen = info.first_seen
+        self.fingerprint = info.fingerprint
+        self.occurrences = info.occurrences
+
+    def addOccurrences(self, count, sample):
+        """Record 'count' more occurrences of this bug, the latest of which is 'sample'.
+           The sample may be None if it was lost from memcache, in which case only
+           the number of occurrences is updated"""
+        self.occurrences = (self.occurrences or 1) + count
+
+        if sample is None:
+            return
+
+        self.report_time = sample.report_time
+        self.description = sample.description
+        self.detail = sample.detail
+
+        samples = list(self.samples or [])
+        samples.append(sample)
+        self.samples = samples[-MAX_BUG_SAMPLES:]
 
     def bugID(self):
         return self.key.integer_id()
@@ -93,6 +206,10 @@ class BugInfo:
         self.description = None
         self.detail = None
         self.backtrace = None
+        self.first_seen = None
+        self.fingerprint = None
+        self.occurrences = 1
+        self.samples = []
         self.bug_id = None
 
         if bug_id:
@@ -126,6 +243,21 @@ class BugInfo:
             if bug.backtrace:
                 self.backtrace = unicode(bug.backtrace)
 
+            if bug.first_seen:
+                self.first_seen = bug.first_seen
+            else:
+                self.first_seen = self.report_time
+
+            if bug.fingerprint:
+                self.fingerprint = unicode(bug.fingerprint)
+
+            if bug.occurrences:
+                self.occurrences = bug.occurrences
+
+            if bug.samples:
+                self.samples = [ BugSampleInfo(sample) for sample in bug.samples ]
+                self.samples.reverse()
+
             self._CLASS = Bug
             self._registry = registry
             self.bug_id = bug.bugID()
@@ -221,9 +353,40 @@ class BugInfo:
                item.put()
                self.user_info = item.user_info
 
+    @classmethod
+    def _recordOccurrences(cls, key, fingerprint, etype, backtrace, sample, count):
+        """Transactionally add 'count' occurrences of the bug with key 'key',
+           creating the bug if this is the first time it has been seen"""
+        def _txn():
+            bug = key.get()
+
+            if bug:
+                bug.addOccurrences(count, sample)
+            elif sample is None:
+                # there is nothing to describe the bug
+                return None
+            else:
+                bug = Bug( key=key, 
+                           report_time=sample.report_time,
+                           first_seen=sample.report_time,
+                           fingerprint=fingerprint,
+                           etype=etype,
+                           email=sample.email,
+                           description=sample.description,
+                           detail=sample.detail,
+                           backtrace=backtrace,
+                           occurrences=count,
+                           samples=[sample] )
+            bug.put()
+            return bug
+
+        return ndb.transaction(_txn)
+
     @classmethod
     def createFromError(cls, account, error, backtrace, registry=DEFAULT_BUGS_REGISTRY):
-        """Create a new record for the passed error"""
+        """Record an occurrence of the passed error. Errors are grouped into bugs
+           by their fingerprint, so that a burst of the same error results in 
+           only one write to the datastore per BUG_FLUSH_INTERVAL"""
         if not account:
             return
 
@@ -233,48 +396,131 @@ class BugInfo:
         if not error:
             return
 
-        bug = Bug( parent=bugs_key(registry),
-                   report_time=bsb.get_now_time(no_timezone=True),
-                   email=account.email )
+        sample = BugSample( report_time=bsb.get_now_time(no_timezone=True),
+                            email=account.email )
+
+        etype = None
 
         try:
-            bug.etype = str(error.__class__.__name__)
+            etype = str(error.__class__.__name__)
         except:
             pass
 
         backtrace = to_string(backtrace)
-        
-        if backtrace:
-            bug.backtrace = backtrace
 
         try:
-            bug.description = error.errorMessage()
+            sample.description = error.errorMessage()
         except:
             try:
-                bug.description = error.message()
+                sample.description = error.message()
             except:
-                bug.description = str(error)
+                sample.description = str(error)
 
         lines = []
 
         try:
-            if e.json:
-                lines.append("JSON\n%s" % e.json)
+            if error.json:
+                lines.append("JSON\n%s" % error.json)
         except:
             pass
 
         try:
-            if e.detail:
-                lines.append("DETAIL\n%s" % e.detail)
+            if error.detail:
+                lines.append("DETAIL\n%s" % error.detail)
         except:
             pass
 
         if len(lines) > 0:
-            bug.detail = "\n\n".join(lines)
-
-        bug.put()
-
-        return BugInfo(bug)
+            sample.detail = "\n\n".join(lines)
+
+        fingerprint = bug_fingerprint(etype, backtrace)
+        bug_id = _fingerprint_to_id(fingerprint)
+        key = ndb.Key(Bug, bug_id, parent=bugs_key(registry))
+
+        (pending_key, latest_key) = _buffer_keys(registry, fingerprint)
+        pending = memcache.incr(pending_key, initial_value=0)
+
+        if pending is None:
+            # memcache is not available, so write this occurrence directly
+            return BugInfo( cls._recordOccurrences(key, fingerprint, etype, backtrace, sample, 1), 
+                            registry=registry )
+
+        if not memcache.add("bug_flush_%s_%s" % (registry, fingerprint), 1, time=BUG_FLUSH_INTERVAL):
+            # this bug was written recently - buffer this occurrence until the next flush
+            memcache.set(latest_key, { "etype" : etype, "backtrace" : backtrace, "sample" : sample })
+            _queue_flush(fingerprint, registry)
+
+            info = BugInfo(registry=registry)
+            info.bug_id = bug_id
+            info.fingerprint = fingerprint
+            info.etype = etype
+            info.email = sample.email
+            info.report_time = sample.report_time
+            info.description = sample.description
+            info.detail = sample.detail
+            info.backtrace = backtrace
+            info._CLASS = Bug
+            info._registry = registry
+            return info
+
+        # this occurrence is included in the buffered count
+        pending = _take_pending(pending_key) or 1
+
+        return BugInfo( cls._recordOccurrences(key, fingerprint, etype, backtrace, sample, pending),
+                        registry=registry )
+
+def _buffer_keys(registry, fingerprint):
+    """Return the memcache keys of the number of buffered occurrences of a bug,
+       and of the latest buffered occurrence"""
+    return ("bug_pending_%s_%s" % (registry, fingerprint),
+            "bug_latest_%s_%s" % (registry, fingerprint))
+
+def _take_pending(pending_key):
+    """Return the number of buffered occurrences, resetting it to zero in the same
+       step, so that two flushes can never both write the same occurrences"""
+    client = memcache.Client()
+
+    for i in range(0, 10):
+        pending = client.gets(pending_key)
+
+        if not pending:
+            return 0
+
+        if client.cas(pending_key, 0):
+            return pending
+
+    return 0
+
+def _queue_flush(fingerprint, registry):
+    """Queue the task that writes the buffered occurrences of the bug at the end of
+       the current flush interval. The task is named, so it is only queued once for
+       each interval, however many occurrences are buffered"""
+    bucket = int(time.time()) // BUG_FLUSH_INTERVAL + 1
+    name = "flush-bug-%s-%s-%d" % (hashlib.sha1(registry).hexdigest()[0:8], fingerprint, bucket)
+
+    try:
+        taskqueue.add(url=BUG_FLUSH_TASK_PATH, name=name,
+                      params={ "fingerprint" : fingerprint, "registry" : registry },
+                      countdown=max(0, bucket * BUG_FLUSH_INTERVAL - time.time()))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def flush_bug(fingerprint, registry=DEFAULT_BUGS_REGISTRY):
+    """Write the occurrences of the bug with the passed fingerprint that have been
+       buffered in memcache. Returns the number of occurrences written"""
+    (pending_key, latest_key) = _buffer_keys(registry, fingerprint)
+    pending = _take_pending(pending_key)
+
+    if not pending:
+        return 0
+
+    latest = memcache.get(latest_key) or {}
+    key = ndb.Key(Bug, _fingerprint_to_id(fingerprint), parent=bugs_key(registry))
+
+    BugInfo._recordOccurrences(key, fingerprint, latest.get("etype"), latest.get("backtrace"),
+                               latest.get("sample"), pending)
+
+    return pending
 
 def get_bugs(account, range_start=None, range_end=None, view_user=None,
              sorted=True, reverse_sort=True, registry=DEFAULT_BUGS_REGISTRY):
@@ -334,10 +580,12 @@ def get_bugs(account, range_start=None, range_end=None, view_user=None,
     return bugs
 
 def get_feedback(account, range_start=None, range_end=None, 
-                 sorted=True, reverse_sort=True, topic_mask=None, registry=DEFAULT_FEEDBACK_REGISTRY):
+                 sorted=True, reverse_sort=True, topic_mask=None, registry=DEFAULT_FEEDBACK_REGISTRY,
+                 lazy=False):
     """Return all of the user feedback that has been submitted between 'range_start'
        and 'range_end'. These will default to the beginning and end of time
-       if they are not specified"""
+       if they are not specified. If 'lazy' is true then the feedback is 
+       returned as read-only FeedBackView objects"""
 
     assert_is_approved(account, "Only approved accounts can view all of the feedback in the system!")
 
@@ -374,21 +622,185 @@ def get_feedback(account, range_start=None, range_end=None,
 
     items = query.fetch()
 
+    if lazy:
+        convert = FeedBackView
+    else:
+        convert = FeedBackInfo
+
     feedbacks = []
 
     if double_range:
         for item in items:
             if item.last_access_time <= range_end:
-                feedbacks.append( FeedBackInfo(item) )
+                feedbacks.append( convert(item) )
     else:
         for item in items:
-            feedbacks.append( FeedBackInfo(item) )
+            feedbacks.append( convert(item) )
 
     if sorted:
         feedbacks.sort(key=lambda x: x.last_access_time, reverse=reverse_sort)
 
     return feedbacks
 
+def _feedback_query(account, topic_mask, registry):
+    """Return the query for the feedback that matches 'topic_mask'. These queries
+       all match the composite indexes on last_access_time in index.yaml"""
+    query = FeedBack.getQuery(registry)
+
+    if topic_mask:
+        if topic_mask == "open":
+            query = query.filter( FeedBack.is_resolved == False )
+        elif topic_mask == "my":
+            query = query.filter( FeedBack.email == account.email )
+        elif topic_mask == "problem":
+            query = query.filter( FeedBack.ftype.IN( problem_ftypes ) ).filter( FeedBack.is_resolved == False )
+        elif topic_mask == "help":
+            query = query.filter( FeedBack.ftype.IN( help_ftypes ) )
+        elif topic_mask == "event":
+            query = query.filter( FeedBack.ftype.IN( event_ftypes ) )
+
+    return query
+
+def _time_to_cursor(t, rank=0):
+    """Return the cursor for the topic that is the 'rank'th (from zero, in key order)
+       of the topics that were last touched at time 't'"""
+    cursor = t.strftime("%Y%m%d%H%M%S%f")
+
+    if rank:
+        cursor = "%s.%d" % (cursor, rank)
+
+    return cursor
+
+def _cursor_to_time(cursor):
+    """Return the (time, rank) pair encoded in the passed cursor"""
+    if not cursor:
+        return (None, 0)
+
+    try:
+        parts = cursor.split(".")
+
+        if len(parts) > 2:
+            raise ValueError("Too many parts")
+
+        rank = 0
+
+        if len(parts) == 2:
+            rank = int(parts[1])
+
+            if rank < 0:
+                raise ValueError("Negative rank")
+
+        return (datetime.datetime.strptime(parts[0], "%Y%m%d%H%M%S%f"), rank)
+    except Exception as e:
+        raise InputError("The page cursor '%s' is not valid" % cursor, detail=e)
+
+def _tie_rank(topics, i):
+    """Return the rank of topics[i] among the topics before it that were last
+       touched at the same time"""
+    rank = 0
+
+    while i-rank > 0 and topics[i-rank-1].last_access_time == topics[i].last_access_time:
+        rank += 1
+
+    return rank
+
+def get_feedback_page(account, range_start=None, range_end=None, topic_mask=None,
+                      cursor=None, page_size=None, registry=DEFAULT_FEEDBACK_REGISTRY):
+    """Return the page of user feedback, newest first, that was last touched between
+       'range_start' and 'range_end' and that starts at 'cursor'. This returns an
+       _db.ItemPage of FeedBackInfo objects.
+
+       Topics are ordered by last_access_time (newest first) and then by key, which
+       is the order of the composite indexes in index.yaml. The cursor is the
+       last_access_time of the first topic on the page, plus its rank among the topics
+       that were last touched at that same time. This works for the multi-queries
+       needed by the 'problem', 'help' and 'event' masks, and means that topics that
+       share a last_access_time are neither repeated nor skipped across pages. The
+       queries themselves are projections on last_access_time, with the topics then
+       looked up by key so that they can be served from the ndb cache"""
+
+    assert_is_approved(account, "Only approved accounts can view all of the feedback in the system!")
+
+    if not page_size:
+        page_size = _db.DEFAULT_PAGE_SIZE
+
+    if range_start and range_end and range_start > range_end:
+        tmp = range_start
+        range_start = range_end
+        range_end = tmp
+
+    base = _feedback_query(account, topic_mask, registry)
+    query = base
+
+    if range_start:
+        query = query.filter( FeedBack.last_access_time >= range_start )
+
+    if range_end:
+        query = query.filter( FeedBack.last_access_time <= range_end )
+
+    (start, skip) = _cursor_to_time(cursor)
+
+    if start:
+        forward = query.filter( FeedBack.last_access_time <= start )
+    else:
+        forward = query
+
+    # fetch the topics to skip that tie with the cursor, plus one extra topic
+    # to find the start of the next page
+    topics = forward.order( -FeedBack.last_access_time, FeedBack.key ) \
+                    .fetch(skip+page_size+1, projection=[FeedBack.last_access_time])
+
+    first = 0
+
+    while first < min(skip, len(topics)) and topics[first].last_access_time == start:
+        first += 1
+
+    next_cursor = None
+
+    if len(topics) > first+page_size:
+        last = first + page_size
+        next_cursor = _time_to_cursor(topics[last].last_access_time, _tie_rank(topics, last))
+
+    items = []
+
+    for item in ndb.get_multi([topic.key for topic in topics[first:first+page_size]]):
+        if item:
+            items.append(item)
+
+    # walk backwards from the start of this page to find the start of the previous page.
+    # The 'rank' topics that tie with the first topic on this page come before it
+    prev_cursor = None
+
+    if start and first < len(topics):
+        first_time = topics[first].last_access_time
+        rank = _tie_rank(topics, first)
+
+        if rank >= page_size:
+            prev_cursor = _time_to_cursor(first_time, rank-page_size)
+        else:
+            # the start of the previous page is the 'n'th newer topic, walking backwards
+            n = page_size - rank
+
+            newer = query.filter( FeedBack.last_access_time > first_time ) \
+                         .order( FeedBack.last_access_time, FeedBack.key ) \
+                         .fetch(n+1, projection=[FeedBack.last_access_time])
+
+            if len(newer) > n:
+                # walking backwards visits the topics that tie at 'prev_time' in reverse
+                # key order, so count the ties to work out the rank of the n'th topic
+                prev_time = newer[n-1].last_access_time
+                nolder = len([topic for topic in newer[0:n] if topic.last_access_time < prev_time])
+                nties = base.filter( FeedBack.last_access_time == prev_time ).count()
+
+                prev_cursor = _time_to_cursor(prev_time, max(0, nties - (n-nolder)))
+
+    feedbacks = []
+
+    for item in items:
+        feedbacks.append( FeedBackInfo(item) )
+
+    return _db.ItemPage(feedbacks, cursor, next_cursor, prev_cursor, start is not None)
+
 common_problem_types = [ ("discussion", "topic for discussion", 2),
                          ("request_for_stuff", "request for consumables", 5),
                          ("request_for_help", "request for help", 6),
@@ -429,6 +841,10 @@ for problem in common_problem_types:
     common_ftype_to_description[problem[2]] = problem[1]
 
 class FeedBackMessage(ndb.Model):
+    """A message in a feedback discussion. Messages are stored as child entities
+       of the FeedBack, with integer IDs that count up from 1 in the order that 
+       the messages were added"""
+
     """Email of the user who left this message"""
     email = ndb.StringProperty(indexed=False)
 
@@ -445,7 +861,11 @@ class FeedBackMessageInfo:
         self.message_time =  message.message_time
         self.message = unicode(message.message)
 
-class FeedBack(ndb.Model):
+def _message_key(feedback_key, number):
+    """Return the key of message 'number' (counting from 1) of the passed feedback"""
+    return ndb.Key(FeedBackMessage, number, parent=feedback_key)
+
+class FeedBack(_db.TrackedModel):
     """The time when the feedback was left"""
     report_time = ndb.DateTimeProperty(indexed=True, auto_now_add=False, auto_now=False)
 
@@ -464,9 +884,22 @@ class FeedBack(ndb.Model):
     """The feedback from the user who supplied this feedback"""
     user_info = ndb.StringProperty(indexed=False)
 
-    """Any messages that have since been added to this feedback"""
+    """Messages that were added by older versions of this code. These are moved
+       into FeedBackMessage child entities when the next message is added"""
     messages = ndb.StructuredProperty(FeedBackMessage, repeated=True, indexed=False)
 
+    """The number of messages (child FeedBackMessage entities) in the discussion"""
+    message_count = ndb.IntegerProperty(indexed=False)
+
+    """Email of the user who left the latest message"""
+    last_message_email = ndb.StringProperty(indexed=False)
+
+    """The time of the latest message"""
+    last_message_time = ndb.DateTimeProperty(indexed=False, auto_now_add=False, auto_now=False)
+
+    """The latest message"""
+    last_message = ndb.StringProperty(indexed=False)
+
     """Whether or not this piece of feedback or error has been resolved"""
     is_resolved = ndb.BooleanProperty(indexed=True)
 
@@ -491,13 +924,36 @@ class FeedBack(ndb.Model):
         self.resolved_email = info.resolved_email
         self.resolved_info = info.resolved_info
         self.resolved_time = info.resolved_time
+        self.message_count = info.message_count
 
         self.messages = []
 
-        for message in info.messages:
-            self.messages.append( FeedBackMessage(email=message.email,
-                                                  message_time=message.message_time,
-                                                  message=message.message) )
+        if info.messages:
+            self.setLastMessage(info.messages[-1])
+
+    def setLastMessage(self, message):
+        """Set the summary of the latest message from the passed message"""
+        self.last_message_email = message.email
+        self.last_message_time = message.message_time
+        self.last_message = message.message
+
+    def moveMessagesToChildren(self):
+        """Move any messages stored by older versions of this code into child
+           entities, returning the list of (unsaved) new child entities"""
+        children = []
+
+        if self.messages:
+            for message in self.messages:
+                children.append( FeedBackMessage(key=_message_key(self.key, len(children)+1),
+                                                 email=message.email,
+                                                 message_time=message.message_time,
+                                                 message=message.message) )
+
+            self.message_count = len(children)
+            self.setLastMessage(children[-1])
+            self.messages = []
+
+        return children
 
     @classmethod
     def stringToFType(cls, s):
@@ -539,8 +995,22 @@ class FeedBack(ndb.Model):
     def ancestor(cls, registry=DEFAULT_FEEDBACK_REGISTRY):
         return feedback_key(registry)
 
-class FeedBackInfo:
-    """Simple class to hold information about a piece of feedback"""
+def _message_keys_for(feedback_keys):
+    """Return the keys of all of the messages that are children of the passed feedback keys"""
+    keys = []
+
+    for key in feedback_keys:
+        keys += FeedBackMessage.query(ancestor=key).fetch(keys_only=True)
+
+    return keys
+
+class FeedBackInfo(object):
+    """Simple class to hold information about a piece of feedback. Only the latest
+       message is held in 'messages' - use getMessages to page through the discussion"""
+    __slots__ = ("report_time", "last_access_time", "ftype", "related_id", "email", "user_info",
+                 "messages", "message_count", "is_resolved", "resolved_email", "resolved_info",
+                 "resolved_time", "feedback_id", "_old_messages", "_registry", "_CLASS")
+
     def __init__(self, feedback=None, feedback_id=None, registry=DEFAULT_FEEDBACK_REGISTRY):
         self.report_time = None
         self.last_access_time = None
@@ -549,12 +1019,14 @@ class FeedBackInfo:
         self.email = None
         self.user_info = None
         self.messages = []
+        self.message_count = 0
         self.is_resolved = False
         self.resolved_email = None
         self.resolved_info = None
         self.resolved_time = None
       
         self.feedback_id = None
+        self._old_messages = None
 
         if feedback_id:
             self.feedback_id = feedback_id
@@ -585,8 +1057,16 @@ class FeedBackInfo:
                 self.user_info = unicode(feedback.user_info)
 
             if feedback.messages:
-                for message in feedback.messages:
-                    self.messages.append( FeedBackMessageInfo(message) )
+                # discussion stored by an older version of this code
+                self._old_messages = feedback.messages
+                self.message_count = len(feedback.messages)
+                self.messages.append( FeedBackMessageInfo(feedback.messages[-1]) )
+
+            elif feedback.message_count:
+                self.message_count = int(feedback.message_count)
+                self.messages.append( FeedBackMessageInfo(FeedBackMessage(email=feedback.last_message_email,
+                                                                          message_time=feedback.last_message_time,
+                                                                          message=feedback.last_message)) )
 
             if feedback.is_resolved:
                 self.is_resolved = True
@@ -631,6 +1111,78 @@ class FeedBackInfo:
 
         return False
 
+    def _appendMessage(self, account, info, now_time, resolve=False):
+        """Append a message to the discussion as a new child entity. This updates
+           the message count and latest message summary on the feedback in the same
+           transaction, so only the new message and the (small) feedback entity are
+           written. Returns the added message"""
+        def _txn():
+            item = self._getFromDB()
+
+            children = item.moveMessagesToChildren()
+
+            count = (item.message_count or 0) + 1
+
+            message = FeedBackMessage( key=_message_key(item.key, count),
+                                       email=account.email, message_time=now_time, message=info )
+            children.append(message)
+
+            item.message_count = count
+            item.setLastMessage(message)
+            item.last_access_time = now_time
+
+            if resolve:
+                item.is_resolved = True
+                item.resolved_email = account.email
+                item.resolved_time = now_time
+
+            ndb.put_multi( [item] + children )
+
+            return message
+
+        message = ndb.transaction(_txn)
+
+        self.message_count += 1
+        self.messages = [ FeedBackMessageInfo(message) ]
+        self._old_messages = None
+        self.last_access_time = now_time
+
+        return message
+
+    def getMessages(self, start=1, page_size=None):
+        """Return the page of messages in the discussion that starts with message
+           number 'start' (counting from 1). This returns an _db.ItemPage whose
+           cursors are the message numbers that start the next and previous pages"""
+        if not page_size:
+            page_size = _db.DEFAULT_PAGE_SIZE
+
+        start = max(1, to_int(start) or 1)
+        end = min(start + page_size, self.message_count + 1)
+
+        messages = []
+
+        if self._old_messages:
+            for message in self._old_messages[start-1:end-1]:
+                messages.append( FeedBackMessageInfo(message) )
+
+        elif start < end:
+            key = self._getKey()
+            keys = [ _message_key(key, i) for i in range(start, end) ]
+
+            for message in ndb.get_multi(keys):
+                if message:
+                    messages.append( FeedBackMessageInfo(message) )
+
+        next_cursor = None
+        if end <= self.message_count:
+            next_cursor = str(end)
+
+        prev_cursor = None
+        if start > 1:
+            prev_cursor = str(max(1, start - page_size))
+
+        return _db.ItemPage(messages, str(start), next_cursor, prev_cursor, start > 1)
+
     def addExtraInformation(self, account, info):
         """Add extra information to this piece of feedback"""
         if not account.is_approved:
@@ -640,18 +1192,7 @@ class FeedBackInfo:
         if not info:
             return
 
-        now_time = bsb.get_now_time()
-
-        item = self._getFromDB()
-
-        message = FeedBackMessage( email=account.email, message_time=now_time, message=info )
-
-        item.messages.append(message)
-        item.last_access_time = now_time
-        item.put()
-
-        self.messages.append( FeedBackMessageInfo(message) )
-        self.last_access_time = now_time
+        self._appendMessage(account, info, bsb.get_now_time())
 
     def markAsResolved(self, account, info):
         """Mark this problem as having been resolved"""
@@ -664,23 +1205,11 @@ class FeedBackInfo:
         now_time = bsb.get_now_time()
         info = to_string(info)
 
-        item = self._getFromDB()
-
-        message = FeedBackMessage( email=account.email, message_time=now_time, message=info )
-
-        item.is_resolved = True
-        item.last_access_time = now_time
-        item.resolved_email = account.email
-        item.resolved_time = now_time
-        item.messages.append(message)
-
-        item.put()
+        self._appendMessage(account, info, now_time, resolve=True)
 
         self.is_resolved = True
         self.resolved_email = account.email
         self.resolved_time = now_time
-        self.last_access_time = now_time
-        self.messages.append( FeedBackMessageInfo(message) )
 
     def description(self):
         """Return a short description of this feedback"""
@@ -712,7 +1241,7 @@ class FeedBackInfo:
 
     def hasMessages(self):
         """Return whether or not this feedback has additional messages"""
-        return len(self.messages) > 0
+        return self.message_count > 0
 
     @classmethod
     def deleteFeedBacks(cls, account, feedback_ids, registry=DEFAULT_FEEDBACK_REGISTRY):
@@ -743,7 +1272,7 @@ class FeedBackInfo:
                     pass
 
         if len(keys) > 0:
-            ndb.delete_multi(keys)
+            ndb.delete_multi( keys + _message_keys_for(keys) )
 
 
     def deleteFeedBack(self, account):
@@ -754,7 +1283,7 @@ class FeedBackInfo:
         key = self._getKey()
             
         if key:
-            key.delete()
+            ndb.delete_multi( [key] + _message_keys_for([key]) )
 
         self.feedback_id = None
         self._CLASS = None
@@ -766,6 +1295,8 @@ class FeedBackInfo:
         self.email = None
         self.user_info = None
         self.messages = []
+        self.message_count = 0
+        self._old_messages = None
         self.is_resolved = False
         self.feedback_id = None
         self.resolved_email = None
@@ -864,11 +1395,6 @@ class FeedBackInfo:
                              email=account.email,
                              ftype=ftype )
         
-        if message:
-            feedback.messages.append( FeedBackMessage(email=account.email,
-                                                      message_time=now_time,
-                                                      message=message) )
-
         if related_id:
             feedback.related_id = to_string(related_id)
 
@@ -876,22 +1402,39 @@ class FeedBackInfo:
 
         feedback.is_resolved = False
 
-        feedback.put()
+        # get a new ID from the datastore so that the first message can be its child
+        new_id = FeedBack.allocate_ids(size = 1, parent = feedback_key(registry))[0]
+        feedback.key = ndb.Key(FeedBack, new_id, parent=feedback_key(registry))
+
+        items = [feedback]
+
+        if message:
+            first = FeedBackMessage( key=_message_key(feedback.key, 1),
+                                     email=account.email,
+                                     message_time=now_time,
+                                     message=message )
+            feedback.message_count = 1
+            feedback.setLastMessage(first)
+            items.append(first)
+
+        ndb.transaction( lambda: ndb.put_multi(items) )
 
         return FeedBackInfo(feedback)
 
     @classmethod
-    def getUnresolvedFeedBackForEquipment(cls, item, registry=DEFAULT_FEEDBACK_REGISTRY):
-        """Return all of the unresolved feedback for the passed piece of equipment"""
+    @ndb.tasklet
+    def getUnresolvedFeedBackForEquipment_async(cls, item, registry=DEFAULT_FEEDBACK_REGISTRY):
+        """Return a future for the unresolved feedback about the piece of equipment
+           'item', newest first, or for None if there is none"""
         if not item:
-            return None
+            raise ndb.Return(None)
 
         if not item.idstring:
-            return None
+            raise ndb.Return(None)
 
-        items = FeedBack.getQuery(registry) \
-                        .filter(FeedBack.is_resolved == False) \
-                        .filter(FeedBack.related_id == item.idstring).fetch()
+        items = yield FeedBack.getQuery(registry) \
+                              .filter(FeedBack.is_resolved == False) \
+                              .filter(FeedBack.related_id == item.idstring).fetch_async()
 
         if items and len(items) > 0:
             feedback = []
@@ -900,6 +1443,36 @@ class FeedBackInfo:
                 feedback.append( FeedBackInfo(item) )
 
             feedback.sort(key=lambda x: x.report_time, reverse=True)
-            return feedback
+            raise ndb.Return(feedback)
         else:
-            return None
+            raise ndb.Return(None)
+
+    @classmethod
+    def getUnresolvedFeedBackForEquipment(cls, item, registry=DEFAULT_FEEDBACK_REGISTRY):
+        """Return all of the unresolved feedback for the passed piece of equipment"""
+        return cls.getUnresolvedFeedBackForEquipment_async(item, registry).get_result()
+
+class FeedBackView(_db.LazyInfo):
+    """Lightweight, read-only view of a piece of FeedBack that is used for large 
+       listings. The commonly-used fields are read directly from the FeedBack, and
+       the full FeedBackInfo is only created if anything else is needed"""
+    __slots__ = ()
+
+    _FIELDS = { "feedback_id" : lambda item: item.feedbackID(),
+                "report_time" : lambda item: item.report_time,
+                "last_access_time" : lambda item: item.last_access_time,
+                "ftype" : lambda item: int(item.ftype) if item.ftype else None,
+                "related_id" : lambda item: unicode(item.related_id) if item.related_id else None,
+                "email" : lambda item: unicode(item.email) if item.email else None,
+                "user_info" : lambda item: unicode(item.user_info) if item.user_info else None,
+                "is_resolved" : lambda item: bool(item.is_resolved),
+                "resolved_email" : lambda item: unicode(item.resolved_email) if item.resolved_email else None,
+                "resolved_time" : lambda item: item.resolved_time }
+
+    def __init__(self, feedback):
+        _db.LazyInfo.__init__(self, feedback, FeedBackInfo)
+
+# The read-only FeedBackInfo functions only use the fields above, so can be
+# shared by FeedBackView without having to create the full FeedBackInfo
+for _name in [ "description", "ftypeString", "severity" ]:
+    setattr(FeedBackView, _name, FeedBackInfo.__dict__[_name])
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the HTTP response cache used by the httplib2 Http objects
+   that talk to google. This implements httplib2's cache interface (get, set
+   and delete) on top of memcache, so that repeated GETs are sent as conditional
+   requests (If-None-Match / If-Modified-Since) and can be answered with a 304"""
+
+from google.appengine.api import memcache
+
+import collections
+import hashlib
+import threading
+import zlib
+
+# The memcache namespace holding the cached responses
+DEFAULT_NAMESPACE = "bsb.httpcache"
+
+# Responses larger than this (in bytes, once compressed) are not cached.
+# Memcache cannot hold values larger than 1 MB
+MAX_ENTRY_SIZE = 512 * 1024
+
+# The maximum number of responses, and total uncompressed size, held in the
+# instance-local tier in front of memcache
+LOCAL_MAX_ENTRIES = 100
+LOCAL_MAX_BYTES = 4 * 1024 * 1024
+
+# Responses to URIs containing any of these are never cached, as each token is
+# only ever requested once
+UNCACHEABLE = ("syncToken=", "pageToken=")
+
+class MemcacheCache(object):
+    """An httplib2 cache that stores compressed responses in memcache, so that they
+       are shared by all instances, with a small thread-safe LRU tier on this instance
+       that avoids a memcache round trip for the most recently used responses"""
+    def __init__(self, namespace=DEFAULT_NAMESPACE, max_entry_size=MAX_ENTRY_SIZE,
+                 local_max_entries=LOCAL_MAX_ENTRIES, local_max_bytes=LOCAL_MAX_BYTES):
+        self.namespace = namespace
+        self.max_entry_size = max_entry_size
+        self.local_max_entries = local_max_entries
+        self.local_max_bytes = local_max_bytes
+
+        self._lock = threading.Lock()
+        self._local = collections.OrderedDict()
+        self._local_bytes = 0
+
+        self.stats = { "local_hits" : 0, "memcache_hits" : 0, "misses" : 0,
+                       "sets" : 0, "too_large" : 0 }
+
+    def _key(self, key):
+        """Return the memcache key for the passed httplib2 cache key (a URI). This is
+           hashed as memcache keys are limited to 250 bytes"""
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+
+        return hashlib.sha1(key).hexdigest()
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _removeLocal(self, k):
+        """Remove 'k' from the local tier. This must be called with the lock held"""
+        value = self._local.pop(k, None)
+
+        if value is not None:
+            self._local_bytes -= len(value)
+
+    def _storeLocal(self, k, value):
+        """Add 'k' to the local tier, evicting the least recently used responses
+           to keep within the size limits"""
+        if len(value) > self.local_max_bytes:
+            return
+
+        with self._lock:
+            self._removeLocal(k)
+            self._local[k] = value
+            self._local_bytes += len(value)
+
+            while len(self._local) > self.local_max_entries or self._local_bytes > self.local_max_bytes:
+                self._removeLocal( next(iter(self._local)) )
+
+    def get(self, key):
+        """Return the cached response for 'key', or None if it is not cached"""
+        k = self._key(key)
+
+        with self._lock:
+            value = self._local.pop(k, None)
+
+            if value is not None:
+                # move to the most recently used end
+                self._local[k] = value
+                self.stats["local_hits"] += 1
+                return value
+
+        compressed = memcache.get(k, namespace=self.namespace)
+
+        if compressed is None:
+            self._count("misses")
+            return None
+
+        try:
+            value = zlib.decompress(compressed)
+        except zlib.error:
+            memcache.delete(k, namespace=self.namespace)
+            self._count("misses")
+            return None
+
+        self._count("memcache_hits")
+        self._storeLocal(k, value)
+
+        return value
+
+    def set(self, key, value):
+        """Cache the response 'value' for 'key'"""
+        for marker in UNCACHEABLE:
+            if marker in key:
+                return
+
+        k = self._key(key)
+        compressed = zlib.compress(value)
+
+        if len(compressed) > self.max_entry_size:
+            # make sure that an older, smaller version is not left behind
+            self._count("too_large")
+            self.delete(key)
+            return
+
+        memcache.set(k, compressed, namespace=self.namespace)
+        self._storeLocal(k, value)
+        self._count("sets")
+
+    def delete(self, key):
+        """Remove the cached response for 'key'"""
+        k = self._key(key)
+
+        with self._lock:
+            self._removeLocal(k)
+
+        memcache.delete(k, namespace=self.namespace)
+
+    def clear(self):
+        """Empty the local tier. The memcache entries are left to expire"""
+        with self._lock:
+            self._local.clear()
+            self._local_bytes = 0
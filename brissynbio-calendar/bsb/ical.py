@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the iCalendar (ICS) feeds of the bookings. There is a feed
+   of the bookings of each piece of equipment and a feed of each user's own bookings,
+   which can be subscribed to from any calendar application without the subscriber
+   needing access to the google calendars. Each feed URL is signed, so no login is
+   needed to read it. Feeds are cached in memcache per (feed, version), and the
+   version is bumped whenever a booking in the feed changes, with the cached feed
+   patched with just the changed booking rather than being regenerated"""
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+
+import datetime
+import hashlib
+import hmac
+import os
+import time
+import urllib
+
+from bsb import *
+
+import _db
+import accounts
+import equipment
+
+# The default registry of the secret used to sign the feed URLs
+DEFAULT_FEEDS_REGISTRY = "bsb.ical.feeds"
+
+# Bookings that ended more than this long ago are not included in the feeds
+FEED_HISTORY = datetime.timedelta(days=30)
+
+# How long (in seconds) a cached feed is kept in memcache
+FEED_LIFETIME = 24 * 60 * 60
+
+# How long (in seconds) calendar applications are asked to keep a feed before
+# polling again. They then send If-None-Match, so most polls are answered with a 304
+FEED_MAX_AGE = 15 * 60
+
+# The path from which all feeds are served
+FEED_PATH = "/feeds"
+
+# How long (in seconds) the secret is cached in memcache. This is the longest time
+# that an instance can carry on accepting feed URLs after the secret is reset
+SECRET_LIFETIME = 60
+
+# The booking states that are shown in the feeds, with the iCalendar STATUS of each
+FEED_STATUSES = { equipment.Booking.confirmed() : "CONFIRMED",
+                  equipment.Booking.pendingAuthorisation() : "TENTATIVE" }
+
+class FeedError(SchedulerError):
+    pass
+
+class InvalidFeedError(FeedError):
+    pass
+
+class FeedSecret(ndb.Model):
+    """The secret used to sign the feed URLs. Changing this revokes every feed URL"""
+    secret = ndb.StringProperty(indexed=False)
+
+def feeds_key(registry=DEFAULT_FEEDS_REGISTRY):
+    """Construct the Datastore key for the feed secret"""
+    return ndb.Key("FeedSecret", registry)
+
+def _secret_cache_key(registry):
+    return "ical_secret_%s" % registry
+
+def _get_secret(registry=DEFAULT_FEEDS_REGISTRY):
+    """Return the secret used to sign the feed URLs, creating it if necessary. This is
+       cached in memcache (shared by all instances) for at most SECRET_LIFETIME seconds,
+       so that resetting the secret revokes the feed URLs on every instance"""
+    secret = memcache.get(_secret_cache_key(registry))
+
+    if secret is None:
+        item = FeedSecret.get_or_insert(registry, secret=hashlib.sha1(os.urandom(32)).hexdigest())
+        secret = str(item.secret)
+
+        # add rather than set, so that this never replaces a newer secret that was
+        # saved by reset_secret after the secret above was read
+        memcache.add(_secret_cache_key(registry), secret, time=SECRET_LIFETIME)
+
+    return secret
+
+def reset_secret(account, registry=DEFAULT_FEEDS_REGISTRY):
+    """Replace the secret used to sign the feed URLs. This revokes every existing feed URL"""
+    assert_is_admin(account, "Only administrators can revoke the calendar feeds")
+
+    secret = hashlib.sha1(os.urandom(32)).hexdigest()
+    FeedSecret(key=feeds_key(registry), secret=secret).put()
+    memcache.set(_secret_cache_key(registry), secret, time=SECRET_LIFETIME)
+
+def equipment_feed(equipment_idstring):
+    """Return the name of the feed of the bookings of the passed equipment"""
+    return "equipment|%s" % equipment_idstring
+
+def user_feed(email):
+    """Return the name of the feed of the bookings made by the passed user"""
+    return "user|%s" % email
+
+def _sign(feed, email, registry=DEFAULT_FEEDS_REGISTRY):
+    """Return the signature that allows 'email' to read 'feed'"""
+    message = ("%s|%s" % (feed, email)).encode("utf-8")
+    return hmac.new(_get_secret(registry), message, hashlib.sha1).hexdigest()[0:32]
+
+def _signatures_equal(a, b):
+    """Compare two signatures in a time that does not depend on where they differ"""
+    if len(a) != len(b):
+        return False
+
+    result = 0
+
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+
+    return result == 0
+
+def equipment_feed_url(host_url, equipment_idstring, email):
+    """Return the URL of the feed of the bookings of the passed equipment, as read by 'email'"""
+    return "%s%s/equipment/%s/%s/%s.ics" % (host_url, FEED_PATH, urllib.quote(equipment_idstring),
+                                            urllib.quote(email, safe="@"),
+                                            _sign(equipment_feed(equipment_idstring), email))
+
+def user_feed_url(host_url, email):
+    """Return the URL of the feed of the bookings made by 'email'"""
+    return "%s%s/user/%s/%s.ics" % (host_url, FEED_PATH, urllib.quote(email, safe="@"),
+                                    _sign(user_feed(email), email))
+
+def get_feed_urls(account, host_url):
+    """Return the list of (name, URL) of all of the feeds that can be read by 'account'"""
+    if not (account and account.is_approved):
+        return []
+
+    urls = [ ("My bookings", user_feed_url(host_url, account.email)) ]
+
+    if account.is_admin:
+        items = [ item.idstring for item in equipment.list_equipment() ]
+    else:
+        items = equipment.EquipmentACLInfo.getAuthorisedEquipment(account) or []
+
+    mapping = equipment.get_equipment_mapping()
+
+    for idstring in items:
+        urls.append( (mapping.get(idstring, idstring), equipment_feed_url(host_url, idstring, account.email)) )
+
+    return urls
+
+def check_access(feed, email, signature):
+    """Check that the passed signature allows 'email' to read 'feed', and that
+       'email' is still allowed to see the bookings in the feed. This raises
+       InvalidFeedError if the feed does not exist or the signature is wrong,
+       or PermissionError if access has been revoked (including if the account
+       has since been deleted)"""
+    if not _signatures_equal(str(signature), _sign(feed, email)):
+        raise InvalidFeedError("There is no feed at this address")
+
+    account = accounts.get_account_by_email_unchecked(email)
+
+    if not (account and account.is_approved):
+        raise PermissionError("The account '%s' can no longer read this feed" % email)
+
+    (kind, subject) = feed.split("|", 1)
+
+    if kind == "user":
+        if subject != email:
+            raise InvalidFeedError("There is no feed at this address")
+
+    elif kind == "equipment":
+        equip = equipment.get_equipment(subject)
+
+        if not equip:
+            raise InvalidFeedError("There is no equipment '%s'" % subject)
+
+        if not account.is_admin:
+            rule = equipment.EquipmentACLInfo.getRule(account, equip)
+
+            if not (rule and rule.isAuthorised()):
+                raise PermissionError("The account '%s' can no longer see the bookings of '%s'" % \
+                                          (email, equip.name))
+    else:
+        raise InvalidFeedError("There is no feed at this address")
+
+def _cache_key(feed):
+    """Return the memcache key prefix for 'feed'. This is hashed as memcache
+       keys are limited to 250 bytes"""
+    return "ical_%s" % hashlib.sha1(feed.encode("utf-8")).hexdigest()
+
+def _state_key(feed, version):
+    return "%s_%d" % (_cache_key(feed), version)
+
+def get_version(feed):
+    """Return the current version of 'feed'. If the version has been evicted from memcache
+       it restarts from the current time, so that it never repeats an earlier version"""
+    k = "%s_version" % _cache_key(feed)
+    version = memcache.get(k)
+
+    if version is None:
+        memcache.add(k, int(time.time() * 1000))
+        version = memcache.get(k)
+
+        if version is None:
+            # memcache is unavailable, so never match a cached copy
+            version = int(time.time() * 1000)
+
+    return version
+
+def _bump_version(feed):
+    """Increment the version of 'feed', returning the new version, or None if
+       the feed has no version (so nothing is cached that needs patching)"""
+    return memcache.incr("%s_version" % _cache_key(feed))
+
+def get_etag(feed, version):
+    """Return the ETag of the passed version of 'feed'"""
+    return '"%s-%d"' % (_cache_key(feed)[5:13], version)
+
+def _escape(text):
+    """Escape the passed text for use as an iCalendar value"""
+    text = unicode(text or "")
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,") \
+               .replace("\r\n", "\\n").replace("\n", "\\n")
+
+def _fold(line):
+    """Fold the passed content line so that no line is longer than 75 octets"""
+    line = line.encode("utf-8")
+    lines = []
+
+    # continuation lines start with a space, so hold one octet less
+    while len(line) > (74 if lines else 75):
+        n = 74 if lines else 75
+
+        # do not split a multi-byte character
+        while n > 0 and (ord(line[n]) & 0xC0) == 0x80:
+            n -= 1
+
+        lines.append(line[0:n])
+        line = line[n:]
+
+    lines.append(line)
+
+    return "\r\n ".join(lines)
+
+def _ical_time(t):
+    """Return the passed UTC time in iCalendar format"""
+    return to_utc(t).strftime("%Y%m%dT%H%M%SZ")
+
+def _uid(booking):
+    return "booking-%s-%s@bsb" % (booking.equipment, booking.booking_id)
+
+def _render_event(booking, kind, account_mapping):
+    """Return the VEVENT for the passed booking (a BookingView or BookingInfo)
+       as it is shown in a feed of 'kind' ("equipment" or "user")"""
+    name = account_mapping.get(booking.email, booking.email)
+
+    if kind == "user":
+        summary = booking.getEquipmentName()
+    else:
+        summary = name
+
+    if booking.status == equipment.Booking.pendingAuthorisation():
+        summary = "%s (awaiting authorisation)" % summary
+
+    lines = [ "BEGIN:VEVENT",
+              "UID:%s" % _uid(booking),
+              "DTSTAMP:%s" % _ical_time(booking.booking_time or get_now_time()),
+              "DTSTART:%s" % _ical_time(booking.start_time),
+              "DTEND:%s" % _ical_time(booking.end_time),
+              "SUMMARY:%s" % _escape(summary),
+              "LOCATION:%s" % _escape(booking.getLaboratoryName()),
+              "DESCRIPTION:%s" % _escape("%s booked by %s. Project = %s" % \
+                                   (booking.getEquipmentName(), name, booking.getProjectName())),
+              "STATUS:%s" % FEED_STATUSES[booking.status],
+              "END:VEVENT" ]
+
+    return "\r\n".join( [_fold(line) for line in lines] )
+
+def _query_bookings(feed):
+    """Return the bookings that are shown in 'feed', as BookingViews"""
+    (kind, subject) = feed.split("|", 1)
+    since = get_now_time() - FEED_HISTORY
+
+    if kind == "equipment":
+        query = equipment.Booking.getEquipmentQuery(subject)
+    else:
+        query = equipment.Booking.getQuery().filter(equipment.Booking.user == subject)
+
+    items = query.filter(equipment.Booking.end_time > since).fetch()
+
+    return [ equipment.BookingView(item) for item in items if item.status in FEED_STATUSES ]
+
+def _build_state(feed):
+    """Render all of the bookings in 'feed', returning the dictionary of
+       {UID : (start time, VEVENT)} that is cached for each version"""
+    kind = feed.split("|", 1)[0]
+    account_mapping = accounts.get_account_mapping()
+
+    events = {}
+
+    for booking in _query_bookings(feed):
+        events[_uid(booking)] = (booking.start_time, _render_event(booking, kind, account_mapping))
+
+    return events
+
+def _feed_name(feed):
+    (kind, subject) = feed.split("|", 1)
+
+    if kind == "equipment":
+        return "%s bookings" % equipment.get_equipment_mapping().get(subject, subject)
+    else:
+        return "Bookings of %s" % accounts.get_account_mapping().get(subject, subject)
+
+def _assemble(feed, events):
+    """Return the full iCalendar text of 'feed' containing the passed events"""
+    lines = [ "BEGIN:VCALENDAR",
+              "VERSION:2.0",
+              "PRODID:-//BrisSynBio//Equipment Calendar//EN",
+              "CALSCALE:GREGORIAN",
+              "METHOD:PUBLISH",
+              _fold("X-WR-CALNAME:%s" % _escape(_feed_name(feed))),
+              "X-WR-TIMEZONE:%s" % get_timezone_string() ]
+
+    for (start, event) in sorted(events.values(), key=lambda x: x[0]):
+        lines.append(event)
+
+    lines.append("END:VCALENDAR")
+
+    return "\r\n".join(lines) + "\r\n"
+
+def get_feed(feed, version):
+    """Return the iCalendar text of the passed version of 'feed'. The rendered events
+       are cached for each version, so the bookings are only read when the feed is
+       not already cached"""
+    events = memcache.get(_state_key(feed, version))
+
+    if events is None:
+        events = _build_state(feed)
+        memcache.set(_state_key(feed, version), events, time=FEED_LIFETIME)
+
+    return _assemble(feed, events)
+
+def booking_changed(booking):
+    """Called after the passed Booking has been saved. This bumps the version of the
+       feeds that include the booking, and patches the cached copy of the previous
+       version with just this booking, so that the feeds do not need to be regenerated.
+       If the previous version is not cached (e.g. two bookings changed at the same
+       time) the new version is regenerated in full when it is next read"""
+    if _db.logical_registry(booking.key.root().string_id()) != equipment.DEFAULT_BOOKING_REGISTRY:
+        return
+
+    view = equipment.BookingView(booking)
+    uid = _uid(view)
+    account_mapping = None
+
+    for (kind, feed) in [ ("equipment", equipment_feed(view.equipment)),
+                          ("user", user_feed(view.email)) ]:
+        version = _bump_version(feed)
+
+        if version is None:
+            continue
+
+        events = memcache.get(_state_key(feed, version-1))
+
+        if events is None:
+            continue
+
+        if view.status in FEED_STATUSES:
+            if account_mapping is None:
+                account_mapping = accounts.get_account_mapping()
+
+            events[uid] = (view.start_time, _render_event(view, kind, account_mapping))
+        else:
+            events.pop(uid, None)
+
+        memcache.set(_state_key(feed, version), events, time=FEED_LIFETIME)
@@ -19,9 +19,9 @@ DEFAULT_PROJECT_REGISTRY = "bsb.equipment.projects"
 def project_key(project_registry=DEFAULT_PROJECT_REGISTRY):
     """Constructs a Datastore key for a project entry.
        We use the project name as the key"""
-    return ndb.Key('Accounts', project_registry)
+    return ndb.Key('Accounts', _db.registry(project_registry))
 
-class Project(ndb.Model):
+class Project(_db.TrackedModel):
     #human readable name of the project
     name = ndb.StringProperty(indexed=False)
 
@@ -64,9 +64,9 @@ class ProjectInfo(_db.StandardInfo):
         return _db.getAllFromDB(account, Project, registry)
 
     @classmethod
-    def backup(cls, account, registry=None):
-        """Return a string containing the entire database in pickled form"""
-        return _db.backup(account, cls, Project, registry)
+    def getPage(cls, account, cursor=None, registry=None):
+        """Return the page of items in the database that starts at 'cursor'"""
+        return _db.getPageFromDB(account, Project, registry, cursor)
 
     @classmethod
     def restore(cls, account, data, registry=None):
@@ -84,15 +84,14 @@ def project_title_to_id(title):
 special_projects = [ ("Other...", project_title_to_id("Other...")), 
                      ("Industrial Project", project_title_to_id("Industrial Project")) ]
 
-special_projects_dict = {}
+special_projects_dict = dict(special_projects)
 
-def _get_project_by_id(id, project_registry=DEFAULT_PROJECT_REGISTRY):
-    """Internal function to find and return a project by ID. Returns None if no such
-       project exists."""
-    return _db.get_db(Project, id, project_registry)
+# The registries in which this instance has already seeded the special projects
+_seeded_registries = {}
 
 def _createSpecialProjects(project_registry=DEFAULT_PROJECT_REGISTRY):
-    """Internal function used to create the special projects that must exist in the registry"""
+    """Internal function used to create the special projects that must exist in the registry.
+       This is normally called once per instance by the warmup handler"""
 
     for special_project in special_projects:
         title = special_project[0]
@@ -108,13 +107,20 @@ def _createSpecialProjects(project_registry=DEFAULT_PROJECT_REGISTRY):
                                vat_exempt = False )
 
             project.put()
+            _db.changed_idstring_to_name_db(Project,project_registry)
+
+    _seeded_registries[project_registry] = True
 
-        special_projects_dict[title] = id
+def seed_special_projects(project_registry=DEFAULT_PROJECT_REGISTRY):
+    """Make sure that the special projects exist in the registry. This only
+       touches the datastore the first time it is called on this instance"""
+    if not project_registry in _seeded_registries:
+        _createSpecialProjects(project_registry)
 
 def list_projects(sorted=True, project_registry=DEFAULT_PROJECT_REGISTRY):
     """Function used to return a list of all projects"""
 
-    _createSpecialProjects()
+    seed_special_projects(project_registry)
 
     projects = Project.getQuery(project_registry).fetch()
 
@@ -143,10 +149,22 @@ def list_projects(sorted=True, project_registry=DEFAULT_PROJECT_REGISTRY):
 
     return output
 
+def list_projects_page(cursor=None, page_size=None, project_registry=DEFAULT_PROJECT_REGISTRY):
+    """Function used to return the page of projects that starts at 'cursor',
+       ordered by project ID"""
+
+    seed_special_projects(project_registry)
+
+    return _db.list_items_page(Project, ProjectInfo, project_registry, cursor, page_size)
+
 def number_of_projects(project_registry=DEFAULT_PROJECT_REGISTRY):
     """Return the total number of projects"""
     return _db.number_of_items(Project, project_registry)
 
+def number_of_projects_async(project_registry=DEFAULT_PROJECT_REGISTRY):
+    """Return a future for the total number of projects"""
+    return _db.number_of_items_async(Project, project_registry)
+
 def _get_project_by_id(id, project_registry=DEFAULT_PROJECT_REGISTRY):
     """Internal function to find and return a project by ID. Returns None if no such
        project exists."""
@@ -170,6 +188,14 @@ def get_sorted_project_mapping(registry=DEFAULT_PROJECT_REGISTRY):
     """Return a sorted list of all project names, together with their IDs"""
     return _db.get_sorted_names_to_idstring(Project,registry)
 
+def get_project_mapping_async(registry=DEFAULT_PROJECT_REGISTRY):
+    """Return a future for the dictionary mapping project IDs to project names"""
+    return _db.get_idstring_to_name_db_async(Project, registry)
+
+def get_sorted_project_mapping_async(registry=DEFAULT_PROJECT_REGISTRY):
+    """Return a future for the sorted list of all project names, together with their IDs"""
+    return _db.get_sorted_names_to_idstring_async(Project,registry)
+
 class AddProjectError:
     def __init__(self, errors):
         self._errors = errors
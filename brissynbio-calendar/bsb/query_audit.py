@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the query audit tool. This records the shape (kind, ancestor,
+   filters, orders) of every datastore query run while recording is switched on,
+   and compares these shapes against the composite indexes in index.yaml, so that
+   missing or unused indexes are found before the queries are run in production.
+
+   Note that recording is per-instance, so this is intended to be used on the
+   local development server (or a single test instance)"""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_index
+
+import os
+import threading
+import traceback
+import datetime
+
+from bsb import *
+
+# The path to the index.yaml file for this application
+INDEX_YAML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index.yaml")
+
+# The name of the hooks registered with the API proxy
+_HOOK_NAME = "bsb_query_audit"
+
+_EQUALITY_OPS = [ datastore_pb.Query_Filter.EQUAL ]
+
+_INEQUALITY_OPS = [ datastore_pb.Query_Filter.LESS_THAN,
+                    datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL,
+                    datastore_pb.Query_Filter.GREATER_THAN,
+                    datastore_pb.Query_Filter.GREATER_THAN_OR_EQUAL ]
+
+_lock = threading.Lock()
+_recording = False
+_shapes = {}
+_pending = {}
+
+class QueryShape:
+    """The shape of a datastore query, together with the statistics
+       of every time that a query of this shape was run"""
+    def __init__(self, kind, ancestor, equality, inequality, orders, projection, keys_only):
+        self.kind = kind
+        self.ancestor = ancestor
+        self.equality = equality
+        self.inequality = inequality
+        self.orders = orders
+        self.projection = projection
+        self.keys_only = keys_only
+
+        self.origins = set()
+        self.calls = 0
+        self.results = 0
+
+    def key(self):
+        return (self.kind, self.ancestor, self.equality, self.inequality,
+                self.orders, self.projection, self.keys_only)
+
+    def __str__(self):
+        parts = [self.kind]
+
+        if self.ancestor:
+            parts.append("ancestor")
+
+        for name in self.equality:
+            parts.append("%s ==" % name)
+
+        if self.inequality:
+            parts.append("%s <>" % self.inequality)
+
+        for (name, direction) in self.orders:
+            parts.append("order %s %s" % (name, direction))
+
+        if self.projection:
+            parts.append("project %s" % ",".join(self.projection))
+
+        if self.keys_only:
+            parts.append("keys only")
+
+        return " | ".join(parts)
+
+    def needsCompositeIndex(self):
+        """Return whether or not this query can only be answered using a composite
+           index. Queries that only use equality filters on a single property, or
+           only an ancestor and equality filters (merge join), or a single sort
+           order with no filters, can use the built-in indexes"""
+        orders = [ o for o in self.orders if o[0] != "__key__" ]
+        descending_key = ("__key__", "desc") in self.orders
+
+        if descending_key and (self.equality or self.inequality or orders):
+            return True
+
+        if descending_key:
+            return self.ancestor
+
+        if self.projection and len(self.projection) > 1:
+            return True
+
+        if not (self.inequality or orders):
+            # equality filters only - these use a merge join of the built-in indexes
+            return False
+
+        if self.ancestor or self.equality:
+            return True
+
+        # inequality and sorts are on a single property
+        names = set( [o[0] for o in orders] )
+
+        if self.inequality:
+            names.add(self.inequality)
+
+        return len(names) > 1
+
+    def requiredIndex(self):
+        """Return the composite index needed by this query, as (kind, ancestor, prefix, postfix)
+           where 'prefix' is the set of equality properties, which can be in any order,
+           and 'postfix' is the list of (name, direction) that must follow them"""
+        postfix = []
+
+        if self.inequality:
+            if not (self.orders and self.orders[0][0] == self.inequality):
+                postfix.append( (self.inequality, "asc") )
+
+        for order in self.orders:
+            if order[0] == "__key__" and order[1] == "asc":
+                continue
+
+            postfix.append(order)
+
+        names = set( [p[0] for p in postfix] ) | set(self.equality)
+
+        for name in self.projection:
+            if not name in names:
+                postfix.append( (name, "asc") )
+
+        return (self.kind, self.ancestor, frozenset(self.equality), tuple(postfix))
+
+    def estimatedCost(self):
+        """Return the estimated number of datastore reads per query, based on the
+           average number of results returned when this query was recorded. Keys-only
+           and projection queries are counted as one read in total, as they only
+           read the index"""
+        if self.calls == 0:
+            return 0
+
+        average = float(self.results) / self.calls
+
+        if self.keys_only or self.projection:
+            return 1
+
+        return 1 + average
+
+class IndexDefinition:
+    """A composite index read from index.yaml"""
+    def __init__(self, kind, ancestor, properties):
+        self.kind = kind
+        self.ancestor = ancestor
+        self.properties = properties
+
+    def __str__(self):
+        parts = [self.kind]
+
+        if self.ancestor:
+            parts.append("ancestor")
+
+        for (name, direction) in self.properties:
+            parts.append("%s %s" % (name, direction))
+
+        return " | ".join(parts)
+
+    def satisfies(self, required):
+        """Return whether or not this index satisfies the 'required' index
+           returned by QueryShape.requiredIndex"""
+        (kind, ancestor, prefix, postfix) = required
+
+        if kind != self.kind or ancestor != self.ancestor:
+            return False
+
+        if len(self.properties) != len(prefix) + len(postfix):
+            return False
+
+        names = set( [p[0] for p in self.properties[0:len(prefix)]] )
+
+        if names != prefix:
+            return False
+
+        return tuple(self.properties[len(prefix):]) == postfix
+
+def load_indexes(path=INDEX_YAML):
+    """Return the list of IndexDefinitions read from the index.yaml file at 'path'"""
+    with open(path, "r") as f:
+        definitions = datastore_index.ParseIndexDefinitions(f)
+
+    indexes = []
+
+    if definitions and definitions.indexes:
+        for index in definitions.indexes:
+            properties = []
+
+            for prop in (index.properties or []):
+                direction = prop.direction or "asc"
+
+                if direction.lower().startswith("desc"):
+                    direction = "desc"
+                else:
+                    direction = "asc"
+
+                properties.append( (prop.name, direction) )
+
+            indexes.append( IndexDefinition(index.kind, bool(index.ancestor), properties) )
+
+    return indexes
+
+def _shape_from_query(query):
+    """Return the QueryShape of the passed datastore_pb.Query"""
+    equality = set()
+    inequality = None
+
+    for f in query.filter_list():
+        name = f.property(0).name()
+
+        if f.op() in _EQUALITY_OPS:
+            equality.add(name)
+        elif f.op() in _INEQUALITY_OPS:
+            inequality = name
+
+    orders = []
+
+    for order in query.order_list():
+        if order.direction() == datastore_pb.Query_Order.DESCENDING:
+            orders.append( (order.property(), "desc") )
+        else:
+            orders.append( (order.property(), "asc") )
+
+    return QueryShape( query.kind(), query.has_ancestor(), tuple(sorted(equality)), inequality,
+                       tuple(orders), tuple(sorted(query.property_name_list())), query.keys_only() )
+
+def _origin():
+    """Return the innermost function in the bsb module that issued the query"""
+    for (filename, line, function, text) in reversed(traceback.extract_stack()):
+        if filename.find("%sbsb%s" % (os.sep,os.sep)) != -1 and \
+           os.path.basename(filename) not in ["query_audit.py", "_db.py"]:
+            return "%s:%s" % (os.path.basename(filename), function)
+
+    return "unknown"
+
+def _pre_call_hook(service, call, request, response):
+    if call != "RunQuery" or not _recording:
+        return
+
+    try:
+        shape = _shape_from_query(request)
+        origin = _origin()
+    except Exception:
+        return
+
+    with _lock:
+        existing = _shapes.get(shape.key())
+
+        if existing is None:
+            _shapes[shape.key()] = shape
+            existing = shape
+
+        existing.calls += 1
+        existing.origins.add(origin)
+        _pending[id(response)] = existing
+
+def _post_call_hook(service, call, request, response):
+    if call != "RunQuery":
+        return
+
+    with _lock:
+        shape = _pending.pop(id(response), None)
+
+    if shape:
+        try:
+            shape.results += response.result_size()
+        except Exception:
+            pass
+
+def _install_hooks():
+    proxy = apiproxy_stub_map.apiproxy
+    proxy.GetPreCallHooks().Append(_HOOK_NAME, _pre_call_hook, "datastore_v3")
+    proxy.GetPostCallHooks().Append(_HOOK_NAME, _post_call_hook, "datastore_v3")
+
+_hooks_installed = False
+
+def start_recording():
+    """Start recording the shapes of all datastore queries run by this instance"""
+    global _recording, _hooks_installed
+
+    with _lock:
+        if not _hooks_installed:
+            _install_hooks()
+            _hooks_installed = True
+
+        _recording = True
+
+def stop_recording():
+    """Stop recording the shapes of datastore queries"""
+    global _recording
+    _recording = False
+
+def is_recording():
+    """Return whether or not queries are currently being recorded"""
+    return _recording
+
+def reset():
+    """Forget all of the recorded query shapes"""
+    with _lock:
+        _shapes.clear()
+        _pending.clear()
+
+def get_shapes():
+    """Return the list of recorded query shapes, sorted by kind"""
+    with _lock:
+        shapes = list(_shapes.values())
+
+    shapes.sort(key=lambda x: str(x))
+    return shapes
+
+class AuditReport:
+    """The result of comparing the recorded query shapes against index.yaml"""
+    def __init__(self, shapes, indexes):
+        # (shape, index) for every shape, where index is None if a built-in index is used
+        self.satisfied = []
+
+        # (shape, required index string) for every shape that has no matching index
+        self.missing = []
+
+        # the indexes in index.yaml that were not used by any recorded query
+        self.unused = []
+
+        used = set()
+
+        for shape in shapes:
+            if not shape.needsCompositeIndex():
+                self.satisfied.append( (shape, None) )
+                continue
+
+            required = shape.requiredIndex()
+            match = None
+
+            for i in range(0,len(indexes)):
+                if indexes[i].satisfies(required):
+                    match = indexes[i]
+                    used.add(i)
+                    break
+
+            if match:
+                self.satisfied.append( (shape, match) )
+            else:
+                (kind, ancestor, prefix, postfix) = required
+                self.missing.append( (shape, IndexDefinition(kind, ancestor,
+                                                [(name,"asc") for name in sorted(prefix)] + list(postfix))) )
+
+        for i in range(0,len(indexes)):
+            if not i in used:
+                self.unused.append(indexes[i])
+
+        self.shapes = shapes
+        self.total_cost = sum( [shape.estimatedCost() * shape.calls for shape in shapes] )
+
+    def missingYaml(self):
+        """Return the index.yaml entries needed to add all of the missing indexes"""
+        lines = []
+
+        for (shape, index) in self.missing:
+            lines.append("- kind: %s" % index.kind)
+
+            if index.ancestor:
+                lines.append("  ancestor: yes")
+
+            lines.append("  properties:")
+
+            for (name, direction) in index.properties:
+                lines.append("  - name: %s" % name)
+
+                if direction == "desc":
+                    lines.append("    direction: desc")
+
+            lines.append("")
+
+        return "\n".join(lines)
+
+def audit(path=INDEX_YAML):
+    """Compare the recorded query shapes against the indexes in 'path', returning an AuditReport"""
+    return AuditReport(get_shapes(), load_indexes(path))
+
+def replay(account):
+    """Run a representative set of the bsb read functions, so that their query shapes
+       are recorded against whatever data is in the datastore. Returns a list of any
+       errors raised (e.g. missing index errors)"""
+    assert_is_admin(account, "Only administrators can replay the queries of the application")
+
+    import accounts
+    import projects
+    import equipment
+    import feedback
+
+    now_time = get_now_time()
+    past_time = now_time - datetime.timedelta(days=7)
+
+    calls = [ lambda: accounts.list_accounts(),
+              lambda: accounts.list_accounts_page(),
+              lambda: projects.list_projects_page(),
+              lambda: equipment.list_equipment_page(),
+              lambda: equipment.get_bookings(start_time=past_time, end_time=now_time),
+              lambda: equipment.get_bookings(end_time=now_time),
+              lambda: equipment.get_bookings_for_user(account, range_start=past_time),
+              lambda: equipment.get_bookings_for_user(account, range_end=now_time),
+              lambda: feedback.get_bugs(account, past_time, now_time),
+              lambda: feedback.get_bugs(account, past_time, now_time, view_user=account.email),
+              lambda: equipment.EquipmentACLInfo.getRulesForAccount(account) ]
+
+    for topic_mask in [None, "open", "my", "problem", "help", "event"]:
+        calls.append( lambda mask=topic_mask: feedback.get_feedback(account, past_time, now_time, topic_mask=mask) )
+        calls.append( lambda mask=topic_mask: feedback.get_feedback_page(account, topic_mask=mask) )
+
+    for item in equipment.list_equipment(False):
+        calls.append( lambda item=item: equipment.get_bookings(item, status=equipment.Booking.confirmed(),
+                                                                start_time=now_time) )
+        calls.append( lambda item=item: equipment.get_bookings(item, start_time=past_time, end_time=now_time) )
+        calls.append( lambda item=item: item.getUnresolvedFeedBack() )
+        calls.append( lambda item=item: item.getACLs(account) )
+
+    errors = []
+
+    for call in calls:
+        try:
+            call()
+        except Exception as e:
+            errors.append(str(e))
+
+    return errors
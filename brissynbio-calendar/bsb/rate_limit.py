@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the rate limiter that shares a budget of google API calls
+   between all instances. The budget is held as memcache counters for the current
+   second and minute, which every call draws from before it is made. Interactive
+   calls can use the whole budget, while background calls (e.g. calendar syncs)
+   are limited to a share of it and are deferred rather than waiting"""
+
+from google.appengine.api import memcache
+
+import contextlib
+import threading
+import time
+
+from bsb import *
+
+# Call priorities
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# The number of calls allowed per second and per minute across all instances
+PER_SECOND_BUDGET = 10
+PER_MINUTE_BUDGET = 300
+
+# The fraction of each budget that background calls may use, so that the rest
+# is kept for the people using the site
+BACKGROUND_SHARE = 0.5
+
+# The longest (in seconds) that an interactive call will wait for the budget
+MAX_WAIT_SECONDS = 2
+
+class RateLimitError(SchedulerError):
+    pass
+
+_local = threading.local()
+
+def current_priority():
+    """Return the priority of the calls made by the current thread"""
+    return getattr(_local, "priority", INTERACTIVE)
+
+@contextlib.contextmanager
+def priority(value):
+    """Context manager that sets the priority of the calls made by the current thread, e.g.
+
+         with rate_limit.priority(rate_limit.BACKGROUND):
+             reconcile_all(account)
+    """
+    old = current_priority()
+    _local.priority = value
+
+    try:
+        yield
+    finally:
+        _local.priority = old
+
+class RateLimiter(object):
+    """Token bucket rate limiter shared by all instances. Each window (second or minute)
+       is a memcache counter that is incremented by every call, so the tokens left in the
+       bucket are the budget minus the counter. Counters expire with their window"""
+    def __init__(self, name, per_second=PER_SECOND_BUDGET, per_minute=PER_MINUTE_BUDGET,
+                 background_share=BACKGROUND_SHARE, max_wait=MAX_WAIT_SECONDS):
+        self.name = name
+        self.per_second = per_second
+        self.per_minute = per_minute
+        self.background_share = background_share
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self.stats = { "granted_interactive" : 0, "granted_background" : 0,
+                       "deferred" : 0, "rejected" : 0, "waits" : 0, "wait_seconds" : 0.0,
+                       "backoffs" : 0 }
+
+    def _keys(self, now):
+        return ("ratelimit_%s_s_%d" % (self.name, int(now)),
+                "ratelimit_%s_m_%d" % (self.name, int(now / 60)))
+
+    def _count(self, stat, value=1):
+        with self._lock:
+            self.stats[stat] += value
+
+    def _limits(self, priority):
+        if priority == BACKGROUND:
+            return (int(self.per_second * self.background_share),
+                    int(self.per_minute * self.background_share))
+        else:
+            return (self.per_second, self.per_minute)
+
+    def maxCost(self, priority=None):
+        """Return the largest number of tokens that a single call can take"""
+        if priority is None:
+            priority = current_priority()
+
+        return max(1, self._limits(priority)[0])
+
+    def _tryAcquire(self, priority, cost, now):
+        """Try to take 'cost' tokens from the current windows. Returns None if the tokens
+           were taken, or else the number of seconds until the budget is refilled"""
+        (second_key, minute_key) = self._keys(now)
+        (second_limit, minute_limit) = self._limits(priority)
+
+        memcache.add_multi({ second_key : 0, minute_key : 0 }, time=120)
+        counts = memcache.offset_multi({ second_key : cost, minute_key : cost }, initial_value=0)
+
+        used_second = counts.get(second_key) or 0
+        used_minute = counts.get(minute_key) or 0
+
+        if used_second <= second_limit and used_minute <= minute_limit:
+            return None
+
+        # give the tokens back, as this call will not be made now
+        memcache.offset_multi({ second_key : -cost, minute_key : -cost })
+
+        if used_minute > minute_limit:
+            return 60 - (now % 60)
+        else:
+            return 1 - (now % 1)
+
+    def acquire(self, priority=None, cost=1):
+        """Take 'cost' tokens from the budget before making a call. Interactive calls wait
+           (for at most 'max_wait' seconds) for the budget to refill. Background calls never
+           wait, and raise RateLimitError so that the caller can defer the work"""
+        if priority is None:
+            priority = current_priority()
+
+        waited = 0.0
+
+        while True:
+            now = time.time()
+            delay = self._tryAcquire(priority, cost, now)
+
+            if delay is None:
+                self._count("granted_%s" % priority)
+
+                if waited:
+                    self._count("waits")
+                    self._count("wait_seconds", waited)
+
+                return
+
+            if priority == BACKGROUND:
+                self._count("deferred")
+                raise RateLimitError("The budget of calls for background work is used up. Try again in %.0f seconds." \
+                                        % delay, detail=delay)
+
+            if waited + delay > self.max_wait:
+                self._count("rejected")
+                raise RateLimitError("""The calendar service is busy. Please try again in %.0f seconds.""" % delay,
+                                     detail=delay)
+
+            time.sleep(delay)
+            waited += delay
+
+    def backoff(self, seconds):
+        """Called when google reports that the rate limit has been exceeded. This uses up
+           the per-second budget for the next 'seconds' seconds on all instances"""
+        self._count("backoffs")
+        now = int(time.time())
+
+        offsets = {}
+
+        for i in range(0,int(seconds)+1):
+            (second_key, minute_key) = self._keys(now + i)
+            offsets[second_key] = self.per_second + 1
+
+        memcache.add_multi( dict( (key, 0) for key in offsets.keys() ), time=120 )
+        memcache.offset_multi(offsets, initial_value=0)
+
+    def usage(self):
+        """Return a dictionary describing the shared budget used in the current second and
+           minute, together with the statistics of the calls made from this instance"""
+        (second_key, minute_key) = self._keys(time.time())
+        counts = memcache.get_multi([second_key, minute_key])
+
+        usage = { "second_used" : counts.get(second_key, 0),
+                  "second_budget" : self.per_second,
+                  "minute_used" : counts.get(minute_key, 0),
+                  "minute_budget" : self.per_minute,
+                  "background_share" : self.background_share }
+
+        with self._lock:
+            usage.update(self.stats)
+
+        return usage
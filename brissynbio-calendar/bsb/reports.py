@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the booking reports, which add up the confirmed booking time
+   of each piece of equipment, project and user over a range of dates. Computed
+   reports are cached against the version of the booking data, which is bumped
+   whenever a booking is saved, so a cached report is always up to date. The
+   default window and the windows either side of any viewed window are computed
+   in the background, so that paging through the reports does not wait"""
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+import datetime
+import time
+
+from bsb import *
+
+import equipment
+
+# How long (in seconds) a computed report is cached. Reports are replaced as soon
+# as the bookings change, so this only limits how long unused reports are kept
+REPORT_CACHE_TIME = 24 * 60 * 60
+
+# The length of the report windows, matching the older and newer links on the reports page
+REPORT_WINDOW = datetime.timedelta(days=7)
+
+# The path of the task that precomputes the reports
+PRECOMPUTE_TASK_PATH = "/tasks/precompute_reports"
+
+class ReportResult(object):
+    """The statistics of the confirmed bookings in a range of dates. Times are in minutes"""
+    def __init__(self, range_start, range_end):
+        self.range_start = range_start
+        self.range_end = range_end
+
+        self.nbookings = 0
+        self.total_time = 0
+
+        self.equip_stats = {}
+        self.proj_stats = {}
+        self.email_stats = {}
+
+        self.equips = []
+        self.projs = []
+        self.emails = []
+
+        # problems found with the bookings, e.g. a booking without a project
+        self.errors = []
+
+def _version_key(registry):
+    return "report_data_version_%s" % registry
+
+def get_data_version(registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Return the current version of the booking data. If the version has been evicted
+       from memcache it restarts from the current time, so it never repeats a version"""
+    k = _version_key(registry)
+    version = memcache.get(k)
+
+    if version is None:
+        memcache.add(k, int(time.time() * 1000))
+        version = memcache.get(k)
+
+        if version is None:
+            # memcache is unavailable, so never match a cached report
+            version = int(time.time() * 1000)
+
+    return version
+
+def bookings_changed(registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Called after a booking has been saved. This bumps the version of the booking data,
+       so that every cached report is replaced, and queues the recomputation of the
+       default window so that the first person to view the reports does not wait"""
+    memcache.incr(_version_key(registry))
+
+    if registry == equipment.DEFAULT_BOOKING_REGISTRY:
+        # only queue one recomputation a minute, however many bookings change
+        bucket = int(time.time()) // 60 + 1
+
+        try:
+            taskqueue.add(url=PRECOMPUTE_TASK_PATH, name="precompute-reports-%d" % bucket,
+                          countdown=max(0, bucket * 60 - time.time()))
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+def _report_key(range_start, range_end, registry, version):
+    return "report_%s_%s_%s_%d" % (registry, range_start.strftime("%Y%m%d%H%M"),
+                                   range_end.strftime("%Y%m%d%H%M"), version)
+
+def compute_report(range_start, range_end, registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Compute the statistics of the confirmed bookings between 'range_start' and 'range_end'"""
+    result = ReportResult(range_start, range_end)
+
+    bookings = equipment.get_bookings_async(start_time=range_start, end_time=range_end,
+                                            registry=registry, lazy=True).get_result()
+
+    equip_stats = result.equip_stats
+    proj_stats = result.proj_stats
+    user_stats = result.email_stats
+
+    for booking in bookings:
+        if not booking.isConfirmed():
+            continue
+
+        run_time = (booking.end_time - booking.start_time).total_seconds() / 60.0
+        result.total_time += run_time
+        equip = booking.equipment
+        proj = booking.project
+        email = booking.email
+        result.nbookings += 1
+
+        if proj is None:
+            result.errors.append( "No project for booking %s %s" % (equip,email) )
+
+        if not equip in equip_stats:
+            equip_stats[equip] = {}
+            equip_stats[equip]["_total"] = 0
+
+        if not proj in proj_stats:
+            proj_stats[proj] = {}
+            proj_stats[proj]["_total"] = 0
+
+        if not email in user_stats:
+            user_stats[email] = {}
+            user_stats[email]["_total"] = 0
+
+        if not proj in equip_stats[equip]:
+            equip_stats[equip][proj] = 0.0
+
+        if not email in equip_stats[equip]:
+            equip_stats[equip][email] = 0.0
+
+        if not proj in user_stats[email]:
+            user_stats[email][proj] = 0.0
+
+        if not equip in user_stats[email]:
+            user_stats[email][equip] = 0.0
+
+        if not equip in proj_stats[proj]:
+            proj_stats[proj][equip] = 0.0
+
+        if not email in proj_stats[proj]:
+            proj_stats[proj][email] = 0.0
+
+        equip_stats[equip]["_total"] += run_time
+        equip_stats[equip][proj] += run_time
+        equip_stats[equip][email] += run_time
+        proj_stats[proj]["_total"] += run_time
+        proj_stats[proj][equip] += run_time
+        proj_stats[proj][email] += run_time
+        user_stats[email]["_total"] += run_time
+        user_stats[email][proj] += run_time
+        user_stats[email][equip] += run_time
+
+    result.equips = sorted(equip_stats.keys())
+    result.projs = sorted(proj_stats.keys())
+    result.emails = sorted(user_stats.keys())
+
+    return result
+
+def get_report(range_start, range_end, registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Return the statistics of the confirmed bookings between 'range_start' and 'range_end',
+       computing them only if they are not cached for the current version of the bookings"""
+    # read the version before the bookings, so that a booking saved while the report is
+    # computed bumps the version past the one this report is saved under
+    k = _report_key(range_start, range_end, registry, get_data_version(registry))
+
+    result = memcache.get(k)
+
+    if result is None:
+        result = compute_report(range_start, range_end, registry)
+        memcache.set(k, result, time=REPORT_CACHE_TIME)
+
+    return result
+
+def default_window(now_time=None):
+    """Return the (range_start, range_end) shown by default on the reports page"""
+    if now_time is None:
+        now_time = get_now_time()
+
+    today_start = datetime.datetime(now_time.year, now_time.month, now_time.day)
+
+    return (today_start, today_start + REPORT_WINDOW)
+
+def adjacent_windows(range_start, range_end):
+    """Return the older and newer windows linked from the report of the passed window"""
+    return [ (range_start - REPORT_WINDOW, range_start), (range_end, range_end + REPORT_WINDOW) ]
+
+def _missing_windows(windows, registry):
+    version = get_data_version(registry)
+    keys = dict( [(_report_key(start, end, registry, version), (start, end)) for (start, end) in windows] )
+    cached = memcache.get_multi(keys.keys())
+
+    return [ keys[k] for k in keys.keys() if not k in cached ]
+
+def precompute_reports(range_start=None, range_end=None, registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Compute and cache the report of the passed window (default the default window) and
+       of the windows either side of it, unless they are already cached. Returns the
+       number of reports that were computed"""
+    if not (range_start and range_end):
+        (range_start, range_end) = default_window()
+
+    windows = _missing_windows([(range_start, range_end)] + adjacent_windows(range_start, range_end), registry)
+
+    for (start, end) in windows:
+        get_report(start, end, registry)
+
+    return len(windows)
+
+def queue_adjacent_reports(range_start, range_end, registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Queue the precomputation of the windows either side of the passed window, if they
+       are not already cached. This is called when a report is viewed"""
+    if registry != equipment.DEFAULT_BOOKING_REGISTRY:
+        return
+
+    if _missing_windows(adjacent_windows(range_start, range_end), registry):
+        taskqueue.add(url=PRECOMPUTE_TASK_PATH, params={ "range_start" : range_start.strftime("%d-%m-%Y"),
+                                                         "range_end" : range_end.strftime("%d-%m-%Y") })
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the utilisation engine, which works out how much of each
+   hour of the week each piece of equipment is booked. Each booking is converted
+   into a (start, end) interval of minutes on the local wall clock, and is added
+   to the 168 hour-of-week bins of its equipment in constant time using a circular
+   difference array, so the cost is proportional to the number of bookings plus
+   168 per piece of equipment, however long the range"""
+
+from google.appengine.api import memcache
+
+import datetime
+
+from bsb import *
+
+import equipment
+import reports
+
+# The number of hour bins in a week, starting from Monday 00:00
+HOURS_PER_WEEK = 7 * 24
+
+DAY_NAMES = [ "Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun" ]
+
+# How long (in seconds) a computed utilisation matrix is cached. Matrices are replaced
+# as soon as the bookings change, so this only limits how long unused matrices are kept
+UTILISATION_CACHE_TIME = 24 * 60 * 60
+
+def _to_local(t):
+    """Return the passed UTC time as a naive time on the local wall clock"""
+    return localise_time(t).replace(tzinfo=None)
+
+def _from_local(t):
+    """Return the passed naive local wall clock time as a naive UTC time"""
+    return to_utc(t.replace(tzinfo=GMT_TZ()))
+
+def _minutes(t, origin):
+    """Return the number of wall clock minutes from 'origin' to 't'"""
+    delta = t - origin
+    return delta.days * 1440 + delta.seconds // 60
+
+class _Bins(object):
+    """The minutes occupied in each hour-of-week bin. Whole hours are added to a
+       circular difference array, so an interval of any length costs O(1)"""
+    __slots__ = ("diff", "edges", "full")
+
+    def __init__(self):
+        self.diff = [0] * (HOURS_PER_WEEK+1)
+        self.edges = [0] * HOURS_PER_WEEK
+        self.full = 0
+
+    def _addHours(self, first, last, minutes):
+        """Add 'minutes' to every absolute hour from 'first' up to (not including) 'last'"""
+        n = last - first
+
+        if n <= 0:
+            return
+
+        # every whole week adds to every bin
+        (weeks, rest) = divmod(n, HOURS_PER_WEEK)
+        self.full += weeks * minutes
+
+        if rest:
+            start = first % HOURS_PER_WEEK
+            end = start + rest
+
+            self.diff[start] += minutes
+
+            if end <= HOURS_PER_WEEK:
+                self.diff[end] -= minutes
+            else:
+                self.diff[HOURS_PER_WEEK] -= minutes
+                self.diff[0] += minutes
+                self.diff[end - HOURS_PER_WEEK] -= minutes
+
+    def add(self, start, end):
+        """Add the interval from minute 'start' to minute 'end'"""
+        if end <= start:
+            return
+
+        (first_hour, first_minute) = divmod(start, 60)
+        (last_hour, last_minute) = divmod(end, 60)
+
+        if first_hour == last_hour:
+            self.edges[first_hour % HOURS_PER_WEEK] += end - start
+            return
+
+        # the partial hours at each end, then all of the whole hours in between
+        self.edges[first_hour % HOURS_PER_WEEK] += 60 - first_minute
+
+        if last_minute:
+            self.edges[last_hour % HOURS_PER_WEEK] += last_minute
+
+        self._addHours(first_hour + 1, last_hour, 60)
+
+    def totals(self):
+        """Return the list of minutes occupied in each hour-of-week bin"""
+        totals = []
+        running = self.full
+
+        for i in range(0, HOURS_PER_WEEK):
+            running += self.diff[i]
+            totals.append(running + self.edges[i])
+
+        return totals
+
+class UtilisationMatrix(object):
+    """The hour-of-week x equipment occupancy matrix for a range of dates"""
+    def __init__(self, range_start, range_end, equipment_ids, occupied, capacity):
+        self.range_start = range_start
+        self.range_end = range_end
+        self.equipment = equipment_ids
+        self.occupied = occupied
+        self.capacity = capacity
+
+    def utilisation(self, equip):
+        """Return the list of the fraction of each hour of the week that 'equip' was booked"""
+        occupied = self.occupied.get(equip)
+
+        if not occupied:
+            return [0.0] * HOURS_PER_WEEK
+
+        return [ (float(occupied[i]) / self.capacity[i]) if self.capacity[i] else 0.0
+                     for i in range(0, HOURS_PER_WEEK) ]
+
+    def overall(self):
+        """Return the list of the mean utilisation of all of the equipment in each hour of the week"""
+        if not self.equipment:
+            return [0.0] * HOURS_PER_WEEK
+
+        total = [0] * HOURS_PER_WEEK
+
+        for equip in self.equipment:
+            occupied = self.occupied.get(equip)
+
+            if occupied:
+                total = [ total[i] + occupied[i] for i in range(0, HOURS_PER_WEEK) ]
+
+        n = len(self.equipment)
+
+        return [ (float(total[i]) / (n * self.capacity[i])) if self.capacity[i] else 0.0
+                     for i in range(0, HOURS_PER_WEEK) ]
+
+    def meanUtilisation(self, equip):
+        """Return the fraction of the whole range that 'equip' was booked"""
+        occupied = self.occupied.get(equip)
+
+        if not occupied or not sum(self.capacity):
+            return 0.0
+
+        return float(sum(occupied)) / sum(self.capacity)
+
+    @classmethod
+    def dayGrid(cls, values):
+        """Return the passed hour-of-week values as a list of (day name, 24 hourly values)"""
+        return [ (DAY_NAMES[day], values[day*24:(day+1)*24]) for day in range(0,7) ]
+
+def compute_utilisation(range_start, range_end, laboratory=None, equipment_type=None,
+                        registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Compute the utilisation matrix of the confirmed bookings between the local dates
+       'range_start' and 'range_end', optionally only for the equipment in one laboratory
+       and/or of one type. Times are binned on the local wall clock, so an hour bin holds
+       the same local hour on either side of a change to or from daylight saving time"""
+    if range_start > range_end:
+        (range_start, range_end) = (range_end, range_start)
+
+    # the bins start at midnight local time on the Monday of the first week
+    origin = datetime.datetime(range_start.year, range_start.month, range_start.day)
+    origin -= datetime.timedelta(days=origin.weekday())
+
+    local_start = _minutes(range_start, origin)
+    local_end = _minutes(range_end, origin)
+
+    equip_ids = None
+
+    if laboratory or equipment_type:
+        labs = equipment.get_laboratory_for_equipment_mapping()
+        types = equipment.get_type_for_equipment_mapping()
+
+        equip_ids = set()
+
+        for equip in labs.keys():
+            if laboratory and labs[equip][0] != laboratory:
+                continue
+
+            if equipment_type and types.get(equip, (None,None))[0] != equipment_type:
+                continue
+
+            equip_ids.add(equip)
+
+    query = equipment.Booking.getQuery(registry).filter(equipment.Booking.status == equipment.Booking.confirmed()) \
+                                                .filter(equipment.Booking.end_time > _from_local(range_start))
+
+    bins = {}
+
+    for item in query.iter(use_cache=False, use_memcache=False):
+        equip = item.equipment()
+
+        if equip_ids is not None and not equip in equip_ids:
+            continue
+
+        start = max(local_start, _minutes(_to_local(item.start_time), origin))
+        end = min(local_end, _minutes(_to_local(item.end_time), origin))
+
+        if start < end:
+            if not equip in bins:
+                bins[equip] = _Bins()
+
+            bins[equip].add(start, end)
+
+    capacity = _Bins()
+    capacity.add(local_start, local_end)
+
+    if equip_ids is None:
+        equip_ids = set(equipment.get_equipment_mapping().keys())
+
+    occupied = {}
+
+    for equip in bins.keys():
+        occupied[equip] = bins[equip].totals()
+
+    return UtilisationMatrix(range_start, range_end, sorted(equip_ids), occupied, capacity.totals())
+
+def get_utilisation(range_start, range_end, laboratory=None, equipment_type=None,
+                    registry=equipment.DEFAULT_BOOKING_REGISTRY):
+    """Return the utilisation matrix for the passed range and filters. This is cached
+       until the bookings next change"""
+    k = "utilisation_%s_%s_%s_%s_%s_%d" % (registry, range_start.strftime("%Y%m%d%H%M"),
+                                           range_end.strftime("%Y%m%d%H%M"), laboratory, equipment_type,
+                                           reports.get_data_version(registry))
+
+    matrix = memcache.get(k)
+
+    if matrix is None:
+        matrix = compute_utilisation(range_start, range_end, laboratory, equipment_type, registry)
+        memcache.set(k, matrix, time=UTILISATION_CACHE_TIME)
+
+    return matrix
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the functions used to warm up a new instance of the
+   BrisSynBio equipment scheduler, so that the first real request served
+   by the instance does not have to pay for seeding and cache building"""
+
+import time
+
+from bsb import *
+
+import projects
+import accounts
+import equipment
+
+def seed_datastore():
+    """Perform the one-time seeding of the datastore that is needed before
+       the first page can be served"""
+    projects.seed_special_projects()
+
+def prime_caches():
+    """Populate the memcache with the reference mappings used on
+       nearly every page"""
+    accounts.get_account_mapping()
+    accounts.get_sorted_account_mapping()
+
+    projects.get_project_mapping()
+    projects.get_sorted_project_mapping()
+
+    equipment.get_equipment_mapping()
+    equipment.get_sorted_equipment_mapping()
+    equipment.get_laboratory_mapping()
+    equipment.get_sorted_laboratory_mapping()
+    equipment.get_equipment_type_mapping()
+    equipment.get_sorted_equipment_type_mapping()
+    equipment.get_equipment_hierarchy()
+    equipment.get_laboratory_for_equipment_mapping()
+    equipment.get_type_for_equipment_mapping()
+
+    # this also initialises the counters on a freshly deployed application
+    accounts.number_of_accounts()
+    accounts.number_of_account_to_approve()
+    equipment.number_of_equipment()
+    equipment.number_of_bookings()
+
+def warmup():
+    """Warm up this instance. This seeds the datastore and then primes the
+       caches, returning a list of (step, seconds) timings"""
+    timings = []
+
+    for (step, func) in [ ("seed datastore", seed_datastore),
+                          ("prime caches", prime_caches) ]:
+        start = time.time()
+        func()
+        timings.append( (step, time.time() - start) )
+
+    return timings
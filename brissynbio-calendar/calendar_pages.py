@@ -95,3 +95,55 @@ class CalendarNotVisiblePage(base_pages.BaseGetPage):
                                % (calendar.name, state.account.email) )
 
         self.write(state, "message.html", "Calendar | Not visible")
+
+class CalendarNotificationPage(webapp2.RequestHandler):
+    """Webhook that receives the push notifications sent by google when the events
+       in a watched calendar change. There is no login, as each notification is
+       checked against the secret token of its channel"""
+
+    def post(self):
+        try:
+            bsb.calendar_watch.handle_notification(self.request.headers)
+        except bsb.calendar_watch.InvalidNotificationError:
+            self.response.set_status(403)
+
+class CalendarFeedPage(webapp2.RequestHandler):
+    """Base class of the pages that serve the iCalendar feeds of the bookings. There
+       is no login, as calendar applications cannot sign in. Instead, each feed URL
+       is signed for the account that reads it, and that account's access is checked
+       on every request. Unchanged feeds are answered with a 304"""
+
+    def serveFeed(self, feed, email, signature):
+        try:
+            bsb.ical.check_access(feed, email, signature)
+        except bsb.ical.InvalidFeedError:
+            self.response.set_status(404)
+            return
+        except bsb.PermissionError:
+            self.response.set_status(403)
+            return
+
+        version = bsb.ical.get_version(feed)
+        etag = bsb.ical.get_etag(feed, version)
+
+        self.response.headers["ETag"] = etag
+        self.response.headers["Cache-Control"] = "private, max-age=%d" % bsb.ical.FEED_MAX_AGE
+
+        if etag in [ tag.strip() for tag in self.request.headers.get("If-None-Match", "").split(",") ]:
+            self.response.set_status(304)
+            return
+
+        self.response.headers["Content-Type"] = "text/calendar; charset=utf-8"
+        self.response.out.write( bsb.ical.get_feed(feed, version) )
+
+class EquipmentFeedPage(CalendarFeedPage):
+    """The iCalendar feed of the bookings of a piece of equipment"""
+
+    def get(self, equipment_idstring, email, signature):
+        self.serveFeed(bsb.ical.equipment_feed(equipment_idstring), email, signature)
+
+class UserFeedPage(CalendarFeedPage):
+    """The iCalendar feed of the bookings made by a user"""
+
+    def get(self, email, signature):
+        self.serveFeed(bsb.ical.user_feed(email), email, signature)
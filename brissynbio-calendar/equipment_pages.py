@@ -75,10 +75,15 @@ class EquipmentPage(base_pages.BasePostPage):
         state.setTemplate("equipment_mapping", bsb.equipment.get_equipment_mapping())
         self.write(state, "equipment.html", "Equipment")
 
-    def _itemCalendarPage(self, state, item, acl, is_demo=False):
+    def _itemCalendarPage(self, state, item, acl, is_demo=False, calendar=None):
+        """Show the calendar for 'item'. 'calendar' is the future for the calendar,
+           if its lookup has already been started"""
         if acl:
             if acl.isAuthorised():
-                calendar = item.getCalendar(state.account)
+                if calendar is None:
+                    calendar = item.getCalendar_async(state.account)
+
+                calendar = calendar.get_result()
                 state.setTemplate("item", item) 
                 state.setTemplate("calendar", calendar)
 
@@ -87,19 +92,34 @@ class EquipmentPage(base_pages.BasePostPage):
                 if item.constraints:
                     calendar_type = item.constraints.calendarType()
                 
-                state.setTemplate("calendar_html", calendar.getEmbedHTML(state.account, 
-                                                                         calendar_type=calendar_type))
+                calendar_html = None
+
+                if bsb.calendar.is_calendar_available():
+                    try:
+                        calendar_html = calendar.getEmbedHTML(state.account, calendar_type=calendar_type)
+                    except bsb.calendar.CalendarUnavailableError:
+                        pass
+
+                if calendar_html:
+                    state.setTemplate("calendar_html", calendar_html)
+                else:
+                    # google calendar is unavailable, so show the bookings from the datastore instead
+                    state.setTemplate("timeline", item.getTimeline())
+                    state.setTemplate("account_mapping", bsb.accounts.get_account_mapping())
 
         if is_demo:
             state.setTemplate("is_demo", True)
 
         self.write(state, "view_equipment.html", "Equipment | %s" % item.name)
 
-    def itemBookingPage(self, state, item, acl, is_post):
+    def itemBookingPage(self, state, item, acl, is_post, calendar=None, requirements_future=None):
         if not acl.isAuthorised():
             state.addError("You do not have permission to use this piece of equipment")
             return self.itemPage(state, item.idstring, is_post)
 
+        if requirements_future is None:
+            requirements_future = item.getRequirements_async()
+
         state.setTemplate("enable_popovers", True)
 
         action = self.request.get("booking_action", None)
@@ -118,18 +138,18 @@ class EquipmentPage(base_pages.BasePostPage):
 
             if (not start_time) or (not end_time):
                 state.addError("You must specify a start time and an end time for your booking!")
-                return self._itemCalendarPage(state, item, acl, is_demo=is_demo)
+                return self._itemCalendarPage(state, item, acl, is_demo=is_demo, calendar=calendar)
 
             try:
                 reservation = item.makeReservation(state.account, acl, start_time, end_time, is_demo=is_demo)
             except bsb.equipment.BookingError as e:
                 state.addError(e.errorMessage())
-                return self._itemCalendarPage(state, item, acl, is_demo=is_demo)
+                return self._itemCalendarPage(state, item, acl, is_demo=is_demo, calendar=calendar)
 
             if not is_demo:
                 state.setTemplate("equipment", item)
                 state.setTemplate("reservation", reservation)
-                state.setTemplate("requirements", item.getRequirements())
+                state.setTemplate("requirements", requirements_future.get_result())
                 self.write(state, "confirm_reservation.html", "Equipment | Confirm Reservation")
             else:
                 state.setTemplate("page_title", "Demo booking successful")
@@ -146,14 +166,14 @@ class EquipmentPage(base_pages.BasePostPage):
                                                      booking_id=bsb.to_string(self.request.get("reservation",None)) )
             state.setTemplate("equipment", item)
             state.setTemplate("reservation", reservation)
-            state.setTemplate("requirements", item.getRequirements())
+            state.setTemplate("requirements", requirements_future.get_result())
             self.write(state, "confirm_reservation.html", "Equipment | Confirm Reservation")
             return
 
         elif action == "demo_booking":
             state.setTemplate("equipment", item)
             state.setTemplate("reservation", None)
-            state.setTemplate("requirements", item.getRequirements())
+            state.setTemplate("requirements", requirements_future.get_result())
             self.write(state, "confirm_reservation.html", "Equipment | Demo Booking")
             return
 
@@ -176,7 +196,7 @@ class EquipmentPage(base_pages.BasePostPage):
             if not project:
                 errors.append( "You must specify the project to which this booking will be assigned." )
 
-            requirements = item.getRequirements()
+            requirements = requirements_future.get_result()
 
             if requirements:
                 try:
@@ -199,7 +219,7 @@ class EquipmentPage(base_pages.BasePostPage):
 
                 state.setTemplate("supplied", supplied)
                 state.setTemplate("equipment", item)
-                state.setTemplate("requirements", item.getRequirements())
+                state.setTemplate("requirements", requirements_future.get_result())
                 state.setTemplate("booking_action", action)
                 self.write(state, "confirm_reservation.html", "Equipment | Demo Booking")
                 return
@@ -244,7 +264,7 @@ class EquipmentPage(base_pages.BasePostPage):
         else:
             state.addError("Unrecognised action '%s'" % action)
 
-        self._itemCalendarPage(state, item, acl)
+        self._itemCalendarPage(state, item, acl, calendar=calendar)
 
     def itemAdminConsPage(self, state, item, acl, is_post):
         if not acl.isAdministrator(): 
@@ -568,21 +588,34 @@ class EquipmentPage(base_pages.BasePostPage):
             state.setTemplate("Cannot find the piece of equipment with ID '%s'" % item_id)
             return self.overviewPage(state, is_post)
 
-        acl = item.getACL(state.account)
+        # these lookups are independent, so start them all before waiting for any
+        acl = item.getACL_async(state.account)
+        laboratory_mapping = bsb.equipment.get_laboratory_mapping_async()
+        type_mapping = bsb.equipment.get_equipment_type_mapping_async()
+        projects = bsb.projects.get_sorted_project_mapping_async()
+        project_mapping = bsb.projects.get_project_mapping_async()
+
+        # get the list of any current, unresolved reported problems with this piece of equipment,
+        # so at least the user can see if something is wrong when they are making the booking
+        unresolved_problems = item.getUnresolvedFeedBack_async()
+
+        # the calendar and the booking requirements are only read by some of the actions
+        # below, so these futures are only waited on if they are needed
+        calendar = item.getCalendar_async(state.account)
+        requirements = item.getRequirements_async()
+
+        acl = acl.get_result()
+        unresolved_problems = unresolved_problems.get_result()
         
         # we don't want to see the second set of menu links
         state.setTemplate("second_menu_links", None)
 
         state.setTemplate("item", item)
         state.setTemplate("acl", acl)
-        state.setTemplate("laboratory_mapping", bsb.equipment.get_laboratory_mapping())
-        state.setTemplate("type_mapping", bsb.equipment.get_equipment_type_mapping())
-        state.setTemplate("projects", bsb.projects.get_sorted_project_mapping())
-        state.setTemplate("project_mapping", bsb.projects.get_project_mapping())
-
-        # get the list of any current, unresolved reported problems with this piece of equipment,
-        # so at least the user can see if something is wrong when they are making the booking
-        unresolved_problems = item.getUnresolvedFeedBack()
+        state.setTemplate("laboratory_mapping", laboratory_mapping.get_result())
+        state.setTemplate("type_mapping", type_mapping.get_result())
+        state.setTemplate("projects", projects.get_result())
+        state.setTemplate("project_mapping", project_mapping.get_result())
 
         if unresolved_problems:
             state.addError("<strong>There are currently unresolved problems with this piece of equipment.</strong>")
@@ -599,7 +632,7 @@ class EquipmentPage(base_pages.BasePostPage):
 
             if action == "book":
                 if acl and acl.isAuthorised():
-                    return self.itemBookingPage(state, item, acl, is_post)
+                    return self.itemBookingPage(state, item, acl, is_post, calendar, requirements)
                 else:
                     state.addError("You do not have permission to book this piece of equipment")
 
@@ -650,7 +683,7 @@ class EquipmentPage(base_pages.BasePostPage):
             else:
                 state.addError("Unknown action '%s' for this piece of equipment." % action)
 
-        self._itemCalendarPage(state, item, acl)
+        self._itemCalendarPage(state, item, acl, calendar=calendar)
 
     def mapPage(self, state, is_post):
         state.setTemplate("map_html", """<iframe width="100%" height="600" frameborder="0" scrolling="no" marginheight="0" marginwidth="0" src="https://maps.google.com/maps?f=q&amp;source=s_q&amp;hl=en&amp;geocode=&amp;q=university+of+bristol&amp;aq=&amp;sll=37.0625,-95.677068&amp;sspn=56.856075,135.263672&amp;ie=UTF8&amp;hq=&amp;hnear=&amp;t=m&amp;iwloc=A&amp;ll=51.458417,-2.602979&amp;spn=0.006295,0.006295&amp;output=embed"></iframe><br /><small><a href="https://maps.google.com/maps?f=q&amp;source=embed&amp;hl=en&amp;geocode=&amp;q=university+of+bristol&amp;aq=&amp;sll=37.0625,-95.677068&amp;sspn=56.856075,135.263672&amp;ie=UTF8&amp;hq=&amp;hnear=&amp;t=m&amp;iwloc=A&amp;ll=51.458417,-2.602979&amp;spn=0.006295,0.006295" style="color:#0000FF;text-align:left">View Larger Map</a></small>""")
@@ -673,15 +706,17 @@ class EquipmentPage(base_pages.BasePostPage):
             else:
                 state.addError("Unrecognised action '%s'" % action)
 
-        state.setTemplate("equipment_mapping", bsb.equipment.get_equipment_mapping())
-        state.setTemplate("laboratory_for_equipment", bsb.equipment.get_laboratory_for_equipment_mapping())
-        state.setTemplate("type_for_equipment", bsb.equipment.get_type_for_equipment_mapping())
         now_time = bsb.get_now_time()
         today_start = bsb.get_day_from(now_time)
         tomorrow_start = today_start + datetime.timedelta(days=1)
-        state.setTemplate("today_bookings", bsb.equipment.get_bookings_for_user(state.account,
-                                                range_start=today_start, range_end=tomorrow_start))
-        state.setTemplate("bookings", bsb.equipment.get_bookings_for_user(state.account, range_start=tomorrow_start))
+
+        # start all of the independent lookups before waiting for any of them
+        equipment_mapping = bsb.equipment.get_equipment_mapping_async()
+        laboratory_for_equipment = bsb.equipment.get_laboratory_for_equipment_mapping_async()
+        type_for_equipment = bsb.equipment.get_type_for_equipment_mapping_async()
+        today_bookings = bsb.equipment.get_bookings_for_user_async(state.account,
+                                                range_start=today_start, range_end=tomorrow_start, lazy=True)
+        bookings = bsb.equipment.get_bookings_for_user_async(state.account, range_start=tomorrow_start, lazy=True)
 
         old_range_start = bsb.to_date(self.request.get("range_start"))
         old_range_end = bsb.to_date(self.request.get("range_end"))
@@ -715,8 +750,16 @@ class EquipmentPage(base_pages.BasePostPage):
         state.setTemplate("newer_range_start", old_range_end)
         state.setTemplate("newer_range_end", min(now_time, old_range_end + datetime.timedelta(days=7)))
 
-        state.setTemplate("old_bookings", bsb.equipment.get_bookings_for_user(state.account, range_start=old_range_start,
-                                                                              range_end=old_range_end, reverse_sort=True))
+        old_bookings = bsb.equipment.get_bookings_for_user_async(state.account, range_start=old_range_start,
+                                                                 range_end=old_range_end, reverse_sort=True,
+                                                                 lazy=True)
+
+        state.setTemplate("equipment_mapping", equipment_mapping.get_result())
+        state.setTemplate("laboratory_for_equipment", laboratory_for_equipment.get_result())
+        state.setTemplate("type_for_equipment", type_for_equipment.get_result())
+        state.setTemplate("today_bookings", today_bookings.get_result())
+        state.setTemplate("bookings", bookings.get_result())
+        state.setTemplate("old_bookings", old_bookings.get_result())
 
         state.setTemplate("really_cancel", self.request.get("really_cancel"))
 
@@ -148,9 +148,16 @@ class ViewForumPage(base_pages.BasePostPage):
         if topic_mask is None:
             topic_mask = "open"
 
-        state.setTemplate("feedback", bsb.feedback.get_feedback(state.account, old_range_start, 
-                                                                old_range_end + datetime.timedelta(days=1),
-                                                                topic_mask=topic_mask))
+        page = bsb.feedback.get_feedback_page(state.account, old_range_start,
+                                              old_range_end + datetime.timedelta(days=1),
+                                              topic_mask=topic_mask,
+                                              cursor=bsb.to_string(self.request.get("cursor", None)))
+
+        state.setTemplate("feedback", page.items)
+        state.setTemplate("page", page)
+        state.setTemplate("page_args", "range_start=%s&range_end=%s&topic_mask=%s" % \
+                                          (old_range_start.strftime("%d-%m-%Y"), 
+                                           old_range_end.strftime("%d-%m-%Y"), topic_mask))
 
         self.write(state, "view_forum.html", "Forum")
 
@@ -236,6 +243,7 @@ class ViewFeedBackPage(base_pages.BasePostPage):
             self.redirect(self.request.uri)
 
         state.setTemplate("feedback", feedback)
+        state.setTemplate("message_page", feedback.getMessages(self.request.get("cursor", None)))
         state.setTemplate("resolved_info", resolve_info)
         state.setTemplate("account_mapping", bsb.accounts.get_account_mapping())
 
@@ -49,93 +49,138 @@ class ReportPage(base_pages.BaseGetPage):
         state.setTemplate("newer_range_start", old_range_end)
         state.setTemplate("newer_range_end", old_range_end + datetime.timedelta(days=7))
 
-        state.setTemplate("account_mapping", bsb.accounts.get_account_mapping())
-
-        bookings = bsb.equipment.get_bookings(start_time=old_range_start, end_time=old_range_end)
-
-        equip_stats = {}
-        proj_stats = {}
-        user_stats = {}
-
-        total_time = 0
-        nbookings = 0
-
-        for booking in bookings:
-            if not booking.isConfirmed():
-                continue
-
-            run_time = (booking.end_time - booking.start_time).total_seconds() / 60.0
-            total_time += run_time
-            equip = booking.equipment
-            proj = booking.project
-            email = booking.email
-            nbookings += 1
-
-            if proj is None:
-                state.addError( "No project for booking %s %s" % (equip,email) )
-
-            if not equip in equip_stats:
-                equip_stats[equip] = {}
-                equip_stats[equip]["_total"] = 0
-
-            if not proj in proj_stats:
-                proj_stats[proj] = {}
-                proj_stats[proj]["_total"] = 0
-
-            if not email in user_stats:
-                user_stats[email] = {}
-                user_stats[email]["_total"] = 0
-
-            if not proj in equip_stats[equip]:
-                equip_stats[equip][proj] = 0.0
-
-            if not email in equip_stats[equip]:
-                equip_stats[equip][email] = 0.0
-
-            if not proj in user_stats[email]:
-                user_stats[email][proj] = 0.0
-
-            if not equip in user_stats[email]:
-                user_stats[email][equip] = 0.0
-
-            if not equip in proj_stats[proj]:
-                proj_stats[proj][equip] = 0.0
-
-            if not email in proj_stats[proj]:
-                proj_stats[proj][email] = 0.0
-
-            equip_stats[equip]["_total"] += run_time
-            equip_stats[equip][proj] += run_time
-            equip_stats[equip][email] += run_time
-            proj_stats[proj]["_total"] += run_time
-            proj_stats[proj][equip] += run_time
-            proj_stats[proj][email] += run_time
-            user_stats[email]["_total"] += run_time
-            user_stats[email][proj] += run_time
-            user_stats[email][equip] += run_time
-
-        equips = list(equip_stats.keys())
-        equips.sort()
-        projs = list(proj_stats.keys())
-        projs.sort()
-        emails = list(user_stats.keys())
-        emails.sort()
-
-        state.setTemplate("equips_dict", bsb.equipment.get_equipment_dict())
-        state.setTemplate("projects_dict", bsb.projects.get_project_mapping())
-        state.setTemplate("emails_dict", bsb.accounts.get_account_mapping())
-
-        state.setTemplate("nbookings", nbookings)
-        state.setTemplate("nemails", len(emails))
-        state.setTemplate("nprojs", len(projs))
-        state.setTemplate("nequips", len(equips))
-        state.setTemplate("total_time", total_time)
-
-        state.setTemplate("equips", equips)
-        state.setTemplate("projs", projs)
-        state.setTemplate("emails", emails)
-        state.setTemplate("equip_stats", equip_stats)
-        state.setTemplate("proj_stats", proj_stats)
-        state.setTemplate("email_stats", user_stats)
+        # start all of the lookups together, as none depend on any other
+        account_mapping = bsb.accounts.get_account_mapping_async()
+        equips_dict = bsb.equipment.get_equipment_dict_async(lazy=True)
+        projects_dict = bsb.projects.get_project_mapping_async()
+
+        # the statistics are cached until the bookings next change
+        report = bsb.reports.get_report(old_range_start, old_range_end)
+
+        for error in report.errors:
+            state.addError(error)
+
+        state.setTemplate("account_mapping", account_mapping.get_result())
+
+        state.setTemplate("equips_dict", equips_dict.get_result())
+        state.setTemplate("projects_dict", projects_dict.get_result())
+        state.setTemplate("emails_dict", account_mapping.get_result())
+
+        state.setTemplate("nbookings", report.nbookings)
+        state.setTemplate("nemails", len(report.emails))
+        state.setTemplate("nprojs", len(report.projs))
+        state.setTemplate("nequips", len(report.equips))
+        state.setTemplate("total_time", report.total_time)
+
+        state.setTemplate("equips", report.equips)
+        state.setTemplate("projs", report.projs)
+        state.setTemplate("emails", report.emails)
+        state.setTemplate("equip_stats", report.equip_stats)
+        state.setTemplate("proj_stats", report.proj_stats)
+        state.setTemplate("email_stats", report.email_stats)
+
+        # the hour-of-week utilisation of the equipment, optionally in one lab or of one type
+        lab = bsb.to_string(self.request.get("lab"))
+        typ = bsb.to_string(self.request.get("type"))
+
+        state.setTemplate("lab", lab)
+        state.setTemplate("type", typ)
+        state.setTemplate("labs", bsb.equipment.get_sorted_laboratory_mapping())
+        state.setTemplate("types", bsb.equipment.get_sorted_equipment_type_mapping())
+        state.setTemplate("utilisation", bsb.utilisation.get_utilisation(old_range_start, old_range_end, lab, typ))
+        state.setTemplate("day_grid", bsb.utilisation.UtilisationMatrix.dayGrid)
 
         self.write(state, "report.html", "Booking Reports")
+
+        # get the older and newer reports ready in case they are viewed next
+        bsb.reports.queue_adjacent_reports(old_range_start, old_range_end)
+
+class ExportPage(base_pages.BasePostPage):
+    """Class that exports the bookings as CSV, either streamed straight to the
+       browser or generated in the background as a file that is downloaded later"""
+
+    def needsAdmin(self):
+        return True
+
+    def saveReferrer(self):
+        return False
+
+    def _getParameters(self):
+        """Return the (range_start, range_end, equipment, status, compress) of the export"""
+        # these are the midnights that start the first and last days, and the
+        # export includes all of the bookings on the last day
+        range_start = bsb.to_date(self.request.get("range_start"))
+        range_end = bsb.to_date(self.request.get("range_end"))
+
+        if range_start and range_end and range_start > range_end:
+            (range_start, range_end) = (range_end, range_start)
+
+        status = bsb.to_int(self.request.get("status"))
+
+        return (range_start, range_end, bsb.to_string(self.request.get("equipment")),
+                status, bsb.to_bool(self.request.get("compress")))
+
+    def _writeFile(self, filename, compress, chunks):
+        """Write the passed chunks to the response as a file attachment"""
+        self.response.clear()
+
+        if compress:
+            self.response.headers["Content-Type"] = "application/gzip"
+        else:
+            self.response.headers["Content-Type"] = "text/csv; charset=utf-8"
+
+        self.response.headers["Content-Disposition"] = "attachment; filename=\"%s\"" % str(filename)
+
+        for chunk in chunks:
+            self.response.out.write(chunk)
+
+    def render_download(self, state):
+        (range_start, range_end, equipment, status, compress) = self._getParameters()
+
+        chunks = bsb.export.stream_bookings(state.account, range_start, range_end, equipment, status, compress)
+
+        self._writeFile(bsb.export.export_filename(range_start, range_end, compress), compress, chunks)
+
+    def render_file(self, state):
+        if len(state.extra_paths) < 2:
+            self.redirect("/export")
+            return
+
+        (export, chunks) = bsb.export.iter_export(state.account, state.extra_paths[1])
+        self._writeFile(export.filename(), export.compress, chunks)
+
+    def render_overview(self, state):
+        now_time = bsb.get_now_time()
+        today_start = datetime.datetime(now_time.year, now_time.month, now_time.day)
+
+        (range_start, range_end, equipment, status, compress) = self._getParameters()
+
+        state.setTemplate("range_start", range_start or datetime.datetime(today_start.year, 1, 1))
+        state.setTemplate("range_end", range_end or today_start)
+        state.setTemplate("equipment", bsb.equipment.get_sorted_equipment_mapping())
+        state.setTemplate("statuses", sorted(bsb.export.STATUS_NAMES.items()))
+        state.setTemplate("exports", bsb.export.list_exports(state.account))
+        state.setTemplate("equipment_mapping", bsb.equipment.get_equipment_mapping())
+        state.setTemplate("status_names", bsb.export.STATUS_NAMES)
+
+        self.write(state, "export.html", "Export Bookings")
+
+    def render_get(self, state):
+        if state.extra_paths is None:
+            self.render_overview(state)
+        elif state.extra_paths[0] == "download":
+            self.render_download(state)
+        elif state.extra_paths[0] == "file":
+            self.render_file(state)
+        elif state.extra_paths[0] == "delete" and len(state.extra_paths) > 1:
+            bsb.export.delete_export(state.account, state.extra_paths[1])
+            self.redirect("/export")
+        else:
+            self.redirect("/export")
+
+    def render_post(self, state):
+        if state.extra_paths and state.extra_paths[0] == "generate":
+            (range_start, range_end, equipment, status, compress) = self._getParameters()
+            bsb.export.start_export(state.account, range_start, range_end, equipment, status, compress)
+
+        self.redirect("/export")
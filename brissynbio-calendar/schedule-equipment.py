@@ -37,6 +37,7 @@ application = webapp2.WSGIApplication([
     ('/reports', "report_pages.ReportPage"),
     ('/admin', "admin_pages.AdminPage"),
     ('/admin/summary', "admin_pages.AdminPage"),
+    ('/admin/warmup', "warmup_pages.LocalWarmupPage"),
     ('/admin/backup', "admin_pages.BackupPage"),
     ('/admin/backup/([\w_\d@\.]+)', "admin_pages.BackupPage"),
     ('/admin/backup/([\w_\d@\.]+)/([\w\d_]+)', "admin_pages.BackupPage"),
@@ -49,6 +50,9 @@ application = webapp2.WSGIApplication([
     ('/report', "report_pages.ReportPage"),
     ('/report/([\w_]+)', "report_pages.ReportPage"),
     ('/report/([\w_]+)/([\w_\d@\.]+)', "report_pages.ReportPage"),
+    ('/export', "report_pages.ExportPage"),
+    ('/export/([\w_]+)', "report_pages.ExportPage"),
+    ('/export/([\w_]+)/([\d]+)', "report_pages.ExportPage"),
     ('/admin/equipment', "admin_pages.AdminEquipmentPage"),
     ('/admin/equipment/([\w_]+)', "admin_pages.AdminEquipmentPage"),
     ('/admin/equipment/([\w_]+)/([\w_\d@\.]+)', "admin_pages.AdminEquipmentPage"),
@@ -60,6 +64,12 @@ application = webapp2.WSGIApplication([
     ('/admin/calendars/([\w_\d@\.]+)/([\w\d_]+)/([\w\d_]+)', "admin_pages.AdminCalendarPage"),
     ('/admin/feedback', "admin_pages.AdminFeedBackPage"),
     ('/admin/feedback/([\w_]+)', "admin_pages.AdminFeedBackPage"),
+    ('/admin/query_audit', "admin_pages.AdminQueryAuditPage"),
+    ('/admin/query_audit/([\w_]+)', "admin_pages.AdminQueryAuditPage"),
+    ('/admin/billing', "admin_pages.AdminBillingPage"),
+    ('/admin/billing/([\w_]+)', "admin_pages.AdminBillingPage"),
+    ('/admin/billing/([\w_]+)/([\d\-]+)', "admin_pages.AdminBillingPage"),
+    ('/admin/billing/([\w_]+)/([\d\-]+)/([\w_\d@\.]+)', "admin_pages.AdminBillingPage"),
     ('/admin/bugs', "admin_pages.AdminBugsPage"),
     ('/admin/bugs/([\w_]+)', "admin_pages.AdminBugsPage"),
     ('/feedback/leave_feedback', "feedback_pages.LeaveFeedBackPage"),
@@ -73,4 +83,18 @@ application = webapp2.WSGIApplication([
     ('/calendar/not_visible', "calendar_pages.CalendarNotVisiblePage"),
     ('/calendar/disconnect_account', "calendar_pages.DisconnectCalendarPage"),
     ('/calendar/oauth2callback', "calendar_pages.CalendarOAuth2Page"),
+    ('/calendar/notify', "calendar_pages.CalendarNotificationPage"),
+    ('/feeds/equipment/([\w_\d@\.]+)/([^/]+)/([\w\d]+)\.ics', "calendar_pages.EquipmentFeedPage"),
+    ('/feeds/user/([^/]+)/([\w\d]+)\.ics', "calendar_pages.UserFeedPage"),
+    ('/_ah/warmup', "warmup_pages.WarmupPage"),
+    ('/tasks/reconcile_counters', "task_pages.ReconcileCountersTask"),
+    ('/tasks/reconcile_calendars', "task_pages.ReconcileCalendarsTask"),
+    ('/tasks/flush_bug', "task_pages.FlushBugTask"),
+    ('/tasks/sync_calendar', "task_pages.SyncCalendarTask"),
+    ('/tasks/renew_calendar_channels', "task_pages.RenewCalendarChannelsTask"),
+    ('/tasks/post_local_notifications', "task_pages.PostLocalNotificationsTask"),
+    ('/tasks/export_bookings', "task_pages.ExportBookingsTask"),
+    ('/tasks/run_billing', "task_pages.RunBillingTask"),
+    ('/tasks/restore_backup', "task_pages.RestoreBackupTask"),
+    ('/tasks/precompute_reports', "task_pages.PrecomputeReportsTask"),
 ], config=session_config, debug=True)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Pages that are run as background tasks, either by cron or the task queue.
+   These are restricted to administrators in app.yaml"""
+
+# web application framework
+import webapp2
+
+# BSB interface
+import bsb
+
+class BaseTask(webapp2.RequestHandler):
+    """Base class of all background tasks"""
+
+    def run_task(self):
+        """Override this function to perform the task. This should return
+           a short message describing what was done"""
+        raise bsb.IncompleteCodeError("run_task has not been implemented for this task")
+
+    def _run(self):
+        message = self.run_task()
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.write(message or "Done")
+
+    def get(self):
+        self._run()
+
+    def post(self):
+        self._run()
+
+class ReconcileCountersTask(BaseTask):
+    """Task that recounts the datastore to correct the maintained counters"""
+
+    def run_task(self):
+        bsb.counters.reconcile_all()
+        return "Counters reconciled"
+
+class FlushBugTask(BaseTask):
+    """Task that writes the occurrences of a bug that were buffered in memcache
+       while the bug was being reported too often to write each one"""
+
+    def run_task(self):
+        n = bsb.feedback.flush_bug(self.request.get("fingerprint"),
+                                   self.request.get("registry", bsb.feedback.DEFAULT_BUGS_REGISTRY))
+
+        return "Wrote %d occurrences" % n
+
+class ReconcileCalendarsTask(BaseTask):
+    """Task that incrementally reconciles the google calendars against the bookings,
+       repairing any events that have drifted"""
+
+    def run_task(self):
+        with bsb.rate_limit.priority(bsb.rate_limit.BACKGROUND):
+            reports = bsb.calendar_sync.reconcile_all(bsb.accounts.system_account())
+
+        drifted = 0
+        errors = 0
+
+        for report in reports:
+            drifted += report.numDrifted()
+            errors += len(report.errors)
+
+        return "Reconciled %d calendars. Repaired %d drifted events with %d errors" % \
+                    (len(reports), drifted, errors)
+
+class SyncCalendarTask(BaseTask):
+    """Task queued by a calendar notification that incrementally syncs the
+       calendar of a single piece of equipment. Unless 'repair' is set, this only
+       checks the calendar, and queues a repair if it finds drift"""
+
+    def run_task(self):
+        equip = bsb.equipment.get_equipment(self.request.get("equipment"))
+
+        if not equip:
+            return "There is no equipment '%s'" % self.request.get("equipment")
+
+        repair = bsb.to_bool(self.request.get("repair"))
+
+        try:
+            with bsb.rate_limit.priority(bsb.rate_limit.BACKGROUND):
+                report = bsb.calendar_sync.reconcile_equipment(bsb.accounts.system_account(), equip,
+                                                                repair=repair)
+        except bsb.calendar.CalendarUnavailableError as e:
+            # ask the task queue to retry this sync later
+            self.response.set_status(503)
+            return e.errorMessage()
+
+        if not report:
+            return "The calendar of '%s' is not connected" % equip.name
+
+        if not repair and report.needsRepair():
+            # repair later, so that changes to the bookings that are still
+            # being written to the calendar are not repaired twice
+            bsb.calendar_watch.queue_sync(equip.idstring, repair=True)
+
+            return "Synced %d changed events for '%s'. Found %d drifted events, so queued a repair" % \
+                        (report.num_changed, equip.name, report.numDrifted())
+
+        if report.repaired:
+            return "Synced %d changed events for '%s'. Repaired %d drifted events" % \
+                        (report.num_changed, equip.name, report.numDrifted())
+        else:
+            return "Synced %d changed events for '%s'. Found %d drifted events" % \
+                        (report.num_changed, equip.name, report.numDrifted())
+
+class RenewCalendarChannelsTask(BaseTask):
+    """Task that makes sure every equipment calendar is watched by a channel
+       that sends notifications to this application"""
+
+    def run_task(self):
+        address = self.request.host_url + bsb.calendar_watch.NOTIFY_PATH
+
+        with bsb.rate_limit.priority(bsb.rate_limit.BACKGROUND):
+            (opened, stopped) = bsb.calendar_watch.renew_channels(bsb.accounts.system_account(), address)
+
+        return "Opened %d channels and stopped %d channels" % (opened, stopped)
+
+class PostLocalNotificationsTask(BaseTask):
+    """Task that stands in for google when running locally, posting a notification
+       to the webhook for each local channel"""
+
+    def run_task(self):
+        results = bsb.calendar_watch.post_local_notifications(self.request.host_url,
+                                                              self.request.get("calendar", None),
+                                                              self.request.get("state", "exists"))
+
+        return "\n".join( ["%s: %d" % (channel_id, status) for (channel_id, status) in results] )
+
+class ExportBookingsTask(BaseTask):
+    """Task that writes the next pages of a generated export file of the bookings,
+       queueing itself again until the export is complete"""
+
+    def run_task(self):
+        export = bsb.export.run_export(self.request.get("export"),
+                                       self.request.get("registry", bsb.export.DEFAULT_EXPORT_REGISTRY))
+
+        if not export:
+            return "There is no export '%s'" % self.request.get("export")
+
+        return "Exported %d bookings in %d chunks" % (export.num_rows, export.num_chunks)
+
+class RunBillingTask(BaseTask):
+    """Task that runs the billing job for a period (by default the previous month),
+       queueing itself again until all of the bookings have been scanned"""
+
+    def run_task(self):
+        period = self.request.get("period", None) or bsb.billing.previous_period()
+
+        (run, num_invoices) = bsb.billing.run_billing(period, bsb.to_bool(self.request.get("invoices_only")),
+                                                      self.request.get("registry", bsb.billing.DEFAULT_BILLING_REGISTRY))
+
+        if run.is_scanning:
+            return "Scanned %d bookings for %s so far" % (run.num_bookings, period)
+
+        return "Saved %d new invoice versions for %s" % (num_invoices, period)
+
+class RestoreBackupTask(BaseTask):
+    """Task that runs the next part of a restore job, queueing itself again
+       until the restore has finished"""
+
+    def run_task(self):
+        job = bsb.backup.run_restore(self.request.get("job"))
+
+        if job is None:
+            return "No such restore job"
+
+        return "Restore job %s is at phase '%s' (%d records restored)" % (job.jobID(), job.phase, job.numRestored())
+
+class PrecomputeReportsTask(BaseTask):
+    """Task that computes the booking reports of a window (by default the window shown
+       first on the reports page) and of the windows either side, so they are cached"""
+
+    def run_task(self):
+        n = bsb.reports.precompute_reports(bsb.to_date(self.request.get("range_start")),
+                                           bsb.to_date(self.request.get("range_end")))
+
+        return "Computed %d reports" % n
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Pages used to warm up a new instance before it starts serving requests"""
+
+# web application framework
+import webapp2
+
+# base pages
+import base_pages
+
+# BSB interface
+import bsb
+
+# templates that are used on nearly every page, which are compiled during warmup
+common_templates = [ "header.html", "footer.html", "index.html", "message.html",
+                     "equipment.html", "view_equipment.html", "bookings.html" ]
+
+def _warmup_instance():
+    """Import the page modules, compile the common templates and then warm up
+       the BSB interface. Returns a list of (step, seconds) timings"""
+
+    # the routes are lazily loaded, so import the page modules now
+    import account_pages
+    import admin_pages
+    import calendar_pages
+    import equipment_pages
+    import feedback_pages
+    import report_pages
+
+    for template in common_templates:
+        base_pages.JINJA_ENVIRONMENT.get_template("/templates/%s" % template)
+
+    return bsb.warmup.warmup()
+
+class WarmupPage(webapp2.RequestHandler):
+    """Class that handles the /_ah/warmup request sent by App Engine when
+       a new instance is started"""
+
+    def get(self):
+        _warmup_instance()
+        self.response.headers["Content-Type"] = "text/plain"
+        self.response.write("Warmed up")
+
+class LocalWarmupPage(base_pages.BaseGetPage):
+    """Class that lets an administrator warm up the current instance by hand.
+       This is the equivalent of /_ah/warmup for the local development server"""
+
+    def needsAdmin(self):
+        return True
+
+    def saveReferrer(self):
+        return False
+
+    def render_get(self, state):
+        timings = _warmup_instance()
+
+        state.setTemplate("header", "This instance has been warmed up.")
+
+        for (step, seconds) in timings:
+            state.addMessage("%s : %.3f s" % (step, seconds))
+
+        self.write(state, "message.html", "Warmup")